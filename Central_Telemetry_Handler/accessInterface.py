@@ -3,8 +3,11 @@ import pymongo
 import logging
 import requests
 
+from concurrent import futures
+
 from flask import Flask
 from flask import request
+from flask import Response
 from flask import jsonify
 from flask import make_response
 
@@ -29,6 +32,9 @@ class AccessInterface(QThread):
         self.__dataEngine = data_engine
         self.__query_timeout = config.get_query_timeout()
 
+        # Concurrent queries of the agents by the bulk monitor and inventory requests
+        self.__executor = futures.ThreadPoolExecutor(max_workers=config.get_fan_out_workers())
+
         self.__cache_k8s_inventory = {}
 
         self.address = config.get_rest_interface()["address"]
@@ -73,6 +79,25 @@ class AccessInterface(QThread):
         def get_infrastructure_inventory(cluster_uuid):
             return make_response(jsonify(self.__dataEngine.get_infrastructure_inventory(str(cluster_uuid))), 200)
 
+        @self.rest_app.route("/api/v1/telemetry/central/infrastructure/capacity", methods=["GET"])
+        @auth.login_required
+        def get_infrastructure_capacity():
+            data, etag = self.__dataEngine.get_capacity()
+            return self.__etag_response({"clusters": data}, etag)
+
+        @self.rest_app.route("/api/v1/telemetry/central/infrastructure/capacity/<uuid:cluster_uuid>", methods=["GET"])
+        @auth.login_required
+        def get_cluster_capacity(cluster_uuid):
+            data, etag = self.__dataEngine.get_capacity(str(cluster_uuid))
+            if not data:
+                return make_response(jsonify({}), 404)
+            return self.__etag_response(data[0], etag)
+
+        @self.rest_app.route("/api/v1/telemetry/central/infrastructure/monitor", methods=["GET"])
+        @auth.login_required
+        def get_platform_monitor():
+            return make_response(jsonify(self.__dataEngine.get_platform_monitor()), 200)
+
         @self.rest_app.route("/api/v1/telemetry/central/infrastructure/monitor/<uuid:cluster_uuid>", methods=["GET"])#/<uuid>
         @auth.login_required
         def get_infrastructure_monitor(cluster_uuid):
@@ -98,8 +123,8 @@ class AccessInterface(QThread):
         @self.rest_app.route("/api/v1/telemetry/central/deployments", methods=["POST"])
         @auth.login_required
         def set_serrano_deployment():
-            self.__dataEngine.set_serrano_deployment(request.get_json())
-            return make_response(jsonify({}), 201)
+            outcomes = self.__dataEngine.set_serrano_deployment(request.get_json())
+            return make_response(jsonify({"clusters": outcomes}), 201)
 
         @self.rest_app.route("/api/v1/telemetry/central/deployments/<uuid:deployment_uuid>", methods=["GET", "DELETE"])
         @auth.login_required
@@ -108,13 +133,23 @@ class AccessInterface(QThread):
                 data = {"deployments": self.__dataEngine.get_serrano_deployments({"deployment_uuid": str(deployment_uuid)})}
                 return make_response(jsonify(data), 200)
             elif request.method == "DELETE":
-                return make_response(jsonify(self.__dataEngine.delete_serrano_deployment(str(deployment_uuid))), 200)
+                outcomes = self.__dataEngine.delete_serrano_deployment(str(deployment_uuid))
+                return make_response(jsonify({"clusters": outcomes}), 200)
 
         @self.rest_app.route("/api/v1/telemetry/central/clusters", methods=["GET"])
         @auth.login_required
         def get_available_clusters():
             return make_response(jsonify({"clusters": self.__dataEngine.get_clusters()}), 200)
 
+        @self.rest_app.route("/api/v1/telemetry/central/clusters/select", methods=["POST"])
+        @auth.login_required
+        def select_clusters():
+            try:
+                data = self.__dataEngine.select_clusters(request.get_json(silent=True))
+            except (TypeError, ValueError) as err:
+                return make_response(jsonify({"error": str(err)}), 400)
+            return make_response(jsonify({"clusters": data}), 200)
+
         @self.rest_app.route("/api/v1/telemetry/central/clusters/<uuid:cluster_uuid>", methods=["GET"])
         @auth.login_required
         def cluster_inventory_from_db(cluster_uuid):
@@ -124,6 +159,16 @@ class AccessInterface(QThread):
             else:
                 return make_response(jsonify({}), 404)
 
+        @self.rest_app.route("/api/v1/telemetry/central/clusters/inventory", methods=["GET"])
+        @auth.login_required
+        def bulk_cluster_inventory():
+            return self.__bulk_response("inventory", request.args, ["max_age"])
+
+        @self.rest_app.route("/api/v1/telemetry/central/clusters/monitor", methods=["GET"])
+        @auth.login_required
+        def bulk_cluster_monitor():
+            return self.__bulk_response("monitor", request.args, ["target", "max_age"])
+
         @self.rest_app.route("/api/v1/telemetry/central/clusters/inventory/<uuid:cluster_uuid>", methods=["GET"])
         @auth.login_required
         def cluster_inventory(cluster_uuid):
@@ -132,12 +177,14 @@ class AccessInterface(QThread):
             if cluster_uuid in agents_by_cluster_id.keys():
                 agent_url = agents_by_cluster_id[cluster_uuid]["url"]
                 probe_uuid = agents_by_cluster_id[cluster_uuid]["probe_uuid"]
+                params = {k: v for k, v in request.args.to_dict().items() if k in ["max_age"]}
                 try:
                     res = requests.get("%s/api/v1/telemetry/agent/inventory/%s" % (agent_url, probe_uuid),
+                                       params=params,
                                        verify=True,
                                        timeout=self.__query_timeout)
                     if res.status_code == 200 or res.status_code == 201:
-                        return make_response(jsonify(json.loads(res.text)), 200)
+                        return self.__proxy_response(res)
                     else:
                         return make_response(jsonify({}), res.status_code)
                 except Exception as e:
@@ -155,14 +202,12 @@ class AccessInterface(QThread):
                 agent_url = agents_by_cluster_id[cluster_uuid]["url"]
                 probe_uuid = agents_by_cluster_id[cluster_uuid]["probe_uuid"]
                 q_url = "%s/api/v1/telemetry/agent/monitor/%s" % (agent_url, probe_uuid)
-                target = request.args.to_dict().get("target", None)
-                if target:
-                    q_url += "?target=%s" % target
+                params = {k: v for k, v in request.args.to_dict().items() if k in ["target", "max_age"]}
 
                 try:
-                    res = requests.get(q_url, verify=True, timeout=self.__query_timeout)
+                    res = requests.get(q_url, params=params, verify=True, timeout=self.__query_timeout)
                     if res.status_code == 200 or res.status_code == 201:
-                        return make_response(jsonify(json.loads(res.text)), 200)
+                        return self.__proxy_response(res)
                     else:
                         return make_response(jsonify({}), res.status_code)
                 except Exception as e:
@@ -176,7 +221,39 @@ class AccessInterface(QThread):
         def cluster_metrics(cluster_uuid):
             cluster_uuid = str(cluster_uuid)
             if cluster_uuid in self.__dataEngine.get_registered_agents().keys():
-                data = self.__dataEngine.get_cluster_metrics(cluster_uuid, request.args.to_dict())
+                args = request.args.to_dict()
+                # target=all returns all the states of the range in a single response ({"metrics"}) as before. The
+                # pagination is opt-in (paginate=true, limit or cursor): a page of the states and the cursor of the
+                # next one ({"metrics", "next_cursor"}). format=ndjson streams the states instead.
+                paginate = args.get("paginate", None) == "true" or "limit" in args or "cursor" in args
+                try:
+                    if args.get("target", None) == "all" and (args.get("format", None) == "ndjson" or
+                                                              request.accept_mimetypes.best == "application/x-ndjson"):
+                        return Response(self.__dataEngine.stream_cluster_metrics(cluster_uuid, args),
+                                        mimetype="application/x-ndjson")
+                    if args.get("target", None) == "all" and paginate:
+                        return make_response(jsonify(self.__dataEngine.get_cluster_metrics_page(cluster_uuid, args)),
+                                             200)
+                    data = self.__dataEngine.get_cluster_metrics(cluster_uuid, args)
+                except ValueError:
+                    return make_response(jsonify({"error": "Invalid query parameters"}), 400)
+                return make_response(jsonify({"metrics": data}), 200)
+
+            return make_response(jsonify({}), 404)
+
+        @self.rest_app.route("/api/v1/telemetry/central/clusters/metrics/<uuid:cluster_uuid>/<string:entity_type>",
+                             methods=["GET"])
+        @self.rest_app.route("/api/v1/telemetry/central/clusters/metrics/<uuid:cluster_uuid>/<string:entity_type>/"
+                             "<path:entity_name>", methods=["GET"])
+        @auth.login_required
+        def cluster_entity_metrics(cluster_uuid, entity_type, entity_name=None):
+            cluster_uuid = str(cluster_uuid)
+            if cluster_uuid in self.__dataEngine.get_registered_agents().keys():
+                try:
+                    data = self.__dataEngine.get_cluster_entity_metrics(cluster_uuid, entity_type, entity_name,
+                                                                        request.args.to_dict())
+                except ValueError:
+                    return make_response(jsonify({"error": "Invalid query parameters"}), 400)
                 return make_response(jsonify({"metrics": data}), 200)
 
             return make_response(jsonify({}), 404)
@@ -215,6 +292,92 @@ class AccessInterface(QThread):
             deployment_uuid = str(deployment_uuid)
             return make_response(jsonify({"metrics": self.__dataEngine.get_serrano_deployment_metrics(deployment_uuid)}), 200)
 
+    def __bulk_response(self, kind, args, forwarded_params):
+
+        # Clusters as "clusters=<uuid>,<uuid>" or repeated "clusters" parameters, all of them by default
+        cluster_uuids = [c.strip() for v in args.getlist("clusters") for c in v.split(",") if c.strip()]
+
+        try:
+            deadline = float(args.get("deadline", None) or self.__query_timeout)
+            if deadline <= 0:
+                raise ValueError(deadline)
+        except (TypeError, ValueError):
+            return make_response(jsonify({"error": "Invalid deadline"}), 400)
+
+        params = {k: v for k, v in args.to_dict().items() if k in forwarded_params}
+
+        return make_response(jsonify({"clusters": self.__fan_out(kind, cluster_uuids, params, deadline)}), 200)
+
+    def __fan_out(self, kind, cluster_uuids, params, deadline):
+
+        agents_by_cluster_id = self.__dataEngine.get_registered_agents()
+
+        if not cluster_uuids or "all" in cluster_uuids:
+            cluster_uuids = list(agents_by_cluster_id.keys())
+
+        data = {}
+        pending = {}
+
+        for cluster_uuid in cluster_uuids:
+            if cluster_uuid not in agents_by_cluster_id:
+                data[cluster_uuid] = {"status": "not_found"}
+                continue
+            pending[self.__executor.submit(self.__query_agent, kind, agents_by_cluster_id[cluster_uuid], params,
+                                           deadline)] = cluster_uuid
+
+        # Every cluster is answered within the deadline, with the results of the agents that replied in time
+        done, not_done = futures.wait(pending.keys(), timeout=deadline)
+
+        for future in done:
+            try:
+                data[pending[future]] = future.result()
+            except Exception as err:
+                data[pending[future]] = {"status": "error", "error": "%s - %s" % (err.__class__.__name__, str(err))}
+
+        for future in not_done:
+            future.cancel()
+            data[pending[future]] = {"status": "timeout"}
+
+        return data
+
+    @staticmethod
+    def __query_agent(kind, agent, params, deadline):
+
+        q_url = "%s/api/v1/telemetry/agent/%s/%s" % (agent["url"], kind, agent["probe_uuid"])
+
+        try:
+            res = requests.get(q_url, params=params, verify=True, timeout=deadline)
+        except requests.exceptions.Timeout:
+            return {"status": "timeout"}
+
+        if res.status_code != 200 and res.status_code != 201:
+            return {"status": "error", "status_code": res.status_code}
+
+        data = {"status": "ok", "data": res.json()}
+        if "Age" in res.headers:
+            data["age"] = int(res.headers["Age"])
+
+        return data
+
+    @staticmethod
+    def __etag_response(data, etag):
+        # Unchanged capacity summaries are not sent again to clients that already hold them
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+        else:
+            response = make_response(jsonify(data), 200)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def __proxy_response(res):
+        # Agent payloads are forwarded as is, along with their freshness
+        response = make_response(res.text, 200)
+        response.headers["Content-Type"] = "application/json"
+        if "Age" in res.headers:
+            response.headers["Age"] = res.headers["Age"]
+        return response
+
     def __del__(self):
         self.wait()
 
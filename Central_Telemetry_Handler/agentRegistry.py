@@ -0,0 +1,87 @@
+import time
+import logging
+import threading
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger("SERRANO.CentralTelemetryHandler.AgentRegistry")
+
+
+class AgentRegistry:
+
+    def __init__(self, entities_collection, config):
+
+        # Cluster -> agent map, shared by the requests of the access interface. It is built with a single aggregation
+        # and built again once its TTL expires, or as soon as the registered entities change when a change stream
+        # is available.
+        self.__entitiesCollection = entities_collection
+        self.__ttl = config["ttl"]
+
+        self.__lock = threading.Lock()
+        self.__agents_by_cluster_id = None
+        self.__timestamp = 0
+        self.__generation = 0
+
+        if config["change_stream"]:
+            threading.Thread(target=self.__watch_entities, daemon=True).start()
+
+    def __build(self):
+
+        pipeline = [{"$match": {"type": "Agent"}},
+                    {"$project": {"_id": 0, "url": 1, "probes": 1}},
+                    {"$unwind": "$probes"},
+                    {"$lookup": {"from": self.__entitiesCollection.name,
+                                 "localField": "probes",
+                                 "foreignField": "uuid",
+                                 "as": "probe"}},
+                    {"$unwind": "$probe"},
+                    {"$project": {"url": 1, "probe_uuid": "$probes", "cluster_uuid": "$probe.cluster_uuid"}}]
+
+        agents_by_cluster_id = {}
+        for item in self.__entitiesCollection.aggregate(pipeline):
+            if item.get("cluster_uuid", None):
+                agents_by_cluster_id[item["cluster_uuid"]] = {"url": item["url"], "probe_uuid": item["probe_uuid"]}
+
+        return agents_by_cluster_id
+
+    def get_registered_agents(self):
+
+        with self.__lock:
+            if self.__agents_by_cluster_id is not None and time.time() - self.__timestamp < self.__ttl:
+                return self.__agents_by_cluster_id
+            generation = self.__generation
+
+        agents_by_cluster_id = self.__build()
+
+        with self.__lock:
+            # A map built while the entities changed is returned but not kept
+            if generation == self.__generation:
+                self.__agents_by_cluster_id = agents_by_cluster_id
+                self.__timestamp = time.time()
+
+        return agents_by_cluster_id
+
+    def invalidate(self):
+        with self.__lock:
+            self.__agents_by_cluster_id = None
+            self.__generation += 1
+
+    def __watch_entities(self):
+
+        while True:
+            try:
+                with self.__entitiesCollection.watch() as stream:
+                    logger.info("Watch the registered entities for changes")
+                    self.invalidate()
+                    for _ in stream:
+                        self.invalidate()
+            except OperationFailure as err:
+                # e.g. change streams are not supported by standalone deployments, the TTL still applies
+                logger.warning("Registered entities are not watched - %s" % str(err))
+                self.invalidate()
+                return
+            except Exception as err:
+                logger.error("Unable to watch the registered entities")
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                self.invalidate()
+                time.sleep(max(self.__ttl, 1))
@@ -26,11 +26,21 @@ class CentralHandlerConfiguration:
         self.__config["query_internal"] = interval
 
     def get_query_timeout(self):
-        return 5 if "query_timeout" not in self.__config else self.__config["query_timeout"]
+        # Seconds, the default also applies when the value is left blank
+        return self.__config.get("query_timeout", None) or 5
 
     def set_query_timeout(self, timeout):
         self.__config["query_timeout"] = timeout
 
+    def get_retain_data_period(self):
+        return 1800 if not self.__config.get("retain_data_period", None) else self.__config["retain_data_period"]
+
+    def get_metrics_page_size(self):
+        return 500 if not self.__config.get("metrics_page_size", None) else self.__config["metrics_page_size"]
+
+    def get_fan_out_workers(self):
+        return 16 if not self.__config.get("fan_out_workers", None) else self.__config["fan_out_workers"]
+
     def get_operational_db(self):
         data = {"address": "", "username": "", "password": "", "dbName": ""}
 
@@ -43,6 +53,34 @@ class CentralHandlerConfiguration:
         if "dbName" in self.__config["operational_db"]:
             data["dbName"] = self.__config["operational_db"]["dbName"]
 
+        data["storage_mode"] = self.__config["operational_db"].get("storage_mode", None) or "collection"
+
+        return data
+
+    def get_agent_registry(self):
+
+        # The registrations are written by the agents, the central handler only learns about them from the change
+        # stream of the entities collection (where available) or once the TTL expires
+        data = {"ttl": 30, "change_stream": True}
+
+        agent_registry = self.__config.get("agent_registry", None) or {}
+
+        for k in data:
+            if agent_registry.get(k, None) is not None:
+                data[k] = agent_registry[k]
+
+        return data
+
+    def get_deployment_outbox(self):
+
+        data = {"retry_interval": 30, "max_attempts": 20, "batch_size": 100}
+
+        deployment_outbox = self.__config.get("deployment_outbox", None) or {}
+
+        for k in data:
+            if deployment_outbox.get(k, None) is not None:
+                data[k] = deployment_outbox[k]
+
         return data
 
     def get_rest_interface(self):
@@ -0,0 +1,128 @@
+import time
+
+"""
+    Cluster selection queries over the cluster_nodes documents (numeric capacity and latest utilization per node):
+
+        {"nodes": {"gpu": {"$gte": 1}, "architecture": "amd64"},
+         "require": [{"vaccel": true, "security_tier": {"$gte": 2}}],
+         "clusters": {"gpu": {"$gte": 2}},
+         "rank": {"field": "memory_free", "order": "desc"},
+         "max_utilization_age": 120,
+         "limit": 5}
+
+    "nodes" selects the candidate nodes, "require" lists node predicates that at least one candidate node of a
+    cluster has to satisfy and "clusters" applies to the totals of the candidate nodes of each cluster. The
+    matching clusters are ranked by one of their totals.
+"""
+
+# Totals of the candidate nodes per cluster
+TOTAL_FIELDS = ["cpu", "memory", "gpu", "fpga", "storage", "pods", "cpu_used", "cpu_free", "memory_used",
+                "memory_free", "filesystem_free", "running_pods"]
+
+NODE_FIELDS = TOTAL_FIELDS + ["node_name", "architecture", "vaccel", "security_tier", "memory_usage_percentage",
+                              "filesystem_usage_percentage"]
+
+OPERATORS = ["$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in"]
+
+
+def check_value(field, value):
+    if isinstance(value, (dict, list)):
+        raise ValueError("Invalid value of '%s'" % field)
+
+
+def match_filter(predicate, fields):
+
+    # Predicate to a find() filter, restricted to the given fields and comparison operators
+    if not isinstance(predicate, dict):
+        raise ValueError("Predicate is not an object")
+
+    query_filter = {}
+
+    for field, condition in predicate.items():
+        if field not in fields:
+            raise ValueError("Unknown field '%s'" % field)
+
+        if not isinstance(condition, dict):
+            check_value(field, condition)
+            query_filter[field] = condition
+            continue
+
+        for op, value in condition.items():
+            if op not in OPERATORS:
+                raise ValueError("Unknown operator '%s'" % op)
+            if op == "$in":
+                if not isinstance(value, list):
+                    raise ValueError("Operator '$in' of '%s' expects a list" % field)
+                for v in value:
+                    check_value(field, v)
+            else:
+                check_value(field, value)
+
+        query_filter[field] = dict(condition)
+
+    return query_filter
+
+
+def match_expression(query_filter):
+
+    # find() filter (as returned by match_filter) to an aggregation expression
+    expressions = []
+
+    for field, condition in query_filter.items():
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, value in condition.items():
+            expressions.append({op: ["$%s" % field, value]})
+
+    return {"$and": expressions} if expressions else True
+
+
+def pipeline(query):
+
+    if not isinstance(query, dict):
+        raise ValueError("Query is not an object")
+
+    node_filter = match_filter(query.get("nodes", None) or {}, NODE_FIELDS)
+    cluster_filter = match_filter(query.get("clusters", None) or {}, TOTAL_FIELDS + ["node_count"])
+
+    requirements = query.get("require", None) or []
+    if not isinstance(requirements, list):
+        raise ValueError("Field 'require' is not a list")
+    requirements = [match_expression(match_filter(r, NODE_FIELDS)) for r in requirements]
+
+    rank = query.get("rank", None) or {"field": "node_count"}
+    if isinstance(rank, str):
+        rank = {"field": rank}
+    if not isinstance(rank, dict) or rank.get("field", None) not in TOTAL_FIELDS + ["node_count"]:
+        raise ValueError("Invalid rank field")
+    if rank.get("order", "desc") not in ["asc", "desc"]:
+        raise ValueError("Invalid rank order")
+
+    limit = int(query.get("limit", 0) or 0)
+    if limit < 0:
+        raise ValueError("Invalid limit")
+
+    if query.get("max_utilization_age", None):
+        node_filter["utilization_timestamp"] = {"$gte": int(time.time() - float(query["max_utilization_age"]))}
+
+    group = {"_id": "$cluster_uuid", "nodes": {"$push": "$$ROOT"}, "node_count": {"$sum": 1}}
+    for field in TOTAL_FIELDS:
+        group[field] = {"$sum": "$%s" % field}
+    for i, expression in enumerate(requirements):
+        group["require_%s" % i] = {"$max": {"$cond": [expression, 1, 0]}}
+
+    cluster_filter.update({"require_%s" % i: 1 for i in range(len(requirements))})
+
+    stages = [{"$match": node_filter},
+              {"$project": {"_id": 0}},
+              {"$group": group},
+              {"$match": cluster_filter},
+              {"$sort": {rank["field"]: -1 if rank.get("order", "desc") == "desc" else 1, "_id": 1}}]
+
+    if limit:
+        stages.append({"$limit": limit})
+
+    totals = {field: "$%s" % field for field in TOTAL_FIELDS + ["node_count"]}
+    stages.append({"$project": {"_id": 0, "cluster_uuid": "$_id", "totals": totals, "nodes": 1}})
+
+    return stages
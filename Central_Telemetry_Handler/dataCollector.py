@@ -25,8 +25,14 @@ class DataCollector(QObject):
         self.__collectorTimer = None
 
         self.__query_cloud_storage_locations(config.get_cloud_storage_locations())
+        self.__acquire_platform_level_data()
         self.__setup_timer()
 
+        # Deployment notifications that did not reach the agents are retried from the deployment outbox
+        self.__outboxTimer = QTimer(self)
+        self.__outboxTimer.timeout.connect(self.__dataEngine.retry_deployment_outbox)
+        self.__outboxTimer.start(config.get_deployment_outbox()["retry_interval"] * 1000)
+
     def __setup_timer(self):
         if not self.__collectorTimer:
             self.__collectorTimer = QTimer(self)
@@ -36,6 +42,10 @@ class DataCollector(QObject):
 
         self.__collectorTimer.start(self.__query_interval * 1000)
 
+    def __acquire_platform_level_data(self):
+        logger.info("Update platform level data ...")
+        self.__dataEngine.update_platform_rollup()
+
     def __query_cloud_storage_locations(self, params):
         try:
             res = requests.get("https://%s/cloud_locations" % (params["address"]), verify=True)
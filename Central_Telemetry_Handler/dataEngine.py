@@ -1,18 +1,46 @@
 import json
 import time
+import uuid
+import hashlib
 import logging
+import threading
 import pymongo
 import datetime
 import requests
 
+from bson import ObjectId
+from concurrent import futures
+
+import stateDelta
+import agentRegistry
+import schemaManager
+import platformRollup
+import clusterSelection
+
 logger = logging.getLogger("SERRANO.CentralTelemetryHandler.DataEngine")
 
+# Seconds of cluster states re-read by each platform rollup, for the write cycles in progress during the previous one
+ROLLUP_WATERMARK_MARGIN = 10
+
 
 class DataEngine:
 
     def __init__(self, config):
 
         self.__storage_gateway_service = config.get_cloud_storage_locations()["address"]
+        self.__metrics_page_size = config.get_metrics_page_size()
+        self.__query_timeout = config.get_query_timeout()
+        self.__deployment_outbox = config.get_deployment_outbox()
+
+        # Latest rollups per cluster and for the platform ("serrano"), updated incrementally by the data collector
+        self.__rollup_lock = threading.Lock()
+        self.__rollup_watermark = 0
+        self.__state_rollups = {}
+        self.__edge_storage_rollups = {}
+        self.__rollups = {}
+
+        # Concurrent deployment notifications of the agents
+        self.__executor = futures.ThreadPoolExecutor(max_workers=config.get_fan_out_workers())
 
         operational_db = config.get_operational_db()
 
@@ -23,6 +51,8 @@ class DataEngine:
         mongo_client = pymongo.MongoClient(mongo_uri)
 
         self.__clusterCollection = mongo_client[operational_db["dbName"]]["clusters"]
+        self.__clusterCapacityCollection = mongo_client[operational_db["dbName"]]["cluster_capacity"]
+        self.__clusterNodesCollection = mongo_client[operational_db["dbName"]]["cluster_nodes"]
         self.__kernelsCollection = mongo_client[operational_db["dbName"]]["serrano_kernels"]
         self.__kernelDeploymentsCollection = mongo_client[operational_db["dbName"]]["serrano_kernel_deployments"]
         self.__kernelMetricsCollection = mongo_client[operational_db["dbName"]]["serrano_kernel_metrics"]
@@ -31,9 +61,13 @@ class DataEngine:
         self.__cloudStorageCollection = mongo_client[operational_db["dbName"]]["cloud_storage_locations"]
         self.__edgeStorageCollection = mongo_client[operational_db["dbName"]]["edge_storage"]
         self.__edgeStorageMetricsCollection = mongo_client[operational_db["dbName"]]["edge_storage_metrics"]
+        self.__clusterLatestCollection = mongo_client[operational_db["dbName"]]["cluster_state_latest"]
+        self.__edgeStorageLatestCollection = mongo_client[operational_db["dbName"]]["edge_storage_latest"]
+        self.__clusterEntityMetricsCollection = mongo_client[operational_db["dbName"]]["cluster_entity_metrics"]
         self.__infrastructureCollection = mongo_client[operational_db["dbName"]]["infrastructure"]
         self.__infrastructureMetricsCollection = mongo_client[operational_db["dbName"]]["serrano_state_metrics"]
         self.__deploymentsCollection = mongo_client[operational_db["dbName"]]["serrano_deployments"]
+        self.__deploymentOutboxCollection = mongo_client[operational_db["dbName"]]["deployment_outbox"]
         self.__deploymentsSpecificMetricsCollection = mongo_client[operational_db["dbName"]]["deployments_specific_metrics"]
 
         self.__clusterDeploymentMetricsCollection = mongo_client[operational_db["dbName"]]["cluster_deployment_metrics"]
@@ -41,6 +75,19 @@ class DataEngine:
 
         self.__applicationCollection = mongo_client[operational_db["dbName"]]["application_metrics"]
 
+        self.__agentRegistry = agentRegistry.AgentRegistry(self.__entitiesCollection, config.get_agent_registry())
+
+        # Capacity summaries written by the agents on inventory changes, cached per version
+        self.__capacity_lock = threading.Lock()
+        self.__capacity_cache = {}
+
+        schema_manager = schemaManager.SchemaManager(mongo_client[operational_db["dbName"]],
+                                                     operational_db["storage_mode"])
+        schema_manager.ensure_indexes()
+        # The platform states are written only by the Central Telemetry Handler, the agents expire their own metrics
+        schema_manager.ensure_ttl_indexes(config.get_retain_data_period(), schemaManager.CENTRAL_METRICS_COLLECTIONS)
+        schema_manager.check_query_plans()
+
     def handle_cloud_storage_locations(self, data):
 
         logger.info("Update operational database with cloud storage locations")
@@ -50,33 +97,22 @@ class DataEngine:
 
 
     def get_registered_agents(self):
-        agents_by_cluster_id = {}
-
-        for entity in self.__entitiesCollection.find({"type": "Agent"}, {"url": 1, "probes": 1}):
-            for probe_id in entity["probes"]:
-                c = self.__entitiesCollection.find_one({"uuid": probe_id}, {"cluster_uuid": 1})
-                if c:
-                    agents_by_cluster_id[c["cluster_uuid"]] = {"url": entity["url"], "probe_uuid": probe_id}
-
-        return agents_by_cluster_id
+        return self.__agentRegistry.get_registered_agents()
 
     def get_infrastructure(self, args):
         data = {}
         query_kernels = args.get("kernels", None)
 
-        data["k8s"] = list(self.__clusterCollection.find({"type": "k8s"},
-                                                         {"_id": 0, "uuid": 1, "inventory":
-                                                             {"node_info": {"architecture": 1},
-                                                              "node_capacity": {
-                                                                  "total_fpga": 1,
-                                                                  "total_gpu": 1,
-                                                                  "cpu": 1,
-                                                                  "memory": 1},
-                                                              "node_labels": 1}}))
+        # Served from the capacity summaries written by the agents, instead of projecting the full inventory of
+        # every cluster document
+        summaries = self.__capacity_summaries()
+
+        data["k8s"] = [{"uuid": s["cluster_uuid"],
+                        "inventory": [{k: v for k, v in n.items() if k != "node_name"} for n in s.get("inventory", [])]}
+                       for s in summaries if s["type"] == "k8s"]
 
-        data["hpc"] = list(self.__clusterCollection.find({"type": "HPC"}, {"_id": 0,
-                                                                           "uuid": 1,
-                                                                           "inventory": {"partitions": 1}}))
+        data["hpc"] = [{"uuid": s["cluster_uuid"], "inventory": s.get("inventory", {})}
+                       for s in summaries if s["type"] == "HPC"]
 
         if not query_kernels:
             return data
@@ -95,21 +131,60 @@ class DataEngine:
         return data
 
     def get_infrastructure_inventory(self, uuid):
-        data = {}
-        self.uuid = uuid
-        data["capacity"] = list(self.__clusterCollection.find({"uuid": self.uuid, }, {"_id": 0,
-                                                                                      "inventory": {"node_name": 1,
-                                                                                                    "node_capacity": {
-                                                                                                        "total_fpga": 1,
-                                                                                                        "total_gpu": 1,
-                                                                                                        "cpu": 1,
-                                                                                                        "memory": 1}}}))
-        data["security"] = list(self.__clusterCollection.find({"uuid": self.uuid, },
-                                                              {"_id": 0, "inventory": {"node_name": 1, "node_labels": {
-                                                                  "vaccel": 1,
-                                                                  "security-tier": 1}}}))
+        data = {"capacity": [], "security": []}
+
+        for summary in self.__capacity_summaries(uuid):
+            if summary["type"] != "k8s":
+                data["capacity"].append({"inventory": {}})
+                data["security"].append({"inventory": {}})
+                continue
+
+            nodes = summary.get("inventory", [])
+            data["capacity"].append({"inventory": [{k: n[k] for k in ["node_name", "node_capacity"] if k in n}
+                                                   for n in nodes]})
+            data["security"].append({"inventory": [dict({k: n[k] for k in ["node_name"] if k in n},
+                                                        node_labels={k: v for k, v in n.get("node_labels", {}).items()
+                                                                     if k in ["vaccel", "security-tier"]})
+                                                   for n in nodes]})
         return data
 
+    def __capacity_summaries(self, cluster_uuid=None):
+
+        # Capacity summaries of the clusters. Only the versions are read, a summary is fetched again once its
+        # version changes.
+        query_filter = {"cluster_uuid": cluster_uuid} if cluster_uuid else {}
+        versions = {d["cluster_uuid"]: d["version"]
+                    for d in self.__clusterCapacityCollection.find(query_filter,
+                                                                   {"_id": 0, "cluster_uuid": 1, "version": 1})}
+
+        with self.__capacity_lock:
+            changed = [k for k, v in versions.items() if self.__capacity_cache.get(k, {}).get("version", None) != v]
+
+        if changed:
+            summaries = list(self.__clusterCapacityCollection.find({"cluster_uuid": {"$in": changed}}, {"_id": 0}))
+            with self.__capacity_lock:
+                for summary in summaries:
+                    self.__capacity_cache[summary["cluster_uuid"]] = summary
+
+        with self.__capacity_lock:
+            if not cluster_uuid:
+                for k in set(self.__capacity_cache.keys()) - set(versions.keys()):
+                    del self.__capacity_cache[k]
+            return [self.__capacity_cache[k] for k in sorted(versions.keys()) if k in self.__capacity_cache]
+
+    def get_capacity(self, cluster_uuid=None):
+
+        # Capacity summaries (without the inventory fields of the infrastructure requests) and their ETag
+        data = [{k: v for k, v in s.items() if k != "inventory"} for s in self.__capacity_summaries(cluster_uuid)]
+
+        etag = hashlib.sha1(",".join([d["version"] for d in data]).encode("utf-8")).hexdigest()
+
+        return data, etag
+
+    def select_clusters(self, query):
+        # Clusters (and their nodes) that satisfy the resource predicates of the query, ranked
+        return list(self.__clusterNodesCollection.aggregate(clusterSelection.pipeline(query)))
+
     def get_application_data(self, uuid):
         data = {}
         data = list(self.__applicationCollection.find({"cluster_uuid": uuid}, {"_id": 0}))
@@ -126,71 +201,285 @@ class DataEngine:
                                                                "timestamp": 1}))
 
     def get_serrano_per_cluster_deployments(self, args):
-        data = {}
 
-        serrano_deployments = list(self.__deploymentsCollection.find({}, {"_id": 0}))
+        cluster_uuid = args.get("cluster_uuid", None)
 
-        for deployment in serrano_deployments:
-            for cluster_uuid in deployment["clusters"]:
-                if cluster_uuid not in data:
-                    data[cluster_uuid] = []
-                data[cluster_uuid] += deployment[cluster_uuid]
+        # The Kubernetes deployments of each cluster are stored under the cluster_uuid key of the deployment documents
+        pipeline = [{"$unwind": "$clusters"},
+                    {"$project": {"_id": 0,
+                                  "cluster_uuid": "$clusters",
+                                  "k8s_deployments": {"$let": {
+                                      "vars": {"fields": {"$filter": {"input": {"$objectToArray": "$$ROOT"},
+                                                                      "cond": {"$eq": ["$$this.k", "$clusters"]}}}},
+                                      "in": {"$arrayElemAt": ["$$fields.v", 0]}}}}},
+                    {"$unwind": {"path": "$k8s_deployments", "preserveNullAndEmptyArrays": True}},
+                    {"$group": {"_id": "$cluster_uuid", "k8s_deployments": {"$push": "$k8s_deployments"}}}]
 
-        return data
+        if cluster_uuid:
+            # Served by the index on clusters, then restricted to the requested cluster
+            pipeline = [{"$match": {"clusters": cluster_uuid}}] + pipeline[:1] + \
+                       [{"$match": {"clusters": cluster_uuid}}] + pipeline[1:]
+
+        return {d["_id"]: d["k8s_deployments"] for d in self.__deploymentsCollection.aggregate(pipeline)}
 
     def set_serrano_deployment(self, data):
 
-        for cluster_uuid in data["clusters"]:
-            probe_uuid = self.__entitiesCollection.find_one({"type": "Probe.k8s", "cluster_uuid": cluster_uuid},
-                                                            {"uuid": 1})["uuid"]
+        logger.info("Request application monitoring of deployment '%s'" % data["deployment_uuid"])
 
-            agent = self.__entitiesCollection.find_one({"type": "Agent", "probes": probe_uuid})
+        outcomes = self.__notify_agents("set", data["deployment_uuid"],
+                                        {cluster_uuid: {"deployment_uuid": data["deployment_uuid"],
+                                                        "k8s_deployments": data[cluster_uuid]}
+                                         for cluster_uuid in data["clusters"]})
 
-            logger.info("Request application monitoring from Agent '%s' @ '%s'" % (agent["uuid"], agent["url"]))
+        self.__deploymentsCollection.replace_one({"deployment_uuid": data["deployment_uuid"]}, data, upsert=True)
 
-            try:
-                res = requests.post(f"{agent['url']}/api/v1/telemetry/agent/deployments",
-                                    json={"deployment_uuid": data["deployment_uuid"],
-                                          "k8s_deployments": data[cluster_uuid]})
-                if res.status_code != 201:
-                    logger.error("Unable to forward application monitoring request to Agent '%s'" % agent["uuid"])
-            except Exception as e:
-                print(str(e))
-                logger.error(str(e))
-
-        if self.__deploymentsCollection.count_documents({"deployment_uuid": data["deployment_uuid"]}) > 0:
-            self.__deploymentsCollection.delete_one({"deployment_uuid": data["deployment_uuid"]})
-        self.__deploymentsCollection.insert_one(data)
+        return outcomes
 
     def delete_serrano_deployment(self, deployment_uuid):
 
-        deployment = self.__deploymentsCollection.find_one({"deployment_uuid": deployment_uuid})
+        deployment = self.__deploymentsCollection.find_one({"deployment_uuid": deployment_uuid}, {"clusters": 1})
 
         if not deployment:
-            return
+            return {}
+
+        logger.info("Terminate application monitoring of deployment '%s'" % deployment_uuid)
+
+        outcomes = self.__notify_agents("delete", deployment_uuid,
+                                        {cluster_uuid: None for cluster_uuid in deployment["clusters"]})
+
+        self.__deploymentsCollection.delete_one({"deployment_uuid": deployment_uuid})
 
-        for cluster_uuid in deployment["clusters"]:
-            probe_uuid = self.__entitiesCollection.find_one({"type": "Probe.k8s", "cluster_uuid": cluster_uuid},
-                                                            {"uuid": 1})["uuid"]
+        return outcomes
 
-            agent = self.__entitiesCollection.find_one({"type": "Agent", "probes": probe_uuid})
+    def __resolve_deployment_agents(self, cluster_uuids):
 
-            logger.info("Terminate application monitoring from Agent '%s'" % agent["uuid"])
+        # Agent of the Kubernetes probe of each cluster, with a single query
+        pipeline = [{"$match": {"type": "Probe.k8s", "cluster_uuid": {"$in": list(cluster_uuids)}}},
+                    {"$lookup": {"from": "entities", "localField": "uuid", "foreignField": "probes", "as": "agent"}},
+                    {"$unwind": "$agent"},
+                    {"$match": {"agent.type": "Agent"}},
+                    {"$project": {"_id": 0, "cluster_uuid": 1, "uuid": "$agent.uuid", "url": "$agent.url"}}]
+
+        return {d["cluster_uuid"]: d for d in self.__entitiesCollection.aggregate(pipeline)}
+
+    def __notify_agent(self, action, agent, deployment_uuid, payload):
+
+        if action == "set":
+            res = requests.post(f"{agent['url']}/api/v1/telemetry/agent/deployments", json=payload,
+                                timeout=self.__query_timeout)
+            if res.status_code != 201:
+                raise ValueError("Agent '%s' replied with status %s" % (agent["uuid"], res.status_code))
+        else:
+            res = requests.delete(f"{agent['url']}/api/v1/telemetry/agent/deployments/{deployment_uuid}",
+                                  timeout=self.__query_timeout)
+            if res.status_code != 200 and res.status_code != 201:
+                raise ValueError("Agent '%s' replied with status %s" % (agent["uuid"], res.status_code))
 
+    def __notify_agents(self, action, deployment_uuid, payloads):
+
+        # The agents are notified concurrently within the query timeout, failed notifications are kept in the
+        # deployment outbox and retried by the data collector
+        agents = self.__resolve_deployment_agents(payloads.keys())
+
+        outcomes = {}
+        pending = {}
+
+        for cluster_uuid, payload in payloads.items():
+            if cluster_uuid not in agents:
+                outcomes[cluster_uuid] = self.__queue_deployment_notification(action, deployment_uuid, cluster_uuid,
+                                                                              payload, "No registered agent")
+                continue
+            future = self.__executor.submit(self.__notify_agent, action, agents[cluster_uuid], deployment_uuid,
+                                            payload)
+            pending[future] = cluster_uuid
+
+        done, not_done = futures.wait(pending.keys(), timeout=self.__query_timeout + 1)
+
+        for future in done:
+            cluster_uuid = pending[future]
             try:
-                res = requests.delete(f"{agent['url']}/api/v1/telemetry/agent/deployments/{deployment_uuid}")
-                if res.status_code != 200 or res.status_code != 201:
-                    logger.error(
-                        "Unable to forward termination request for application monitoring to Agent '%s'" % agent[
-                            "uuid"])
-            except Exception as e:
-                print(str(e))
-                logger.error(str(e))
+                future.result()
+            except Exception as err:
+                error = "%s - %s" % (err.__class__.__name__, str(err))
+                logger.error("Unable to notify Agent '%s' for deployment '%s'" % (agents[cluster_uuid]["uuid"],
+                                                                                   deployment_uuid))
+                logger.error(error)
+                outcomes[cluster_uuid] = self.__queue_deployment_notification(action, deployment_uuid, cluster_uuid,
+                                                                              payloads[cluster_uuid], error)
+                continue
+            # A notification that went through supersedes the queued ones
+            self.__deploymentOutboxCollection.delete_one({"deployment_uuid": deployment_uuid,
+                                                          "cluster_uuid": cluster_uuid})
+            outcomes[cluster_uuid] = {"status": "ok", "agent_uuid": agents[cluster_uuid]["uuid"]}
+
+        for future in not_done:
+            cluster_uuid = pending[future]
+            outcomes[cluster_uuid] = self.__queue_deployment_notification(action, deployment_uuid, cluster_uuid,
+                                                                          payloads[cluster_uuid], "Timeout")
+
+        return outcomes
+
+    def __queue_deployment_notification(self, action, deployment_uuid, cluster_uuid, payload, error):
+
+        now = int(time.time())
+
+        # The latest notification of a deployment per cluster is kept, e.g. a deletion replaces a queued registration
+        self.__deploymentOutboxCollection.replace_one({"deployment_uuid": deployment_uuid,
+                                                       "cluster_uuid": cluster_uuid},
+                                                      {"deployment_uuid": deployment_uuid,
+                                                       "cluster_uuid": cluster_uuid,
+                                                       "action": action,
+                                                       "payload": payload,
+                                                       "attempts": 0,
+                                                       "next_attempt": now + self.__deployment_outbox["retry_interval"],
+                                                       "last_error": error,
+                                                       "revision": str(uuid.uuid4()),
+                                                       "timestamp": now}, upsert=True)
+
+        return {"status": "queued", "error": error}
+
+    def retry_deployment_outbox(self):
+
+        now = int(time.time())
 
-        self.__deploymentsCollection.delete_one({"deployment_uuid": deployment_uuid})
+        try:
+            notifications = list(self.__deploymentOutboxCollection.find(
+                {"next_attempt": {"$lte": now}, "attempts": {"$lt": self.__deployment_outbox["max_attempts"]}}
+            ).sort("next_attempt", 1).limit(self.__deployment_outbox["batch_size"]))
+
+            if not notifications:
+                return
+
+            logger.info("Retry %s deployment notifications" % len(notifications))
+
+            agents = self.__resolve_deployment_agents(set([n["cluster_uuid"] for n in notifications]))
+
+            pending = {}
+            for n in notifications:
+                if n["cluster_uuid"] in agents:
+                    pending[self.__executor.submit(self.__notify_agent, n["action"], agents[n["cluster_uuid"]],
+                                                   n["deployment_uuid"], n["payload"])] = n
+                else:
+                    self.__deployment_notification_failed(n, "No registered agent")
+
+            done, not_done = futures.wait(pending.keys(), timeout=self.__query_timeout + 1)
+
+            for future in done:
+                try:
+                    future.result()
+                except Exception as err:
+                    self.__deployment_notification_failed(pending[future], "%s - %s" % (err.__class__.__name__,
+                                                                                        str(err)))
+                    continue
+                # Unless the notification has been replaced in the meantime
+                self.__deploymentOutboxCollection.delete_one({"_id": pending[future]["_id"],
+                                                              "revision": pending[future]["revision"]})
+
+            for future in not_done:
+                self.__deployment_notification_failed(pending[future], "Timeout")
+
+        except Exception as err:
+            logger.error("Unable to retry deployment notifications")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def __deployment_notification_failed(self, notification, error):
+
+        attempts = notification["attempts"] + 1
+        delay = min(self.__deployment_outbox["retry_interval"] * 2 ** attempts, 3600)
+
+        if attempts >= self.__deployment_outbox["max_attempts"]:
+            logger.error("Give up notification '%s' of deployment '%s' for cluster '%s'" % (
+                notification["action"], notification["deployment_uuid"], notification["cluster_uuid"]))
+
+        self.__deploymentOutboxCollection.update_one({"_id": notification["_id"],
+                                                      "revision": notification["revision"]},
+                                                     {"$set": {"attempts": attempts,
+                                                               "next_attempt": int(time.time()) + delay,
+                                                               "last_error": error}})
+
+    def update_platform_rollup(self):
+
+        # Only the cluster states and edge storage devices updated since the previous rollup are read again, with a
+        # margin for the write cycles of the agents that were in progress
+        now = int(time.time())
+        since = self.__rollup_watermark - ROLLUP_WATERMARK_MARGIN
+
+        try:
+            capacities = {d["cluster_uuid"]: d for d in self.get_capacity()[0]}
+
+            changed = set()
+
+            for latest in self.__clusterLatestCollection.find({"timestamp": {"$gte": since}},
+                                                              {"_id": 0, "cluster_uuid": 1, "timestamp": 1,
+                                                               "state": 1}):
+                rollup = platformRollup.state_rollup(latest["state"], capacities.get(latest["cluster_uuid"], None))
+                rollup["timestamp"] = latest["timestamp"]
+                self.__state_rollups[latest["cluster_uuid"]] = rollup
+                changed.add(latest["cluster_uuid"])
+
+            edge_clusters = self.__edgeStorageLatestCollection.distinct("cluster_uuid", {"timestamp": {"$gte": since}})
+            if edge_clusters:
+                devices = {}
+                for device in self.__edgeStorageLatestCollection.find({"cluster_uuid": {"$in": edge_clusters}},
+                                                                      {"_id": 0, "cluster_uuid": 1,
+                                                                       "minio_node_disk_total_bytes": 1,
+                                                                       "minio_node_disk_used_bytes": 1,
+                                                                       "minio_node_disk_free_bytes": 1}):
+                    devices.setdefault(device["cluster_uuid"], []).append(device)
+                for cluster_uuid, cluster_devices in devices.items():
+                    self.__edge_storage_rollups[cluster_uuid] = platformRollup.edge_storage_rollup(cluster_devices)
+                    changed.add(cluster_uuid)
+
+            # Deregistered clusters and devices
+            for rollups, collection in [(self.__state_rollups, self.__clusterLatestCollection),
+                                        (self.__edge_storage_rollups, self.__edgeStorageLatestCollection)]:
+                for cluster_uuid in set(rollups.keys()) - set(collection.distinct("cluster_uuid")):
+                    del rollups[cluster_uuid]
+
+            rollups = {}
+            for cluster_uuid in set(self.__state_rollups.keys()) | set(self.__edge_storage_rollups.keys()):
+                rollup = dict(self.__state_rollups.get(cluster_uuid, {"type": "edge"}), cluster_uuid=cluster_uuid)
+                if cluster_uuid in self.__edge_storage_rollups:
+                    rollup["edge_storage"] = self.__edge_storage_rollups[cluster_uuid]
+                rollups[cluster_uuid] = rollup
+
+            rollups["serrano"] = platformRollup.platform_rollup([r for r in rollups.values()])
+            rollups["serrano"]["timestamp"] = now
+
+            documents = [dict(rollups[k], scope=k) for k in sorted(changed) if k in rollups]
+            documents.append(dict(rollups["serrano"], scope="serrano"))
+            for document in documents:
+                document["created_at"] = datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc)
+            self.__infrastructureMetricsCollection.insert_many(documents)
+
+            with self.__rollup_lock:
+                self.__rollups = rollups
+
+            self.__rollup_watermark = now
+
+            logger.info("Platform rollup updated - %s of %s clusters changed" % (len(changed), len(rollups) - 1))
+
+        except Exception as err:
+            logger.error("Unable to update the platform rollup")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
 
     def get_infrastructure_monitor(self, uuid):
-        return {}
+
+        with self.__rollup_lock:
+            data = self.__rollups.get(uuid, None)
+
+        if data is not None:
+            return data
+
+        # Before the first rollup of this instance
+        data = self.__infrastructureMetricsCollection.find_one({"scope": uuid}, {"_id": 0, "created_at": 0},
+                                                               sort=[("timestamp", -1)])
+        return data or {}
+
+    def get_platform_monitor(self):
+        with self.__rollup_lock:
+            return {"serrano": self.__rollups.get("serrano", {}),
+                    "clusters": [v for k, v in self.__rollups.items() if k != "serrano"]}
 
     def get_clusters(self):
         return list(self.__clusterCollection.find({}, {"_id": 0, "uuid": 1, "type": 1, "name": 1}))
@@ -200,13 +489,205 @@ class DataEngine:
 
     def get_cluster_metrics(self, cluster_uuid, args):
 
+        # The cluster states are stored as keyframes followed by change-only documents, rebuilt on read
         if "target" in args and args["target"] == "all":
-            return list(
-                self.__clusterMetricsCollection.find({"cluster_uuid": cluster_uuid}, {"_id": 0}).sort("timestamp", -1))
-        else:
-            return list(
-                self.__clusterMetricsCollection.find({"cluster_uuid": cluster_uuid}, {"_id": 0}).sort("timestamp",
-                                                                                                      -1).limit(1))
+            return self.get_cluster_metrics_all(cluster_uuid, args)
+
+        # Current state maintained by the agents, without the BSON date of the TTL index as in the previous responses
+        latest = self.__clusterLatestCollection.find_one({"cluster_uuid": cluster_uuid}, {"_id": 0, "created_at": 0})
+        if latest is not None:
+            return [latest]
+
+        # Clusters of agents that do not maintain the current state
+        latest = self.__clusterMetricsCollection.find_one({"cluster_uuid": cluster_uuid}, {"_id": 0, "created_at": 0},
+                                                          sort=[("timestamp", -1)])
+        if latest is None:
+            return []
+
+        if latest.get("kind", stateDelta.KEYFRAME) == stateDelta.KEYFRAME:
+            return list(stateDelta.rebuild([latest]))
+
+        documents = self.__clusterMetricsCollection.find({"cluster_uuid": cluster_uuid,
+                                                          "timestamp": {"$gte": latest["keyframe"],
+                                                                        "$lte": latest["timestamp"]},
+                                                          "$or": [{"kind": stateDelta.KEYFRAME,
+                                                                   "timestamp": latest["keyframe"]},
+                                                                  {"keyframe": latest["keyframe"]}]},
+                                                         {"_id": 0, "created_at": 0}).sort([("timestamp", 1),
+                                                                                           ("_id", 1)])
+
+        # Latest state that can be rebuilt, in case a delta of the chain is missing
+        return list(stateDelta.rebuild(documents))[-1:]
+
+    def __cluster_states(self, cluster_uuid, start=None, stop=None, sections=None):
+
+        # Rebuilt cluster states within [start, stop] in ascending (timestamp, _id) order, as the cursor yields the
+        # documents. The _id of each state is kept for the keyset pagination.
+        begin = start
+        if start is not None:
+            first = self.__clusterMetricsCollection.find_one({"cluster_uuid": cluster_uuid,
+                                                              "timestamp": {"$gte": start}},
+                                                             {"_id": 0, "kind": 1, "keyframe": 1},
+                                                             sort=[("timestamp", 1), ("_id", 1)])
+            # The states of a range that starts with a delta are rebuilt from its keyframe
+            if first is not None and first.get("kind", stateDelta.KEYFRAME) == stateDelta.DELTA:
+                begin = min(start, first["keyframe"])
+
+        time_filter = {}
+        if begin is not None:
+            time_filter["$gte"] = begin
+        if stop is not None:
+            time_filter["$lte"] = stop
+
+        query_filter = {"cluster_uuid": cluster_uuid}
+        if time_filter:
+            query_filter["timestamp"] = time_filter
+
+        documents = self.__clusterMetricsCollection.find(query_filter, {"created_at": 0}).sort([("timestamp", 1),
+                                                                                               ("_id", 1)])
+
+        for data in stateDelta.rebuild(documents):
+            if start is not None and data["timestamp"] < start:
+                continue
+            if sections:
+                data["state"] = {k: v for k, v in data["state"].items() if k in sections}
+            yield data
+
+    @staticmethod
+    def __cluster_states_args(args):
+
+        start = int(args["start"]) if args.get("start", None) else None
+        stop = int(args["stop"]) if args.get("stop", None) else None
+        sections = [k.strip() for k in args["sections"].split(",") if k.strip()] if args.get("sections", None) \
+            else None
+
+        return start, stop, sections
+
+    @staticmethod
+    def __encode_cursor(state):
+        return "%s_%s" % (state["timestamp"], state["_id"])
+
+    @staticmethod
+    def __decode_cursor(cursor):
+        try:
+            timestamp, object_id = cursor.split("_", 1)
+            return int(timestamp), ObjectId(object_id)
+        except Exception:
+            raise ValueError("Invalid cursor '%s'" % cursor)
+
+    @staticmethod
+    def __without_id(states):
+        for state in states:
+            state.pop("_id", None)
+        return states
+
+    def get_cluster_metrics_page(self, cluster_uuid, args):
+
+        # Keyset pagination on (timestamp, _id), so that the states of the same second are not skipped: the next
+        # page starts after the "next_cursor" of the previous one
+        start, stop, sections = self.__cluster_states_args(args)
+        limit = int(args.get("limit", None) or self.__metrics_page_size)
+        order = args.get("order", None) or "desc"
+        cursor = self.__decode_cursor(args["cursor"]) if args.get("cursor", None) else None
+
+        if limit <= 0 or order not in ["asc", "desc"]:
+            raise ValueError("Invalid limit or order")
+
+        if order == "asc":
+            if cursor is not None:
+                start = max(start, cursor[0]) if start is not None else cursor[0]
+            data = []
+            for state in self.__cluster_states(cluster_uuid, start, stop, sections):
+                if cursor is not None and (state["timestamp"], state["_id"]) <= cursor:
+                    continue
+                if len(data) == limit:
+                    next_cursor = self.__encode_cursor(data[-1])
+                    return {"metrics": self.__without_id(data), "next_cursor": next_cursor}
+                data.append(state)
+            return {"metrics": self.__without_id(data), "next_cursor": None}
+
+        # Newest first: the keys of the page are resolved through the index, then the time range is rebuilt
+        query_filter = {"cluster_uuid": cluster_uuid}
+        time_filter = {}
+        if stop is not None:
+            time_filter["$lte"] = stop
+        if start is not None:
+            time_filter["$gte"] = start
+        if cursor is not None:
+            time_filter["$lte"] = min(stop, cursor[0]) if stop is not None else cursor[0]
+            query_filter["$or"] = [{"timestamp": {"$lt": cursor[0]}},
+                                   {"timestamp": cursor[0], "_id": {"$lt": cursor[1]}}]
+        if time_filter:
+            query_filter["timestamp"] = time_filter
+
+        keys = list(self.__clusterMetricsCollection.find(query_filter, {"_id": 1, "timestamp": 1})
+                    .sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+
+        if not keys:
+            return {"metrics": [], "next_cursor": None}
+
+        page = keys[:limit]
+        ids = set([k["_id"] for k in page])
+        data = [state for state in self.__cluster_states(cluster_uuid, page[-1]["timestamp"], page[0]["timestamp"],
+                                                         sections) if state["_id"] in ids]
+
+        return {"metrics": self.__without_id(list(reversed(data))),
+                "next_cursor": self.__encode_cursor(page[-1]) if len(keys) > limit else None}
+
+    def get_cluster_metrics_all(self, cluster_uuid, args):
+
+        # All the states of the range, newest first, the default response without pagination
+        start, stop, sections = self.__cluster_states_args(args)
+        return self.__without_id(list(reversed(list(self.__cluster_states(cluster_uuid, start, stop, sections)))))
+
+    def stream_cluster_metrics(self, cluster_uuid, args):
+
+        # All the cluster states of the range in ascending order, as NDJSON lines. The arguments are checked before
+        # the first line is produced.
+        start, stop, sections = self.__cluster_states_args(args)
+
+        def generate():
+            for state in self.__cluster_states(cluster_uuid, start, stop, sections):
+                state.pop("_id", None)
+                yield json.dumps(state, default=str) + "\n"
+
+        return generate()
+
+    def get_cluster_entity_metrics(self, cluster_uuid, entity_type, entity_name, args):
+
+        query_filter = {"cluster_uuid": cluster_uuid, "entity_type": entity_type}
+        projection = {"_id": 0, "created_at": 0}
+
+        if entity_name:
+            query_filter["entity_name"] = entity_name
+
+        time_filter = {}
+        if args.get("start", None):
+            time_filter["$gte"] = int(args["start"])
+        if args.get("stop", None):
+            time_filter["$lte"] = int(args["stop"])
+        if time_filter:
+            query_filter["timestamp"] = time_filter
+
+        if args.get("target", None) == "all":
+            cursor = self.__clusterEntityMetricsCollection.find(query_filter, projection).sort("timestamp", -1)
+            if args.get("limit", None):
+                cursor = cursor.limit(int(args["limit"]))
+            return list(cursor)
+
+        if entity_name:
+            return list(self.__clusterEntityMetricsCollection.find(query_filter, projection).sort("timestamp",
+                                                                                                 -1).limit(1))
+
+        # Latest document of each entity, following the (cluster_uuid, entity_type, entity_name, timestamp) index
+        pipeline = [{"$match": query_filter},
+                    {"$sort": {"cluster_uuid": 1, "entity_type": 1, "entity_name": 1, "timestamp": -1}},
+                    {"$group": {"_id": "$entity_name", "latest": {"$first": "$$ROOT"}}},
+                    {"$replaceRoot": {"newRoot": "$latest"}},
+                    {"$project": projection},
+                    {"$sort": {"entity_name": 1}}]
+
+        return list(self.__clusterEntityMetricsCollection.aggregate(pipeline))
 
     def get_storage_locations(self, args):
         data = {}
@@ -228,17 +709,19 @@ class DataEngine:
         if not target or target == "edge":
             pipeline = [{"$project": {"_id": 0, "timestamp": 0}},
                         {"$lookup": {
-                            "from": "edge_storage_metrics",
+                            "from": "edge_storage_latest",
                             "localField": "name",
                             "foreignField": "name",
                             "as": "metrics",
+                            "let": {"cluster_uuid": "$cluster_uuid"},
                             "pipeline": [
+                                {"$match": {"$expr": {"$eq": ["$cluster_uuid", "$$cluster_uuid"]}}},
+                                {"$sort": {"timestamp": -1}},
+                                {"$limit": 1},
                                 {"$project": {"_id": 0,
                                               "minio_node_disk_total_bytes": 1,
                                               "minio_node_disk_used_bytes": 1,
-                                              "minio_node_disk_free_bytes": 1}},
-                                {"$limit": 1},
-                                {"$sort": {"timestamp": -1}}
+                                              "minio_node_disk_free_bytes": 1}}
                             ]
                         }}]
 
@@ -266,14 +749,13 @@ class DataEngine:
         return data
 
     def update_serrano_kernel_deployments(self, data):
+        query_filter = {"deployment_mode": data["deployment_mode"], "cluster_uuid": data["cluster_uuid"]}
+
+        # Counters are never decreased below zero
         if data["counter_diff"] < 0:
-            r = self.__kernelDeploymentsCollection.find_one({"cluster_uuid": data["cluster_uuid"],
-                                                             "deployment_mode": data["deployment_mode"]})
-            if r and r.get(data["kernel_mode"], 0) == 0:
-                return
+            query_filter[data["kernel_mode"]] = {"$gt": 0}
 
-        self.__kernelDeploymentsCollection.update_one({"deployment_mode": data["deployment_mode"],
-                                                       "cluster_uuid": data["cluster_uuid"]},
+        self.__kernelDeploymentsCollection.update_one(query_filter,
                                                       {"$inc": {data["kernel_mode"]: data["counter_diff"]}})
 
     def add_serrano_kernel_metrics(self, data):
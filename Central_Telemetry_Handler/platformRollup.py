@@ -0,0 +1,83 @@
+# Utilization aggregates of the clusters and of the SERRANO platform, from the latest cluster states and the latest
+# edge storage device metrics
+
+
+def number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def usage(total, used):
+    return {"total": total, "used": used, "usage_percentage": float("%.2f" % (used / total * 100)) if total else 0.0}
+
+
+def k8s_state_rollup(state, capacity):
+
+    nodes = state.get("Nodes", [])
+    pods = state.get("Pods", [])
+
+    cpu_used = sum([number((p.get("usage", None) or {}).get("cpu_cores", 0)) for p in pods])
+
+    return {"type": "k8s",
+            "nodes": len(nodes),
+            "running_pods": sum([number(n.get("node_total_running_pods", 0)) for n in nodes]),
+            "cpu": usage(number((capacity or {}).get("totals", {}).get("cpu", 0)), cpu_used),
+            "memory": usage(sum([number(n.get("node_memory_MemTotal_bytes", 0)) for n in nodes]),
+                            sum([number(n.get("node_memory_MemUsed_bytes", 0)) for n in nodes])),
+            "storage": usage(sum([number(n.get("node_filesystem_size_bytes", 0)) for n in nodes]),
+                             sum([number(n.get("node_filesystem_used_bytes", 0)) for n in nodes]))}
+
+
+def hpc_state_rollup(state):
+
+    partitions = state.get("partitions", [])
+
+    data = {"type": "HPC", "partitions": len(partitions)}
+    for k in ["avail_cpus", "avail_nodes", "queued_jobs", "running_jobs"]:
+        data[k] = sum([number(p.get(k, 0)) for p in partitions])
+
+    return data
+
+
+def state_rollup(state, capacity):
+    if "partitions" in state:
+        return hpc_state_rollup(state)
+    return k8s_state_rollup(state, capacity)
+
+
+def edge_storage_rollup(devices):
+
+    data = usage(sum([number(d.get("minio_node_disk_total_bytes", 0)) for d in devices]),
+                 sum([number(d.get("minio_node_disk_used_bytes", 0)) for d in devices]))
+    data["free"] = sum([number(d.get("minio_node_disk_free_bytes", 0)) for d in devices])
+    data["devices"] = len(devices)
+
+    return data
+
+
+def platform_rollup(cluster_rollups):
+
+    data = {"clusters": {}}
+    totals = {"cpu": [0, 0], "memory": [0, 0], "storage": [0, 0], "edge_storage": [0, 0]}
+    hpc = {"partitions": 0, "avail_cpus": 0, "avail_nodes": 0, "queued_jobs": 0, "running_jobs": 0}
+    edge = {"devices": 0, "free": 0}
+
+    for rollup in cluster_rollups:
+        data["clusters"][rollup["type"]] = data["clusters"].get(rollup["type"], 0) + 1
+        for k in totals:
+            if k in rollup:
+                totals[k][0] += rollup[k]["total"]
+                totals[k][1] += rollup[k]["used"]
+        if rollup["type"] == "HPC":
+            for k in hpc:
+                hpc[k] += rollup[k]
+        if "edge_storage" in rollup:
+            for k in edge:
+                edge[k] += rollup["edge_storage"][k]
+
+    for k, (total, used) in totals.items():
+        data[k] = usage(total, used)
+
+    data["edge_storage"].update(edge)
+    data["hpc"] = hpc
+
+    return data
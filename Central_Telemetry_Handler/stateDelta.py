@@ -0,0 +1,166 @@
+import copy
+import logging
+
+# The same module is shipped with the Enhanced Telemetry Agent and the Central Telemetry Handler, keep them in sync
+# (python checkSharedModules.py).
+logger = logging.getLogger("SERRANO.OperationalDB.StateDelta")
+
+# Kind of the cluster_state_metrics documents, documents without "kind" are (legacy) keyframes
+KEYFRAME = "keyframe"
+DELTA = "delta"
+
+# Fields of the delta documents that are not part of the rebuilt cluster state documents
+DELTA_FIELDS = ["kind", "keyframe", "sequence", "changes"]
+
+
+def item_key(item):
+    # Identity of the items of the monitoring data sections (e.g. Nodes, Pods, PersistentVolumes, Deployments)
+    if not isinstance(item, dict):
+        return None
+    if "node_name" in item:
+        return str(item["node_name"])
+    if "name" in item:
+        return "%s/%s" % (item["namespace"], item["name"]) if "namespace" in item else str(item["name"])
+    return None
+
+
+def to_keyed(state):
+
+    # Sections that are lists of identifiable items are diffed item by item, the order is kept separately
+    keyed = {}
+    orders = {}
+
+    for section, value in state.items():
+        if isinstance(value, list) and value:
+            keys = [item_key(item) for item in value]
+            if None not in keys and len(set(keys)) == len(keys):
+                keyed[section] = dict(zip(keys, value))
+                orders[section] = keys
+                continue
+        keyed[section] = value
+
+    return keyed, orders
+
+
+def from_keyed(keyed, orders):
+
+    state = {}
+
+    for section, value in keyed.items():
+        if section in orders:
+            state[section] = [value[k] for k in orders[section] if k in value]
+        else:
+            state[section] = value
+
+    return state
+
+
+def diff(old, new, path=None, changes=None):
+
+    path = path or []
+    changes = changes if changes is not None else {"set": [], "unset": []}
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k, v in new.items():
+            if k not in old:
+                changes["set"].append([path + [k], v])
+            elif old[k] != v:
+                diff(old[k], v, path + [k], changes)
+        for k in old:
+            if k not in new:
+                changes["unset"].append(path + [k])
+    elif old != new:
+        changes["set"].append([path, new])
+
+    return changes
+
+
+def apply(keyed, changes):
+
+    for path, value in changes.get("set", []):
+        target = keyed
+        for k in path[:-1]:
+            if not isinstance(target.get(k, None), dict):
+                target[k] = {}
+            target = target[k]
+        target[path[-1]] = copy.deepcopy(value)
+
+    for path in changes.get("unset", []):
+        target = keyed
+        for k in path[:-1]:
+            target = target.get(k, None)
+            if not isinstance(target, dict):
+                break
+        else:
+            target.pop(path[-1], None)
+
+    return keyed
+
+
+class StateEncoder:
+
+    def __init__(self, keyframe_interval):
+
+        # Every N-th document of each cluster is a keyframe, 1 disables the delta encoding
+        self.__keyframe_interval = max(int(keyframe_interval), 1)
+        self.__previous = {}
+
+    def encode(self, cluster_uuid, state, timestamp):
+
+        keyed, orders = to_keyed(copy.deepcopy(state))
+        previous = self.__previous.get(cluster_uuid, None)
+
+        if previous is None or previous["sequence"] + 1 >= self.__keyframe_interval:
+            self.__previous[cluster_uuid] = {"keyed": keyed, "orders": orders, "sequence": 0, "keyframe": timestamp}
+            return {"cluster_uuid": cluster_uuid, "kind": KEYFRAME, "state": state}
+
+        changes = diff(previous["keyed"], keyed)
+        if orders != previous["orders"]:
+            changes["orders"] = orders
+
+        previous.update({"keyed": keyed, "orders": orders, "sequence": previous["sequence"] + 1})
+
+        return {"cluster_uuid": cluster_uuid, "kind": DELTA, "keyframe": previous["keyframe"],
+                "sequence": previous["sequence"], "changes": changes}
+
+    def reset(self, cluster_uuid=None):
+        if cluster_uuid is None:
+            self.__previous = {}
+        else:
+            self.__previous.pop(cluster_uuid, None)
+
+
+def rebuild(documents):
+
+    # Rebuild the full state documents from a sequence of keyframe and delta documents, sorted by timestamp
+    keyed = None
+    orders = None
+    keyframe = None
+    sequence = 0
+
+    for document in documents:
+
+        kind = document.get("kind", KEYFRAME)
+
+        if kind == KEYFRAME:
+            keyed, orders = to_keyed(copy.deepcopy(document["state"]))
+            keyframe = document.get("timestamp", None)
+            sequence = 0
+            state = document["state"]
+        else:
+            if keyed is None or document.get("keyframe", None) != keyframe or \
+                    document.get("sequence", None) != sequence + 1:
+                # The keyframe or a previous delta is missing (e.g. expired), the state can not be rebuilt
+                logger.debug("Skip delta of cluster '%s' at %s" % (document.get("cluster_uuid", ""),
+                                                                   document.get("timestamp", "")))
+                keyed = None
+                continue
+            apply(keyed, document["changes"])
+            orders = document["changes"].get("orders", orders)
+            sequence = document["sequence"]
+            state = from_keyed(copy.deepcopy(keyed), orders)
+
+        data = {k: v for k, v in document.items() if k not in DELTA_FIELDS}
+        data["state"] = state
+
+        yield data
@@ -3,6 +3,8 @@ import logging
 import requests
 import pymongo
 
+import openMetricsExporter
+
 from flask import Flask
 from flask import request
 from flask import jsonify
@@ -21,17 +23,22 @@ class AccessInterface(QThread):
 
     restInterfaceMessage = pyqtSignal(object)
 
-    def __init__(self, config):
+    def __init__(self, config, probe_data_cache, specific_metrics_schema):
 
         QThread.__init__(self)
 
         self.__config = config
+        self.__probe_data_cache = probe_data_cache
 
         self.address = config.get_rest_interface()["address"]
         self.port = config.get_rest_interface()["port"]
 
         self.__registered_entities = {}
         self.__cache_k8s_inventory = {}
+        self.__notification_engine = None
+        self.__specific_metrics_schema = specific_metrics_schema
+        self.__open_metrics_exporter = openMetricsExporter.OpenMetricsExporter(probe_data_cache)
+        self.__specific_metrics_batch_size = config.get_specific_metrics_batch_size()
 
         self.rest_app = Flask(__name__)
 
@@ -98,59 +105,12 @@ class AccessInterface(QThread):
         @self.rest_app.route("/api/v1/telemetry/agent/monitor/<uuid:entity_uuid>", methods=["GET"])
         @auth.login_required
         def monitor_entity(entity_uuid):
-            data = {}
-            if str(entity_uuid) not in self.__registered_entities:
-                return make_response(jsonify({}), 404)
-
-            q_url = "%s/api/v1/telemetry/probe/monitor" % (self.__registered_entities[str(entity_uuid)]["url"])
-            target = request.args.to_dict().get("target", None)
-            if target:
-                q_url += "?target=%s" % target
-
-            try:
-                res = requests.get(q_url, verify=True)
-                if res.status_code == 200 or res.status_code == 201:
-                    monitor_data = json.loads(res.text)
-
-                    evt_msg = {x: self.__registered_entities[str(entity_uuid)][x] for x in ["uuid", "type", "cluster_uuid"]}
-
-                    evt_msg["action"] = "monitor"
-                    evt_msg["monitoring_data"] = monitor_data
-
-                    self.restInterfaceMessage.emit(evt_msg)
-                    return make_response(jsonify(monitor_data), 200)
-                else:
-                    return make_response(jsonify({}), res.status_code)
-            except Exception as err:
-                logger.error("Unable to request monitoring data from entity '%s'" % entity_uuid)
-                logger.error(str(err))
-                return make_response(jsonify(data), 500)
+            return self.__probe_data_response(str(entity_uuid), "monitor", request.args.to_dict())
 
         @self.rest_app.route("/api/v1/telemetry/agent/inventory/<uuid:entity_uuid>", methods=["GET"])
         @auth.login_required
         def inventory_entity(entity_uuid):
-            data = {}
-            if str(entity_uuid) not in self.__registered_entities:
-                return make_response(jsonify({}), 404)
-            try:
-                res = requests.get(
-                    "%s/api/v1/telemetry/probe/inventory" % (self.__registered_entities[str(entity_uuid)]["url"]), verify=True)
-
-                if res.status_code == 200 or res.status_code == 201:
-                    inventory_data = json.loads(res.text)
-
-                    evt_msg = {x: self.__registered_entities[str(entity_uuid)][x] for x in ["uuid", "type", "cluster_uuid"]}
-                    evt_msg["action"] = "inventory"
-                    evt_msg["inventory_data"] = inventory_data
-
-                    self.restInterfaceMessage.emit(evt_msg)
-                    return make_response(jsonify(inventory_data), 200)
-                else:
-                    return make_response(jsonify({}), res.status_code)
-            except Exception as err:
-                logger.error("Unable to request inventory data from entity '%s'" % entity_uuid)
-                logger.error(str(err))
-                return make_response(jsonify(data), 500)
+            return self.__probe_data_response(str(entity_uuid), "inventory", request.args.to_dict())
 
         @self.rest_app.route("/api/v1/telemetry/agent/deployments", methods=["POST"])
         @auth.login_required
@@ -165,6 +125,7 @@ class AccessInterface(QThread):
         @self.rest_app.route("/api/v1/telemetry/agent/deployments/<uuid:deployment_uuid>", methods=["DELETE"])
         @auth.login_required
         def delete_serrano_deployment(deployment_uuid):
+            self.__specific_metrics_schema.forget(str(deployment_uuid))
             self.restInterfaceMessage.emit({"action": "deployment",
                                             "request_method": "delete",
                                             "deployment_uuid": str(deployment_uuid)})
@@ -198,11 +159,73 @@ class AccessInterface(QThread):
         @self.rest_app.route("/api/v1/telemetry/agent/deployment_specific_metrics", methods=["POST"])
         @auth.login_required
         def deployment_specific_metrics():
+            # Same validation as the bulk requests, so that a metric keeps its type whichever way it is pushed
+            metrics_data, error = self.__specific_metrics_schema.validate(request.get_json(silent=True))
+            if error:
+                return make_response(jsonify({"error": error}), 400)
             self.restInterfaceMessage.emit({"action": "deployment_specific_metrics",
                                             "request_method": "post",
-                                            "metrics_data": request.get_json()})
+                                            "metrics_data": metrics_data})
             return make_response(jsonify({}), 201)
 
+        @self.rest_app.route("/api/v1/telemetry/agent/deployment_specific_metrics/bulk", methods=["POST"])
+        @auth.login_required
+        def deployment_specific_metrics_bulk():
+
+            # JSON array (or object) body, or NDJSON stream that is read and forwarded batch by batch
+            if request.mimetype in ["application/x-ndjson", "application/jsonl"]:
+                records = self.__ndjson_records(request.stream)
+            else:
+                body = request.get_json(silent=True)
+                if body is None:
+                    return make_response(jsonify({"error": "Invalid JSON body"}), 400)
+                records = body if isinstance(body, list) else [body]
+
+            data = {"accepted": 0, "rejected": 0, "batches": []}
+            batch = []
+            batch_report = {"batch": 0, "accepted": 0, "rejected": 0, "errors": []}
+
+            for index, record in enumerate(records):
+
+                if isinstance(record, Exception):
+                    metrics_data, error = None, "Invalid JSON line"
+                else:
+                    metrics_data, error = self.__specific_metrics_schema.validate(record)
+
+                if error:
+                    batch_report["rejected"] += 1
+                    if len(batch_report["errors"]) < 10:
+                        batch_report["errors"].append({"record": index, "error": error})
+                else:
+                    batch_report["accepted"] += 1
+                    batch.append(metrics_data)
+
+                if batch_report["accepted"] + batch_report["rejected"] == self.__specific_metrics_batch_size:
+                    self.__forward_specific_metrics(batch, batch_report, data)
+                    batch = []
+                    batch_report = {"batch": len(data["batches"]), "accepted": 0, "rejected": 0, "errors": []}
+
+            if batch_report["accepted"] + batch_report["rejected"] > 0:
+                self.__forward_specific_metrics(batch, batch_report, data)
+
+            # Nothing is written when every record is rejected
+            return make_response(jsonify(data), 400 if data["rejected"] and not data["accepted"] else 202)
+
+        @self.rest_app.route("/api/v1/telemetry/agent/notifications", methods=["GET"])
+        @auth.login_required
+        def notifications_stats():
+            if self.__notification_engine is None:
+                return make_response(jsonify({}), 503)
+            return make_response(jsonify(self.__notification_engine.get_stats()), 200)
+
+        @self.rest_app.route("/metrics", methods=["GET"])
+        @auth.login_required
+        def open_metrics():
+            # Latest monitoring data of the probes in the OpenMetrics text format, for Prometheus scrapers
+            res = make_response(self.__open_metrics_exporter.render(), 200)
+            res.headers["Content-Type"] = openMetricsExporter.CONTENT_TYPE
+            return res
+
         @self.rest_app.route("/api/v1/telemetry/agent", methods=["GET", "PUT"])
         @auth.login_required
         def configure_entity():
@@ -216,6 +239,95 @@ class AccessInterface(QThread):
                 self.restInterfaceMessage.emit({"action": "configuration", "request_params": request.get_json()})
                 return make_response(jsonify({}), 201)
 
+    def __probe_data_response(self, entity_uuid, kind, args):
+
+        if entity_uuid not in self.__registered_entities:
+            return make_response(jsonify({}), 404)
+
+        target = args.get("target", None)
+
+        try:
+            max_age = float(args["max_age"]) if args.get("max_age", None) is not None else None
+        except ValueError:
+            return make_response(jsonify({"error": "Invalid max_age"}), 400)
+
+        # The inventory and the data of a target are not collected periodically, they are requested again once older
+        # than the collection interval
+        if max_age is None and kind == "inventory":
+            max_age = self.__config.get_inventory_interval()
+        elif max_age is None and target:
+            max_age = self.__config.get_query_interval()
+
+        # The latest payload of the periodic collection is served, unless it is older than the requested max_age
+        cached = self.__probe_data_cache.get(entity_uuid, kind, target)
+
+        if cached is None or (max_age is not None and cached[1] > max_age):
+
+            q_url = "%s/api/v1/telemetry/probe/%s" % (self.__registered_entities[entity_uuid]["url"], kind)
+            if target:
+                q_url += "?target=%s" % target
+
+            try:
+                res = requests.get(q_url, verify=True, timeout=self.__config.get_query_timeout())
+            except Exception as err:
+                logger.error("Unable to request %s data from entity '%s'" % (kind, entity_uuid))
+                logger.error(str(err))
+                return make_response(jsonify({}), 500)
+
+            if res.status_code != 200 and res.status_code != 201:
+                logger.error("Entity '%s' replied to the %s data request with HTTP %s"
+                             % (entity_uuid, kind, res.status_code))
+                return make_response(jsonify({"error": "Invalid reply of the probe"}), 502)
+
+            try:
+                data = json.loads(res.text)
+            except ValueError as err:
+                logger.error("Invalid %s data from entity '%s'" % (kind, entity_uuid))
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                return make_response(jsonify({"error": "Invalid reply of the probe"}), 502)
+
+            cluster_uuid = self.__registered_entities[entity_uuid]["cluster_uuid"]
+            self.__probe_data_cache.put(entity_uuid, kind, res.text, target, metadata={"cluster_uuid": cluster_uuid})
+            cached = (res.text, 0)
+
+            evt_msg = {"uuid": entity_uuid,
+                       "type": self.__registered_entities[entity_uuid]["type"],
+                       "cluster_uuid": cluster_uuid,
+                       "action": kind}
+            evt_msg["monitoring_data" if kind == "monitor" else "inventory_data"] = data
+            self.restInterfaceMessage.emit(evt_msg)
+
+        response = make_response(cached[0], 200)
+        response.headers["Content-Type"] = "application/json"
+        response.headers["Age"] = str(int(cached[1]))
+        return response
+
+    @staticmethod
+    def __ndjson_records(stream):
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as err:
+                yield err
+
+    def __forward_specific_metrics(self, batch, batch_report, data):
+
+        # Each batch is written with a single bulk write to the operational database and the PMDS
+        if batch:
+            self.restInterfaceMessage.emit({"action": "deployment_specific_metrics",
+                                            "request_method": "bulk",
+                                            "metrics_data": batch})
+
+        data["accepted"] += batch_report["accepted"]
+        data["rejected"] += batch_report["rejected"]
+        data["batches"].append(batch_report)
+
+    def set_notification_engine(self, notification_engine):
+        self.__notification_engine = notification_engine
+
     def set_registered_entities(self, entities):
         for entity in entities:
             self.__registered_entities[entity["uuid"]] = entity
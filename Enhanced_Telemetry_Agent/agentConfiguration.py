@@ -26,7 +26,8 @@ class AgentConfiguration:
         self.__config["query_interval"] = interval
 
     def get_query_timeout(self):
-        return 5 if "query_timeout" not in self.__config else self.__config["query_timeout"]
+        # Seconds, the default also applies when the value is left blank
+        return self.__config.get("query_timeout", None) or 5
 
     def set_query_timeout(self, timeout):
         self.__config["query_timeout"] = timeout
@@ -34,6 +35,18 @@ class AgentConfiguration:
     def get_retain_data_period(self):
         return 1800 if "retain_data_period" not in self.__config else self.__config["retain_data_period"]
 
+    def get_state_keyframe_interval(self):
+        # cluster_state_metrics documents between consecutive full states, 1 disables the delta encoding
+        return self.__config.get("state_keyframe_interval", None) or 10
+
+    def get_inventory_interval(self):
+        # Seconds between the periodic collections of the probes inventory
+        return self.__config.get("inventory_interval", None) or 300
+
+    def get_specific_metrics_batch_size(self):
+        # Records of the bulk deployment specific metrics requests that are written together
+        return self.__config.get("specific_metrics_batch_size", None) or 500
+
     def get_operational_db(self):
         data = {"address": "", "username": "", "password": "", "dbName": ""}
 
@@ -46,6 +59,15 @@ class AgentConfiguration:
         if "dbName" in self.__config["operational_db"]:
             data["dbName"] = self.__config["operational_db"]["dbName"]
 
+        data["storage_mode"] = self.__config["operational_db"].get("storage_mode", None) or "collection"
+        data["entity_metrics"] = bool(self.__config["operational_db"].get("entity_metrics", False))
+
+        data["write_concern"] = {"w": 1}
+
+        if self.__config["operational_db"].get("write_concern", None):
+            data["write_concern"] = {k: v for (k, v) in self.__config["operational_db"]["write_concern"].items()
+                                     if k in ["w", "j", "wtimeout"] and v is not None}
+
         return data
 
     def get_rest_interface(self):
@@ -79,7 +101,7 @@ class AgentConfiguration:
 
     def get_influxDB(self):
 
-        data = {"address": "", "port": "", "org": "", "Token": ""}
+        data = {"address": "", "port": "", "org": "", "Token": "", "schema_version": 2}
         
         if "address" in self.__config["influxDB"]:
             data["address"] = self.__config["influxDB"]["address"]
@@ -89,5 +111,42 @@ class AgentConfiguration:
             data["org"] = self.__config["influxDB"]["org"]
         if "token" in self.__config["influxDB"]:
             data["token"] = self.__config["influxDB"]["token"]
+        if "schema_version" in self.__config["influxDB"] and self.__config["influxDB"]["schema_version"]:
+            data["schema_version"] = int(self.__config["influxDB"]["schema_version"])
+
+        data["deployments_retention"] = {"raw": 2592000, "1m": 31536000, "1h": 315360000}
+
+        if self.__config["influxDB"].get("deployments_retention", None):
+            for tier, retention in self.__config["influxDB"]["deployments_retention"].items():
+                if str(tier) in data["deployments_retention"] and retention is not None:
+                    data["deployments_retention"][str(tier)] = int(retention)
         
         return data
+
+    def get_notification_engine(self):
+
+        data = {"bootstrap_servers": "", "topic": "serrano_telemetry_notifications", "linger_ms": 50,
+                "batch_size": 16384, "acks": 1, "retries": 3, "max_block_ms": 1000, "coalesce_window": 5,
+                "flap_window": 300, "flap_threshold": 4, "buffer_size": 10000, "overflow_file": None,
+                "overflow_max_bytes": 104857600, "reconnect_interval": 10}
+
+        notification_engine = self.__config.get("notification_engine", None) or {}
+
+        for k in data:
+            if notification_engine.get(k, None) is not None:
+                data[k] = notification_engine[k]
+
+        return data
+
+    def get_metrics_listener(self):
+
+        data = {"enabled": False, "address": "0.0.0.0", "port": 8125, "unix_socket": None, "flush_interval": 10,
+                "rate_limit": 1000}
+
+        metrics_listener = self.__config.get("metrics_listener", None) or {}
+
+        for k in data:
+            if metrics_listener.get(k, None) is not None:
+                data[k] = metrics_listener[k]
+
+        return data
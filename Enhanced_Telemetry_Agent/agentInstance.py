@@ -5,14 +5,19 @@ import signal
 import os.path
 import logging
 
+from PyQt5.QtCore import QTimer
 from PyQt5.QtCore import QObject
 from PyQt5.QtCore import QCoreApplication
 
 import pmdsInterface
+import probeDataCache
 import dataCollector
+import metricsListener
 import accessInterface
 import agentConfiguration
+import specificMetricsSchema
 import notificationEngine
+import notificationCoalescer
 import telemetryController
 
 CONF_FILE = "/etc/serrano/telemetry_agent.yaml"
@@ -29,9 +34,13 @@ class AgentInstance(QObject):
         self.config = agentConfiguration.AgentConfiguration(conf)
 
         self.pmdsInterface = None
+        self.probeDataCache = None
+        self.specificMetricsSchema = None
         self.dataCollector = None
         self.accessInterface = None
+        self.metricsListener = None
         self.notificationEngine = None
+        self.notificationCoalescer = None
         self.telemetryController = None
 
         logging.basicConfig(filename="%s.log" % (int(time.time())), level=LOG_LEVEL[self.config.get_log_level()])
@@ -41,13 +50,20 @@ class AgentInstance(QObject):
 
         self.telemetryController = telemetryController.TelemetryController()
 
-        self.accessInterface = accessInterface.AccessInterface(self.config)
+        # Latest monitoring and inventory payloads of the probes, shared by the collector and the REST interface
+        self.probeDataCache = probeDataCache.ProbeDataCache()
+
+        # Learned types of the deployment specific metrics, shared by the REST interface and the metrics listener
+        self.specificMetricsSchema = specificMetricsSchema.SpecificMetricsSchema()
+
+        self.accessInterface = accessInterface.AccessInterface(self.config, self.probeDataCache,
+                                                               self.specificMetricsSchema)
         self.accessInterface.restInterfaceMessage.connect(self.telemetryController.handle_access_request)
         self.accessInterface.start()
 
         self.pmdsInterface = pmdsInterface.PMDSInterface(self.config)
 
-        self.dataCollector = dataCollector.DataCollector(self.config)
+        self.dataCollector = dataCollector.DataCollector(self.config, self.probeDataCache)
         self.telemetryController.probesChanged.connect(self.dataCollector.on_probes_changed)
         self.telemetryController.inventoryChanged.connect(self.dataCollector.on_inventory_changed)
         self.telemetryController.monitorChanged.connect(self.dataCollector.on_monitor_changed)
@@ -57,23 +73,43 @@ class AgentInstance(QObject):
         self.dataCollector.updatePMDS.connect(self.pmdsInterface.on_update_pmds)
         self.pmdsInterface.start()
 
+        if self.config.get_metrics_listener()["enabled"]:
+            self.metricsListener = metricsListener.MetricsListener(self.config.get_metrics_listener(),
+                                                                   self.specificMetricsSchema)
+            self.metricsListener.listenerMessage.connect(self.telemetryController.handle_access_request)
+            self.metricsListener.start()
+
         entities = self.dataCollector.on_boot_load_probes()
         self.accessInterface.set_registered_entities(entities)
 
-        self.notificationEngine = notificationEngine.NotificationEngine(self.config["notification_engine"])
-        self.telemetryController.notificationEvent.connect(self.notificationEngine.on_telemetry_controller_event)
-        self.dataCollector.notificationEvent.connect(self.notificationEngine.on_telemetry_controller_event)
+        self.notificationEngine = notificationEngine.NotificationEngine(self.config.get_notification_engine())
+        self.notificationCoalescer = notificationCoalescer.NotificationCoalescer(self.config.get_notification_engine())
+        self.telemetryController.notificationEvent.connect(self.notificationCoalescer.on_event)
+        self.dataCollector.notificationEvent.connect(self.notificationCoalescer.on_event)
+        self.notificationCoalescer.notificationEvent.connect(self.notificationEngine.on_telemetry_controller_event)
+        self.accessInterface.set_notification_engine(self.notificationEngine)
 
 
         logger.info("SERRANO Enhanced Telemetry Agent is ready ...")
 
+    def shutdown(self):
+        logger.info("Shutdown services ... ")
+
+        if self.metricsListener:
+            self.metricsListener.stop()
+            self.metricsListener.wait()
+
+        if self.notificationCoalescer:
+            self.notificationCoalescer.flush()
+
+        if self.notificationEngine:
+            self.notificationEngine.shutdown()
+
 
 if __name__ == "__main__":
 
     config_params = None
 
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
-
     if os.path.exists(CONF_FILE):
         with open(CONF_FILE) as f:
             config_params = yaml.safe_load(f)
@@ -83,8 +119,18 @@ if __name__ == "__main__":
 
     app = QCoreApplication(sys.argv)
 
+    # Quit the event loop on SIGINT/SIGTERM, so that the services are shutdown (e.g. pending notifications are sent).
+    # The timer returns the control to the Python interpreter periodically to handle the signals.
+    signal.signal(signal.SIGINT, lambda *args: app.quit())
+    signal.signal(signal.SIGTERM, lambda *args: app.quit())
+    signal_timer = QTimer()
+    signal_timer.timeout.connect(lambda: None)
+    signal_timer.start(500)
+
     instance = AgentInstance(config_params)
     instance.boot()
 
+    app.aboutToQuit.connect(instance.shutdown)
+
     sys.exit(app.exec_())
 
@@ -0,0 +1,77 @@
+import json
+import hashlib
+
+import quantityParser
+
+# Numeric capacity of the summaries per Kubernetes node capacity key
+NODE_CAPACITY = {"cpu": "cpu", "memory": "memory", "total_gpu": "gpu", "total_fpga": "fpga",
+                 "ephemeral-storage": "storage", "pods": "pods"}
+
+# Node inventory fields served by the infrastructure requests of the central handler, as a find() projection
+NODE_INVENTORY = {"node_name": 1, "node_info": {"architecture": 1},
+                  "node_capacity": {"total_fpga": 1, "total_gpu": 1, "cpu": 1, "memory": 1}, "node_labels": 1}
+
+
+def project(document, projection):
+    result = {}
+    for k, v in projection.items():
+        if k not in document:
+            continue
+        if isinstance(v, dict):
+            if isinstance(document[k], dict):
+                result[k] = project(document[k], v)
+        else:
+            result[k] = document[k]
+    return result
+
+
+def k8s_node_summary(node):
+
+    capacity = node.get("node_capacity_numeric", None)
+    if capacity is None:
+        capacity = quantityParser.normalize_capacity(node.get("node_capacity", {}))
+
+    labels = node.get("node_labels", {})
+
+    data = {"node_name": node.get("node_name", ""),
+            "architecture": node.get("node_info", {}).get("architecture", None),
+            "vaccel": str(labels.get("vaccel", "false")).lower() == "true",
+            "security_tier": str(labels.get("security-tier", 0))}
+
+    for k, name in NODE_CAPACITY.items():
+        data[name] = capacity.get(k, 0)
+
+    return data
+
+
+def summarize(cluster_uuid, cluster_type, inventory):
+
+    # Capacity of a cluster and of its nodes (or HPC partitions) with numeric values, computed once per inventory
+    # update, along with the inventory fields of the infrastructure requests. The version is derived from the
+    # content, so that it changes only when the summary changes.
+    data = {"cluster_uuid": cluster_uuid, "type": cluster_type}
+
+    if cluster_type == "k8s":
+        nodes = [k8s_node_summary(node) for node in inventory]
+        data["nodes"] = sorted(nodes, key=lambda n: n["node_name"])
+        data["totals"] = {name: sum(n[name] for n in nodes) for name in NODE_CAPACITY.values()}
+        data["totals"]["nodes"] = len(nodes)
+        data["vaccel_nodes"] = len([n for n in nodes if n["vaccel"]])
+        data["security_tiers"] = {}
+        for n in nodes:
+            data["security_tiers"][n["security_tier"]] = data["security_tiers"].get(n["security_tier"], 0) + 1
+        data["inventory"] = sorted([project(node, NODE_INVENTORY) for node in inventory],
+                                   key=lambda n: n.get("node_name", ""))
+    else:
+        partitions = [{"name": p.get("name", ""),
+                       "total_nodes": int(p.get("total_nodes", 0) or 0),
+                       "total_cpus": int(p.get("total_cpus", 0) or 0)} for p in inventory.get("partitions", [])]
+        data["name"] = inventory.get("name", None)
+        data["partitions"] = partitions
+        data["totals"] = {"nodes": sum(p["total_nodes"] for p in partitions),
+                          "cpu": sum(p["total_cpus"] for p in partitions)}
+        data["inventory"] = project(inventory, {"partitions": 1})
+
+    data["version"] = hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    return data
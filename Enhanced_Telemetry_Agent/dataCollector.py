@@ -16,11 +16,12 @@ class DataCollector(QObject):
     updatePMDS = pyqtSignal(object)
     notificationEvent = pyqtSignal(object)
 
-    def __init__(self, config):
+    def __init__(self, config, probe_data_cache):
 
         super(QObject, self).__init__()
 
         self.__config = config
+        self.__probe_data_cache = probe_data_cache
 
         self.__restProbes = {}
         self.__grpcProbes = {}
@@ -31,6 +32,7 @@ class DataCollector(QObject):
 
         self.__query_interval = config.get_query_interval()
         self.__query_timeout = config.get_query_timeout()
+        self.__inventory_interval = config.get_inventory_interval()
         self.__active_monitoring = True
 
         self.__lock = threading.Lock()
@@ -41,6 +43,11 @@ class DataCollector(QObject):
 
         self.__setup_timer()
 
+        # The inventory changes seldom, it is collected at a longer interval than the monitoring data
+        self.__inventoryTimer = QTimer(self)
+        self.__inventoryTimer.timeout.connect(self.__acquire_inventory_data)
+        self.__inventoryTimer.start(self.__inventory_interval * 1000)
+
     def __setup_timer(self):
         if not self.__collectorTimer:
             self.__collectorTimer = QTimer(self)
@@ -126,6 +133,7 @@ class DataCollector(QObject):
             try:
                 self.__lock.acquire()
                 del self.__restProbes[event["probe_uuid"]]
+                self.__probe_data_cache.remove(event["probe_uuid"])
                 self.__dataEngine.handle_probe_deregistration_data(event)
             except Exception as err:
                 logger.error("Failed to deregistrer probe")
@@ -160,6 +168,9 @@ class DataCollector(QObject):
         if not self.__active_monitoring:
             return
 
+        # The operational database writes of all the probes are gathered and bulk written at the end of the cycle
+        self.__dataEngine.begin_write_cycle()
+
         for probe_uuid, probe in probes.items():
             try:
                 logger.info("Retrieve monitoring data from probe '%s'" % probe_uuid)
@@ -168,6 +179,13 @@ class DataCollector(QObject):
                                    timeout=self.__query_timeout)
                 if res.status_code == 200 or res.status_code == 201:
                     logger.debug(res.text)
+                    self.__probe_data_cache.put(probe_uuid, "monitor", res.text,
+                                                metadata={"cluster_uuid": probe["cluster_uuid"]})
+                    if probe_uuid in self.__flaggedProbes:
+                        # The probe answers again, inform about its recovery
+                        self.__flaggedProbes.remove(probe_uuid)
+                        self.notificationEvent.emit({"entity_id": probe_uuid, "status": "UP",
+                                                     "type": "Probe", "timestamp": int(time.time())})
                     data = json.loads(res.text)
                     if data["type"] == "Probe.k8s":
                         self.__dataEngine.handle_probe_monitoring_data(probe["cluster_uuid"],
@@ -196,4 +214,38 @@ class DataCollector(QObject):
                 logger.error("Unable to retrieve monitoring data from probe '%s'" % probe_uuid)
                 logger.error(str(err))
 
+        self.__dataEngine.end_write_cycle()
+
+    def __acquire_inventory_data(self):
+        self.__lock.acquire()
+        probes = dict(self.__restProbes)
+        self.__lock.release()
+
+        if not self.__active_monitoring:
+            return
+
+        for probe_uuid, probe in probes.items():
+            try:
+                res = requests.get("%s/api/v1/telemetry/probe/inventory" % probe["url"],
+                                   verify=True,
+                                   timeout=self.__query_timeout)
+                if res.status_code != 200 and res.status_code != 201:
+                    logger.warning("Unable to retrieve inventory data from probe '%s' - HTTP %s"
+                                   % (probe_uuid, res.status_code))
+                    continue
+
+                data = json.loads(res.text)
 
+                # The operational database (clusters, capacity summary) is updated only when the inventory changed
+                cached = self.__probe_data_cache.get(probe_uuid, "inventory")
+                if cached is None or cached[0] != res.text:
+                    logger.info("Inventory data of probe '%s' changed" % probe_uuid)
+                    self.__dataEngine.handle_probe_inventory_data(probe["cluster_uuid"], probe_uuid, probe["type"],
+                                                                  data)
+
+                self.__probe_data_cache.put(probe_uuid, "inventory", res.text,
+                                            metadata={"cluster_uuid": probe["cluster_uuid"]})
+
+            except Exception as err:
+                logger.error("Unable to retrieve inventory data from probe '%s'" % probe_uuid)
+                logger.error(str(err))
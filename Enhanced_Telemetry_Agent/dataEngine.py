@@ -2,12 +2,32 @@ import json
 import time
 import logging
 import pymongo
+import datetime
 import threading
 
+import stateDelta
+import schemaManager
+import quantityParser
+import capacitySummary
+import mongoBatchWriter
+
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteMany
 from PyQt5.QtCore import QObject, pyqtSignal
 
 logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.DataEngine")
 
+# Entity types of the cluster_entity_metrics documents per monitoring data section
+ENTITY_TYPES = {"Nodes": "node", "Pods": "pod", "PersistentVolumes": "persistent_volume",
+                "Deployments": "deployment", "Services": "service"}
+
+# Latest utilization of the cluster_nodes documents per node monitoring data key
+NODE_UTILIZATION = {"node_memory_MemUsed_bytes": "memory_used",
+                    "node_memory_usage_percentage": "memory_usage_percentage",
+                    "node_filesystem_size_bytes": "filesystem_size",
+                    "node_filesystem_used_bytes": "filesystem_used",
+                    "node_filesystem_usage_percentage": "filesystem_usage_percentage",
+                    "node_total_running_pods": "running_pods"}
+
 
 class DataEngine(QObject):
 
@@ -26,17 +46,27 @@ class DataEngine(QObject):
         mongo_client = pymongo.MongoClient(mongo_uri)
 
         self.__retain_period = config.get_retain_data_period()
+        self.__entity_metrics = operational_db["entity_metrics"]
         self.__agent_uuid = config.get_agent_uuid()
+
+        # Cluster states are stored as keyframes followed by change-only documents
+        self.__state_encoder = stateDelta.StateEncoder(config.get_state_keyframe_interval())
         self.__agent_url = rest_interface["exposed_service"]
 
         self.__lock = threading.Lock()
         self.__deployments_monitoring = {}
+        self.__capacity_versions = {}
 
         self.__clusterCollection = mongo_client[operational_db["dbName"]]["clusters"]
+        self.__clusterCapacityCollection = mongo_client[operational_db["dbName"]]["cluster_capacity"]
+        self.__clusterNodesCollection = mongo_client[operational_db["dbName"]]["cluster_nodes"]
         self.__entitiesCollection = mongo_client[operational_db["dbName"]]["entities"]
         self.__clusterMetricsCollection = mongo_client[operational_db["dbName"]]["cluster_state_metrics"]
         self.__edgeStorageCollection = mongo_client[operational_db["dbName"]]["edge_storage"]
         self.__edgeStorageMetricsCollection = mongo_client[operational_db["dbName"]]["edge_storage_metrics"]
+        self.__clusterLatestCollection = mongo_client[operational_db["dbName"]]["cluster_state_latest"]
+        self.__edgeStorageLatestCollection = mongo_client[operational_db["dbName"]]["edge_storage_latest"]
+        self.__clusterEntityMetricsCollection = mongo_client[operational_db["dbName"]]["cluster_entity_metrics"]
         self.__deploymentsCollection = mongo_client[operational_db["dbName"]]["serrano_deployments"]
         self.__deploymentsSpecificMetricsCollection = mongo_client[operational_db["dbName"]]["deployments_specific_metrics"]
 
@@ -44,17 +74,27 @@ class DataEngine(QObject):
 
         self.__applicationCollection = mongo_client[operational_db["dbName"]]["application_metrics"]
 
+        # Monitoring data writes, batched per collection within each collection cycle
+        self.__writer = mongoBatchWriter.MongoBatchWriter(mongo_client[operational_db["dbName"]],
+                                                          operational_db["write_concern"])
+
+        # Indexes of the operational database, the monitoring data expire through TTL indexes (or the time-series
+        # collections expiry) based on the retain data period
+        schema_manager = schemaManager.SchemaManager(mongo_client[operational_db["dbName"]],
+                                                     operational_db["storage_mode"])
+        schema_manager.ensure_time_series_collections(self.__retain_period)
+        schema_manager.ensure_indexes()
+        schema_manager.ensure_ttl_indexes(self.__retain_period)
+        schema_manager.check_query_plans()
+
         self.__initialize_agent_entity()
         self.__load_deployments_monitoring()
 
     def __initialize_agent_entity(self):
 
-        if self.__entitiesCollection.count_documents({"uuid": self.__agent_uuid}) == 0:
-            self.__entitiesCollection.insert_one({"uuid": self.__agent_uuid, "type": "Agent", "url": self.__agent_url,
-                                                  "probes": [], "timestamp": int(time.time())})
-        else:
-            self.__entitiesCollection.update_one({"uuid": self.__agent_uuid}, {"$set": {"url": self.__agent_url,
-                                                                                        "timestamp": int(time.time())}})
+        self.__entitiesCollection.update_one({"uuid": self.__agent_uuid},
+                                             {"$set": {"url": self.__agent_url, "timestamp": int(time.time())},
+                                              "$setOnInsert": {"type": "Agent", "probes": []}}, upsert=True)
 
     def __load_deployments_monitoring(self):
 
@@ -80,6 +120,28 @@ class DataEngine(QObject):
             if self.__lock.locked():
                 self.__lock.release()
 
+    def begin_write_cycle(self):
+        self.__writer.begin_cycle()
+
+    def end_write_cycle(self):
+        self.__end_write_cycle()
+
+    def __end_write_cycle(self):
+        # A lost cluster state document breaks the delta chain of its cluster, the encoders are reset so that the
+        # next cluster states are written as keyframes
+        if "cluster_state_metrics" in self.__writer.end_cycle():
+            logger.warning("Cluster state metrics write failed, the next cluster states are encoded as keyframes")
+            self.__state_encoder.reset()
+
+    def get_write_cycle_stats(self):
+        return self.__writer.get_cycle_stats()
+
+    @staticmethod
+    def __timestamped(document, timestamp):
+        document["timestamp"] = timestamp
+        document["created_at"] = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        return document
+
     def get_agent_probes(self):
         ids = self.__entitiesCollection.find_one({"uuid": self.__agent_uuid})["probes"]
         return list(self.__entitiesCollection.find({"uuid": {"$in": ids}}))
@@ -89,21 +151,12 @@ class DataEngine(QObject):
         logger.info("Update operational database with registered probe '%s'" % data["probe_uuid"])
         logger.debug(json.dumps(data))
 
-        if self.__entitiesCollection.count_documents({"uuid": data["probe_uuid"]}) == 0:
-            self.__entitiesCollection.insert_one({"uuid": data["probe_uuid"], "type": data["type"], "url": data["url"],
-                                                  "cluster_uuid": data["cluster_uuid"], "timestamp": int(time.time())})
-        else:
-            self.__entitiesCollection.update_one({"uuid": data["probe_uuid"]}, {"$set": {"url": data["url"],
-                                                                                         "type": data["type"],
-                                                                                         "cluster_uuid": data[
-                                                                                             "cluster_uuid"],
-                                                                                         "timestamp": int(
-                                                                                             time.time())}})
-
-        if self.__entitiesCollection.count_documents({"uuid": self.__agent_uuid,
-                                                      "probes": {"$in": [data["probe_uuid"]]}}) == 0:
-            self.__entitiesCollection.update_one({"uuid": self.__agent_uuid},
-                                                 {"$push": {"probes": data["probe_uuid"]}})
+        self.__entitiesCollection.update_one({"uuid": data["probe_uuid"]},
+                                             {"$set": {"url": data["url"], "type": data["type"],
+                                                       "cluster_uuid": data["cluster_uuid"],
+                                                       "timestamp": int(time.time())}}, upsert=True)
+
+        self.__entitiesCollection.update_one({"uuid": self.__agent_uuid}, {"$addToSet": {"probes": data["probe_uuid"]}})
 
         if data["type"] == "Probe.EdgeStorage":
             self.__set_edge_storage_probe_inventory_data(data)
@@ -112,42 +165,111 @@ class DataEngine(QObject):
 
     def __set_edge_storage_probe_inventory_data(self, data):
      
+        operations = []
+
         for inventory_data in data["inventory"]["edge_storage_devices"]:
-            if self.__edgeStorageCollection.count_documents({"name": inventory_data["name"],
-                                                             "cluster_uuid": inventory_data["cluster_uuid"]}) == 0:
-                inventory_data["timestamp"] = int(time.time())
-                self.__edgeStorageCollection.insert_one(inventory_data)
-            else:
-                self.__edgeStorageCollection.update_one({"name": inventory_data["name"],
-                                                         "cluster_uuid": inventory_data["cluster_uuid"]},
-                                                        {"$set": {"timestamp": int(time.time()),
-                                                                  "lat": inventory_data["lat"],
-                                                                  "lng": inventory_data["lng"],
-                                                                  "minio_node_disk_total_bytes": inventory_data["minio_node_disk_total_bytes"]}})
+            updated = {"timestamp": int(time.time()), "lat": inventory_data["lat"], "lng": inventory_data["lng"],
+                       "minio_node_disk_total_bytes": inventory_data["minio_node_disk_total_bytes"]}
+            inserted = {k: v for k, v in inventory_data.items()
+                        if k not in updated and k not in ["name", "cluster_uuid"]}
+            operations.append(UpdateOne({"name": inventory_data["name"],
+                                         "cluster_uuid": inventory_data["cluster_uuid"]},
+                                        {"$set": updated, "$setOnInsert": inserted}, upsert=True))
 
-    def __set_cluster_probe_inventory_data(self, data):
+        if operations:
+            self.__edgeStorageCollection.bulk_write(operations, ordered=False)
 
-        if self.__clusterCollection.count_documents({"uuid": data["cluster_uuid"]}) == 0:
+    def __set_cluster_probe_inventory_data(self, data):
 
-            cluster_data = {"uuid": data["cluster_uuid"], "type": "k8s", "name": "", "timestamp": int(time.time())}
+        if data["type"].find("Probe.k8s") != -1 or data["type"].find("Probe.K8s") != -1:
+            cluster_type = "k8s"
+            inventory_data = self.__normalize_k8s_inventory_data(data["inventory"]["kubernetes_inventory_data"])
+        else:
+            cluster_type = "HPC"
+            inventory_data = data["inventory"]
 
-            if data["type"].find("Probe.k8s") != -1 or data["type"].find("Probe.K8s") != -1:
-                cluster_data["type"] = "k8s"
-                cluster_data["inventory"] = data["inventory"]["kubernetes_inventory_data"]
-            else:
-                cluster_data["type"] = "HPC"
-                cluster_data["inventory"] = data["inventory"]
+        self.__clusterCollection.update_one({"uuid": data["cluster_uuid"]},
+                                            {"$set": {"timestamp": int(time.time()), "inventory": inventory_data},
+                                             "$setOnInsert": {"type": cluster_type, "name": ""}}, upsert=True)
 
-            self.__clusterCollection.insert_one(cluster_data)
+        self.__set_cluster_capacity(data["cluster_uuid"], cluster_type, inventory_data)
 
-        else:
-            if data["type"].find("Probe.k8s") != -1 or data["type"].find("Probe.K8s") != -1:
-                inventory_data = data["inventory"]["kubernetes_inventory_data"]
-            else:
-                inventory_data = data["inventory"]
+    def __set_cluster_capacity(self, cluster_uuid, cluster_type, inventory_data):
 
-            self.__clusterCollection.update_one({"uuid": data["cluster_uuid"]}, {"$set": {"timestamp": int(time.time()),
-                                                                                          "inventory": inventory_data}})
+        # The capacity summary served by the central handler is written only when the capacity changes
+        try:
+            summary = capacitySummary.summarize(cluster_uuid, cluster_type, inventory_data)
+        except Exception as err:
+            logger.error("Unable to summarize the capacity of cluster '%s'" % cluster_uuid)
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            return
+
+        if self.__capacity_versions.get(cluster_uuid, None) == summary["version"]:
+            return
+
+        summary["timestamp"] = int(time.time())
+        self.__clusterCapacityCollection.replace_one({"cluster_uuid": cluster_uuid}, summary, upsert=True)
+
+        # Numeric capacity per node, queried by the cluster selection requests of the central handler
+        if cluster_type == "k8s":
+            operations = []
+            for node in summary["nodes"]:
+                node = dict(node, cluster_uuid=cluster_uuid)
+                try:
+                    node["security_tier"] = int(node["security_tier"])
+                except ValueError:
+                    pass
+                operations.append(UpdateOne({"cluster_uuid": cluster_uuid, "node_name": node["node_name"]},
+                                            {"$set": node}, upsert=True))
+            operations.append(DeleteMany({"cluster_uuid": cluster_uuid,
+                                          "node_name": {"$nin": [n["node_name"] for n in summary["nodes"]]}}))
+            self.__clusterNodesCollection.bulk_write(operations, ordered=False)
+
+        self.__capacity_versions[cluster_uuid] = summary["version"]
+
+    def __queue_node_utilization(self, cluster_uuid, data, timestamp):
+
+        cpu_used = {}
+        for pod in data.get("Pods", []):
+            usage = pod.get("usage", None) or {}
+            cpu_used[pod.get("node", None)] = cpu_used.get(pod.get("node", None), 0) + usage.get("cpu_cores", 0)
+
+        for node in data.get("Nodes", []):
+            utilization = {name: node[k] for k, name in NODE_UTILIZATION.items() if k in node}
+            utilization["cpu_used"] = cpu_used.get(node["node_name"], 0)
+            utilization["utilization_timestamp"] = timestamp
+
+            # Free resources are derived from the capacity of the node document, the nodes without capacity yet
+            # are skipped
+            free = {"cpu_free": {"$max": [{"$subtract": ["$cpu", utilization["cpu_used"]]}, 0]}}
+            if "memory_used" in utilization:
+                free["memory_free"] = {"$max": [{"$subtract": ["$memory", utilization["memory_used"]]}, 0]}
+            if "filesystem_used" in utilization and "filesystem_size" in utilization:
+                free["filesystem_free"] = utilization["filesystem_size"] - utilization["filesystem_used"]
+
+            self.__writer.queue("cluster_nodes",
+                                UpdateOne({"cluster_uuid": cluster_uuid, "node_name": node["node_name"]},
+                                          [{"$set": utilization}, {"$set": free}]),
+                                key=(cluster_uuid, node["node_name"]))
+
+    @staticmethod
+    def __normalize_k8s_inventory_data(inventory_data):
+        # Numeric node capacity for inventory data reported by probes that do not provide it
+        for node in inventory_data:
+            if "node_capacity" in node and "node_capacity_numeric" not in node:
+                node["node_capacity_numeric"] = quantityParser.normalize_capacity(node["node_capacity"])
+        return inventory_data
+
+    @staticmethod
+    def __normalize_k8s_monitoring_data(data):
+        # Numeric cores and bytes for monitoring data reported by probes that do not provide them
+        for pod in data.get("Pods", []):
+            if "usage" in pod:
+                quantityParser.normalize_usage(pod["usage"])
+        for pv in data.get("PersistentVolumes", []):
+            if "capacity" in pv and "capacity_numeric" not in pv:
+                pv["capacity_numeric"] = quantityParser.normalize_capacity(pv["capacity"] or {})
+        return data
 
     def handle_probe_deregistration_data(self, data):
 
@@ -160,9 +282,16 @@ class DataEngine(QObject):
         if entity["type"] == "Probe.EdgeStorage":
             self.__edgeStorageCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
             self.__edgeStorageMetricsCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
+            self.__edgeStorageLatestCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
         else:
             self.__clusterCollection.delete_one({"uuid": entity["cluster_uuid"]})
+            self.__clusterCapacityCollection.delete_one({"cluster_uuid": entity["cluster_uuid"]})
+            self.__clusterNodesCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
+            self.__capacity_versions.pop(entity["cluster_uuid"], None)
             self.__clusterMetricsCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
+            self.__clusterLatestCollection.delete_one({"cluster_uuid": entity["cluster_uuid"]})
+            self.__clusterEntityMetricsCollection.delete_many({"cluster_uuid": entity["cluster_uuid"]})
+            self.__state_encoder.reset(entity["cluster_uuid"])
 
         # Delete the probe from ETA
         self.__entitiesCollection.update_one({"uuid": self.__agent_uuid}, {"$pull": {"probes": data["probe_uuid"]}})
@@ -193,10 +322,20 @@ class DataEngine(QObject):
             # through the simple sidecar mechanism
             if data["action"] == "deployment_specific_metrics":
                 if data["request_method"] == "post":
-                    self.__deploymentsSpecificMetricsCollection.delete_many({"deployment_uuid": data["metrics_data"]["deployment_uuid"],
-                                                                             "timestamp": {"$lte": int(time.time()) - self.__retain_period}})
-
-                    self.__deploymentsSpecificMetricsCollection.insert_one(data["metrics_data"])
+                    metrics_data = dict(data["metrics_data"])
+                    metrics_data["created_at"] = datetime.datetime.now(tz=datetime.timezone.utc)
+                    self.__writer.queue("deployments_specific_metrics", InsertOne(metrics_data))
+                    self.updatePMDS.emit({"probe_type": "DeploymentSpecificMetrics", "data": data["metrics_data"]})
+                elif data["request_method"] == "bulk":
+                    self.__writer.begin_cycle()
+                    try:
+                        for metrics_data in data["metrics_data"]:
+                            self.__writer.queue("deployments_specific_metrics",
+                                                InsertOne(self.__timestamped(dict(metrics_data),
+                                                                             int(metrics_data.get("timestamp", None) or
+                                                                                 time.time()))))
+                    finally:
+                        self.__end_write_cycle()
                     self.updatePMDS.emit({"probe_type": "DeploymentSpecificMetrics", "data": data["metrics_data"]})
 
         except Exception as e:
@@ -225,6 +364,24 @@ class DataEngine(QObject):
             data.append(p)
         return data
 
+    @staticmethod
+    def __extract_entity_metrics(cluster_uuid, data):
+
+        entity_metrics = []
+
+        for section, items in data.items():
+            if not isinstance(items, list):
+                continue
+            entity_type = ENTITY_TYPES.get(section, section.lower())
+            for item in items:
+                entity_name = stateDelta.item_key(item)
+                if entity_name is None:
+                    continue
+                entity_metrics.append({"cluster_uuid": cluster_uuid, "entity_type": entity_type,
+                                       "entity_name": entity_name, "metrics": item})
+
+        return entity_metrics
+
     def handle_probe_monitoring_data(self, cluster_uuid, probe_uuid, probe_type, data):
 
         logger.info("Update operational database with operational data from probe '%s'" % probe_uuid)
@@ -232,43 +389,66 @@ class DataEngine(QObject):
 
         try:
 
+            self.__writer.begin_cycle()
+
             if probe_type == "Probe.EdgeStorage":
 
-                # Delete "expired" metrics
-                self.__edgeStorageMetricsCollection.delete_many({"cluster_uuid": cluster_uuid,
-                                                                 "timestamp": {"$lte": int(time.time()) - self.__retain_period}})
-                # Update edge storage metrics
+                # Update edge storage metrics and the latest metrics per device
                 for d in data:
-                    d["timestamp"] = int(time.time())
-                    self.__edgeStorageMetricsCollection.insert_one(d)
+                    self.__writer.queue("edge_storage_metrics", InsertOne(self.__timestamped(dict(d),
+                                                                                             int(time.time()))))
+                    self.__writer.queue("edge_storage_latest",
+                                        ReplaceOne({"cluster_uuid": d["cluster_uuid"], "name": d["name"]},
+                                                   self.__timestamped(dict(d), int(time.time())), upsert=True),
+                                        key=(d["cluster_uuid"], d["name"]))
 
             else:
 
+                if probe_type == "Probe.k8s":
+                    self.__normalize_k8s_monitoring_data(data)
+
                 if probe_type == "Probe.k8s" and "Pods" in data:
                     deployments_metrics = self.__extract_deployments_metrics(cluster_uuid, data["Pods"])
                     logger.debug("Handle Deployment metrics ...")
                     if deployments_metrics:
-                        self.__clusterDeploymentMetricsCollection.delete_many({"cluster_uuid": cluster_uuid,
-                                                                               "timestamp": {"$lte": int(time.time()) - self.__retain_period }})
-                        self.__clusterDeploymentMetricsCollection.insert_many(deployments_metrics)
+                        for deployment_metrics in deployments_metrics:
+                            self.__writer.queue("cluster_deployment_metrics",
+                                                InsertOne(self.__timestamped(dict(deployment_metrics),
+                                                                             deployment_metrics["timestamp"])))
                         self.updatePMDS.emit({"probe_type": "DeploymentMonitoring",
                                               "cluster_uuid": cluster_uuid,
                                               "probe_uuid": probe_uuid,
                                               "data": deployments_metrics})
 
-                # Delete "expired" metrics
-                self.__clusterMetricsCollection.delete_many({"cluster_uuid": cluster_uuid,
-                                                             "timestamp": {"$lte": int(time.time()) - self.__retain_period}})
-
-                # Update cluster_state_metrics
-                self.__clusterMetricsCollection.insert_one({"cluster_uuid": cluster_uuid,
-                                                            "timestamp": int(time.time()),
-                                                            "state": data})
+                # Update cluster_state_metrics and the latest cluster state
+                timestamp = int(time.time())
+                self.__writer.queue("cluster_state_metrics",
+                                    InsertOne(self.__timestamped(self.__state_encoder.encode(cluster_uuid, data,
+                                                                                             timestamp),
+                                                                 timestamp)))
+                self.__writer.queue("cluster_state_latest",
+                                    ReplaceOne({"cluster_uuid": cluster_uuid},
+                                               self.__timestamped({"cluster_uuid": cluster_uuid, "state": data},
+                                                                  timestamp), upsert=True),
+                                    key=cluster_uuid)
+
+                # Update the latest utilization of the nodes
+                if probe_type == "Probe.k8s":
+                    self.__queue_node_utilization(cluster_uuid, data, timestamp)
+
+                # Update cluster_entity_metrics, one document per node, pod, persistent volume, ...
+                if self.__entity_metrics:
+                    for entity_metrics in self.__extract_entity_metrics(cluster_uuid, data):
+                        self.__writer.queue("cluster_entity_metrics",
+                                            InsertOne(self.__timestamped(entity_metrics, timestamp)))
 
         except Exception as err:
             logger.error("Unable to update operational database")
             logger.error("%s - %s" % (err.__class__.__name__, str(err)))
 
+        finally:
+            self.__end_write_cycle()
+
         logger.info("Inform PMDSInterface")
 
         self.updatePMDS.emit({"probe_type": probe_type,
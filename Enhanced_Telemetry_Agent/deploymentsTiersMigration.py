@@ -0,0 +1,133 @@
+"""
+    Roll up the existing history of the "SERRANO_Deployments" bucket into the downsampling tiers
+    ("SERRANO_Deployments_1m", "SERRANO_Deployments_1h") and apply the configured retention periods of
+    "influxDB.deployments_retention" to the deployments buckets.
+
+    The Enhanced Telemetry Agent creates the tier buckets and their rollup tasks, but it does not shorten the
+    retention of an existing "SERRANO_Deployments" bucket, since its history would expire before it is rolled
+    up. The history is rolled up in consecutive time windows (whole hours), the "1m" tier first and then the "1h"
+    tier from the "1m" tier. Rolling up a window again overwrites the same points, so that an interrupted
+    migration can be resumed by running the command again. The retention periods are applied only when the
+    "--apply-retention" option is provided.
+
+    The legacy "SERRANO_Deployments_Metrics" bucket, a full resolution copy of "SERRANO_Deployments" that is no
+    longer written, is deleted when the "--delete-legacy" option is provided.
+
+    Example: python deploymentsTiersMigration.py --start -3650d --window 7d --apply-retention --delete-legacy
+"""
+
+import sys
+import yaml
+import time
+import logging
+import os.path
+import argparse
+import datetime
+
+from influxdb_client import InfluxDBClient, BucketRetentionRules
+
+import pmdsInterface
+import agentConfiguration
+
+CONF_FILE = "/etc/serrano/telemetry_agent.yaml"
+LOG_LEVEL = {"CRITICAL": 50, "ERROR": 40, "WARNING": 30, "INFO": 20, "DEBUG": 10}
+
+LEGACY_BUCKET = "SERRANO_Deployments_Metrics"
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.DeploymentsTiersMigration")
+
+
+def parse_time(value, now):
+    if value.startswith("-"):
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+        return now - datetime.timedelta(seconds=int(value[1:-1]) * units[value[-1]])
+    return datetime.datetime.fromtimestamp(int(value), tz=datetime.timezone.utc)
+
+
+def parse_window(value):
+    units = {"h": 3600, "d": 86400, "w": 604800}
+    return datetime.timedelta(seconds=int(value[:-1]) * units[value[-1]])
+
+
+def hour(value):
+    # The windows are aligned to whole hours, so that no rollup window of the tiers is split
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def backfill_tier(query_api, org, tier, start, stop, window):
+
+    w_start = start
+
+    while w_start < stop:
+        w_stop = min(w_start + window, stop)
+        query_api.query(pmdsInterface.deployments_rollup_flux(tier, org, w_start.isoformat(), w_stop.isoformat()),
+                        org=org)
+        logger.info("Tier '%s' - window %s / %s rolled up" % (tier, w_start.isoformat(), w_stop.isoformat()))
+        w_start = w_stop
+
+
+def apply_retention(buckets_api, bucket_name, retention_seconds):
+
+    buckets = buckets_api.find_buckets(name=bucket_name).buckets
+    if len(buckets) == 0:
+        logger.warning("Bucket '%s' does not exist" % bucket_name)
+        return
+
+    logger.info("Update retention period of bucket '%s' to %s seconds" % (bucket_name, retention_seconds))
+    buckets[0].retention_rules = [BucketRetentionRules(type="expire", every_seconds=retention_seconds)]
+    buckets_api.update_bucket(bucket=buckets[0])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Roll up the SERRANO deployments history into the downsampling tiers")
+    parser.add_argument("--config", default=CONF_FILE)
+    parser.add_argument("--start", default="-3650d", help="Relative duration (e.g. -365d) or unix timestamp")
+    parser.add_argument("--stop", default=None, help="Relative duration (e.g. -1h) or unix timestamp")
+    parser.add_argument("--window", default="1d", help="Rollup window in whole hours (e.g. 6h, 1d, 1w)")
+    parser.add_argument("--apply-retention", action="store_true",
+                        help="Apply the configured retention periods once the tiers are rolled up")
+    parser.add_argument("--delete-legacy", action="store_true", help="Delete the '%s' bucket" % LEGACY_BUCKET)
+    args = parser.parse_args()
+
+    config_params = None
+
+    if os.path.exists(args.config):
+        with open(args.config) as f:
+            config_params = yaml.safe_load(f)
+
+    if config_params is None:
+        sys.exit(0)
+
+    config = agentConfiguration.AgentConfiguration(config_params)
+    logging.basicConfig(filename="migration_%s.log" % (int(time.time())), level=LOG_LEVEL[config.get_log_level()])
+
+    influx_config = config.get_influxDB()
+    client = InfluxDBClient(url="https://%s:%s" % (influx_config["address"], influx_config["port"]),
+                            token=influx_config["token"],
+                            org=influx_config["org"],
+                            timeout=300000)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    start = hour(parse_time(args.start, now))
+    stop = hour(parse_time(args.stop, now) if args.stop else now)
+
+    # Lower tiers first, each tier is rolled up from the previous one
+    for tier_name in pmdsInterface.DEPLOYMENTS_TIERS.keys():
+        backfill_tier(client.query_api(), influx_config["org"], tier_name, start, stop, parse_window(args.window))
+        print("Tier '%s' rolled up from %s to %s" % (tier_name, start.isoformat(), stop.isoformat()))
+
+    if args.apply_retention:
+        retention = influx_config["deployments_retention"]
+        apply_retention(client.buckets_api(), pmdsInterface.DEPLOYMENTS_BUCKET, retention["raw"])
+        for tier_name, tier_config in pmdsInterface.DEPLOYMENTS_TIERS.items():
+            apply_retention(client.buckets_api(), tier_config["bucket"], retention[tier_name])
+
+    if args.delete_legacy:
+        legacy = client.buckets_api().find_buckets(name=LEGACY_BUCKET).buckets
+        if legacy:
+            logger.info("Delete bucket '%s'" % LEGACY_BUCKET)
+            client.buckets_api().delete_bucket(legacy[0])
+            print("Bucket '%s' deleted" % LEGACY_BUCKET)
+
+    client.close()
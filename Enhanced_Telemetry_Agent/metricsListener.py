@@ -0,0 +1,229 @@
+"""
+    Deployment specific metrics received over UDP or a Unix datagram socket, one sample per line in a
+    StatsD-like format with the identity of the deployment as tags:
+
+        <metric>:<value>|<type>[|@<sample rate>]|#deployment_uuid:<uuid>,service_id:<id>[,cluster_uuid:<uuid>]
+
+    with type "c" (counter), "g" (gauge) or "ms"/"h" (timer). The samples are aggregated in memory per flush
+    interval and forwarded as deployment specific metrics records, one per deployment service:
+    counters as their sum, gauges as their last value and timers as <metric>_count, _min, _max and _mean.
+"""
+
+import os
+import math
+import time
+import socket
+import logging
+import selectors
+
+from PyQt5.QtCore import QThread
+from PyQt5.QtCore import pyqtSignal
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.MetricsListener")
+
+MAX_DATAGRAM = 65535
+
+
+class MetricsListener(QThread):
+
+    listenerMessage = pyqtSignal(object)
+
+    def __init__(self, config, specific_metrics_schema):
+
+        QThread.__init__(self)
+
+        self.__address = config["address"]
+        self.__port = config["port"]
+        self.__unix_socket = config["unix_socket"]
+        self.__flush_interval = config["flush_interval"]
+        self.__rate_limit = config["rate_limit"]
+
+        # Shared with the REST interface, so that a metric keeps its type whichever way it is pushed
+        self.__specific_metrics_schema = specific_metrics_schema
+
+        self.__running = True
+        self.__selector = selectors.DefaultSelector()
+
+        self.__aggregates = {}
+        self.__buckets = {}
+        self.__stats = {"received": 0, "invalid": 0, "rate_limited": 0, "rejected": 0}
+
+    def __open_sockets(self):
+
+        if self.__port:
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.bind((self.__address, int(self.__port)))
+            udp_socket.setblocking(False)
+            self.__selector.register(udp_socket, selectors.EVENT_READ)
+            logger.info("Listen for metrics on udp://%s:%s" % (self.__address, self.__port))
+
+        if self.__unix_socket:
+            if os.path.exists(self.__unix_socket):
+                os.remove(self.__unix_socket)
+            unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            unix_socket.bind(self.__unix_socket)
+            unix_socket.setblocking(False)
+            self.__selector.register(unix_socket, selectors.EVENT_READ)
+            logger.info("Listen for metrics on unix://%s" % self.__unix_socket)
+
+    def __allow(self, deployment_uuid, now):
+
+        # Token bucket per deployment, refilled at rate_limit samples per second
+        tokens, timestamp = self.__buckets.get(deployment_uuid, (self.__rate_limit, now))
+        tokens = min(self.__rate_limit, tokens + (now - timestamp) * self.__rate_limit)
+
+        if tokens < 1:
+            self.__buckets[deployment_uuid] = (tokens, now)
+            return False
+
+        self.__buckets[deployment_uuid] = (tokens - 1, now)
+        return True
+
+    @staticmethod
+    def parse_line(line):
+
+        parts = line.split("|")
+        if len(parts) < 2 or ":" not in parts[0]:
+            raise ValueError("Invalid sample '%s'" % line)
+
+        name, value = parts[0].rsplit(":", 1)
+        sample = {"name": name.strip(), "value": float(value), "type": parts[1].strip(), "rate": 1.0, "tags": {}}
+
+        for part in parts[2:]:
+            if part.startswith("@"):
+                sample["rate"] = float(part[1:])
+            elif part.startswith("#"):
+                for tag in part[1:].split(","):
+                    k, v = tag.split(":", 1)
+                    sample["tags"][k.strip()] = v.strip()
+
+        if not sample["name"] or sample["type"] not in ["c", "g", "ms", "h"] or not 0 < sample["rate"] <= 1 or \
+                not math.isfinite(sample["value"]):
+            raise ValueError("Invalid sample '%s'" % line)
+        if "deployment_uuid" not in sample["tags"] or "service_id" not in sample["tags"]:
+            raise ValueError("Missing deployment_uuid or service_id tag '%s'" % line)
+
+        return sample
+
+    def __handle_datagram(self, datagram, now):
+
+        for line in datagram.decode("utf-8", errors="replace").splitlines():
+
+            if not line.strip():
+                continue
+
+            self.__stats["received"] += 1
+
+            try:
+                sample = self.parse_line(line.strip())
+            except (ValueError, IndexError, KeyError):
+                self.__stats["invalid"] += 1
+                continue
+
+            tags = sample["tags"]
+            if not self.__allow(tags["deployment_uuid"], now):
+                self.__stats["rate_limited"] += 1
+                continue
+
+            key = (tags.get("cluster_uuid", ""), tags["deployment_uuid"], tags["service_id"])
+            metrics = self.__aggregates.setdefault(key, {})
+
+            if sample["type"] == "c":
+                metrics[sample["name"]] = metrics.get(sample["name"], 0.0) + sample["value"] / sample["rate"]
+            elif sample["type"] == "g":
+                metrics[sample["name"]] = sample["value"]
+            else:
+                timer = metrics.setdefault((sample["name"], "timer"), {"count": 0, "sum": 0.0,
+                                                                        "min": sample["value"],
+                                                                        "max": sample["value"]})
+                timer["count"] += 1
+                timer["sum"] += sample["value"]
+                timer["min"] = min(timer["min"], sample["value"])
+                timer["max"] = max(timer["max"], sample["value"])
+
+    def __flush(self):
+
+        aggregates = self.__aggregates
+        self.__aggregates = {}
+
+        records = []
+        timestamp = int(time.time())
+
+        for (cluster_uuid, deployment_uuid, service_id), metrics in aggregates.items():
+            data = {}
+            for name, value in metrics.items():
+                if isinstance(name, tuple):
+                    data["%s_count" % name[0]] = float(value["count"])
+                    data["%s_min" % name[0]] = value["min"]
+                    data["%s_max" % name[0]] = value["max"]
+                    data["%s_mean" % name[0]] = value["sum"] / value["count"]
+                else:
+                    data[name] = value
+
+            # Same validation as the records of the REST interface, e.g. a metric previously pushed as a string
+            record, error = self.__specific_metrics_schema.validate({"cluster_uuid": cluster_uuid,
+                                                                     "deployment_uuid": deployment_uuid,
+                                                                     "service_id": service_id,
+                                                                     "metrics": data,
+                                                                     "timestamp": timestamp})
+            if error:
+                self.__stats["rejected"] += 1
+                logger.debug("Metrics listener - rejected record of deployment '%s' - %s" % (deployment_uuid, error))
+                continue
+            records.append(record)
+
+        if self.__stats["invalid"] or self.__stats["rate_limited"] or self.__stats["rejected"]:
+            logger.warning("Metrics listener - %s invalid and %s rate limited samples of %s, %s rejected records" %
+                           (self.__stats["invalid"], self.__stats["rate_limited"], self.__stats["received"],
+                            self.__stats["rejected"]))
+        self.__stats = {"received": 0, "invalid": 0, "rate_limited": 0, "rejected": 0}
+
+        if not records:
+            return
+
+        # Same path as the bulk deployment specific metrics requests of the REST interface
+        self.listenerMessage.emit({"action": "deployment_specific_metrics",
+                                   "request_method": "bulk",
+                                   "metrics_data": records})
+
+    def stop(self):
+        self.__running = False
+
+    def __del__(self):
+        self.wait()
+
+    def run(self):
+
+        try:
+            self.__open_sockets()
+        except Exception as err:
+            logger.error("Unable to open the metrics listener sockets")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            return
+
+        logger.info("MetricsListener is running ...")
+
+        next_flush = time.time() + self.__flush_interval
+
+        while self.__running:
+
+            for key, _ in self.__selector.select(timeout=max(next_flush - time.time(), 0)):
+                try:
+                    datagram = key.fileobj.recv(MAX_DATAGRAM)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                try:
+                    self.__handle_datagram(datagram, time.time())
+                except Exception as err:
+                    logger.error("Unable to handle metrics datagram")
+                    logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+            if time.time() >= next_flush:
+                self.__flush()
+                next_flush = time.time() + self.__flush_interval
+
+        self.__flush()
+
+        for key in list(self.__selector.get_map().values()):
+            self.__selector.unregister(key.fileobj)
+            key.fileobj.close()
@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+
+import pymongo
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.MongoBatchWriter")
+
+
+class MongoBatchWriter:
+
+    def __init__(self, database, write_concern):
+
+        self.__database = database
+        self.__write_concern = pymongo.WriteConcern(**write_concern)
+
+        self.__lock = threading.Lock()
+        self.__collections = {}
+        self.__operations = {}
+        self.__keyed_operations = {}
+
+        self.__cycle_depth = 0
+        self.__cycle_stats = {"round_trips": 0, "operations": 0, "errors": 0, "duration": 0, "timestamp": 0}
+        self.__last_cycle_stats = dict(self.__cycle_stats)
+        # Collections with failed writes in the current cycle
+        self.__cycle_failures = set()
+        # Writes flushed outside of a cycle (e.g. single deployment specific metrics), accumulated since the start
+        self.__out_of_cycle_stats = {"round_trips": 0, "operations": 0, "errors": 0}
+
+    def __collection(self, name):
+        if name not in self.__collections:
+            self.__collections[name] = self.__database.get_collection(name, write_concern=self.__write_concern)
+        return self.__collections[name]
+
+    def begin_cycle(self):
+        with self.__lock:
+            if self.__cycle_depth == 0:
+                self.__cycle_stats = {"round_trips": 0, "operations": 0, "errors": 0, "duration": 0,
+                                      "timestamp": int(time.time())}
+                self.__cycle_failures = set()
+            self.__cycle_depth += 1
+
+    def end_cycle(self):
+        # Returns the names of the collections with failed writes in the completed cycle, empty for a nested cycle
+        with self.__lock:
+            self.__cycle_depth = max(self.__cycle_depth - 1, 0)
+            if self.__cycle_depth > 0:
+                return set()
+
+        self.__flush(True)
+
+        with self.__lock:
+            self.__cycle_stats["duration"] = time.time() - self.__cycle_stats["timestamp"]
+            self.__last_cycle_stats = dict(self.__cycle_stats)
+            failures = set(self.__cycle_failures)
+
+        logger.info("Write cycle completed - %s operations in %s round trips" % (self.__last_cycle_stats["operations"],
+                                                                                self.__last_cycle_stats["round_trips"]))
+
+        return failures
+
+    def queue(self, collection_name, operation, key=None):
+        # Operations queued with the same key within a cycle are executed only once, the last one wins (e.g. the
+        # latest state upserts of a cluster)
+        with self.__lock:
+            if key is None:
+                self.__operations.setdefault(collection_name, []).append(operation)
+            else:
+                self.__keyed_operations.setdefault(collection_name, {})[key] = operation
+            in_cycle = self.__cycle_depth > 0
+
+        if not in_cycle:
+            self.flush()
+
+    def flush(self):
+        self.__flush(False)
+
+    def __flush(self, in_cycle):
+
+        with self.__lock:
+            pending = {}
+            for collection_name in set(self.__operations.keys()) | set(self.__keyed_operations.keys()):
+                pending[collection_name] = list(self.__keyed_operations.get(collection_name, {}).values()) + \
+                                           self.__operations.get(collection_name, [])
+            self.__operations = {}
+            self.__keyed_operations = {}
+
+        for collection_name, operations in pending.items():
+
+            if not operations:
+                continue
+
+            try:
+                self.__collection(collection_name).bulk_write(operations, ordered=False)
+            except BulkWriteError as err:
+                logger.error("Bulk write to '%s' partially failed" % collection_name)
+                logger.error(str(err.details.get("writeErrors", [])[:5]))
+                self.__record(in_cycle, len(operations), len(err.details.get("writeErrors", [])), collection_name)
+                continue
+            except Exception as err:
+                logger.error("Unable to bulk write to '%s'" % collection_name)
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                self.__record(in_cycle, len(operations), len(operations), collection_name)
+                continue
+
+            self.__record(in_cycle, len(operations), 0)
+
+    def __record(self, in_cycle, operations, errors, collection_name=None):
+        with self.__lock:
+            stats = self.__cycle_stats if in_cycle else self.__out_of_cycle_stats
+            stats["round_trips"] += 1
+            stats["operations"] += operations
+            stats["errors"] += errors
+            if in_cycle and errors:
+                self.__cycle_failures.add(collection_name)
+
+    def get_cycle_stats(self):
+        with self.__lock:
+            return dict(self.__last_cycle_stats, out_of_cycle=dict(self.__out_of_cycle_stats))
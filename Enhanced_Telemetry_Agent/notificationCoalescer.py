@@ -0,0 +1,112 @@
+import json
+import time
+import logging
+
+from collections import deque
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.NotificationCoalescer")
+
+FLAPPING = "FLAPPING"
+
+
+class NotificationCoalescer(QObject):
+
+    notificationEvent = pyqtSignal(object)
+
+    def __init__(self, config):
+
+        super(QObject, self).__init__()
+
+        # Events of an entity are held for the coalescing window, only the last status is forwarded if it differs
+        # from the last forwarded one. An entity changing status flap_threshold times within the flap window is
+        # reported once as FLAPPING, and its status is forwarded again once stable for a whole flap window.
+        self.__coalesce_window = config["coalesce_window"]
+        self.__flap_window = config["flap_window"]
+        self.__flap_threshold = config["flap_threshold"]
+
+        self.__entities = {}
+
+        self.__timer = QTimer(self)
+        self.__timer.timeout.connect(self.__on_timer)
+        self.__timer.start(1000)
+
+    def __entity(self, entity_id):
+        if entity_id not in self.__entities:
+            self.__entities[entity_id] = {"status": None, "pending": None, "deadline": 0, "flapping": False,
+                                          "transitions": deque(), "last_status": None, "type": "Probe"}
+        return self.__entities[entity_id]
+
+    def on_event(self, event):
+
+        entity_id = event.get("entity_id", None)
+
+        if entity_id is None:
+            self.notificationEvent.emit(event)
+            return
+
+        entity = self.__entity(entity_id)
+        entity["type"] = event.get("type", "Probe")
+        now = time.time()
+
+        if event["status"] != entity["last_status"]:
+            entity["last_status"] = event["status"]
+            entity["transitions"].append(now)
+        while entity["transitions"] and entity["transitions"][0] < now - self.__flap_window:
+            entity["transitions"].popleft()
+
+        if not entity["flapping"] and len(entity["transitions"]) >= self.__flap_threshold:
+            logger.warning("Entity '%s' is flapping, suppress its notifications" % entity_id)
+            entity["flapping"] = True
+            entity["pending"] = None
+            self.__forward(entity, dict(event, status=FLAPPING))
+            return
+
+        if entity["flapping"]:
+            return
+
+        if event["status"] == entity["status"]:
+            # Duplicate, or the pending opposite event is cancelled within the coalescing window
+            entity["pending"] = None
+            return
+
+        if self.__coalesce_window <= 0:
+            self.__forward(entity, event)
+            return
+
+        if entity["pending"] is None:
+            entity["deadline"] = now + self.__coalesce_window
+        entity["pending"] = event
+
+    def __forward(self, entity, event):
+        entity["status"] = event["status"]
+        logger.debug("Forward notification event: %s" % json.dumps(event))
+        self.notificationEvent.emit(event)
+
+    def __on_timer(self):
+
+        now = time.time()
+
+        for entity_id, entity in self.__entities.items():
+
+            if entity["flapping"]:
+                while entity["transitions"] and entity["transitions"][0] < now - self.__flap_window:
+                    entity["transitions"].popleft()
+                if not entity["transitions"]:
+                    logger.info("Entity '%s' is stable, status '%s'" % (entity_id, entity["last_status"]))
+                    entity["flapping"] = False
+                    self.__forward(entity, {"entity_id": entity_id, "status": entity["last_status"],
+                                            "type": entity["type"], "timestamp": int(now)})
+                continue
+
+            if entity["pending"] is not None and entity["deadline"] <= now:
+                self.__forward(entity, entity["pending"])
+                entity["pending"] = None
+
+    def flush(self):
+        # Forward the pending events, e.g. on shutdown
+        for entity in self.__entities.values():
+            if entity["pending"] is not None and not entity["flapping"]:
+                self.__forward(entity, entity["pending"])
+                entity["pending"] = None
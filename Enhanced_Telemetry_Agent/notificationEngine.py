@@ -1,5 +1,11 @@
+import os
 import json
+import time
+import bisect
 import logging
+import threading
+
+from collections import deque
 
 import kafka
 from kafka import KafkaProducer
@@ -15,19 +21,318 @@ class NotificationEngine(QObject):
 
         logging.getLogger("kafka").setLevel(logging.WARNING)
 
-        self.__kafka_notification_topic = "serrano_telemetry_notifications"
-        self.__producer = KafkaProducer(bootstrap_servers=config["bootstrap_servers"],
-                                        value_serializer=lambda v: json.dumps(v).encode("ascii"),
-                                        compression_type='gzip')
+        self.__config = config
+        self.__kafka_notification_topic = config["topic"]
+        self.__producer = None
+        self.__failed_producer = None
 
-    def on_telemetry_controller_event(self, event):
+        # Events are buffered in order while Kafka is unavailable: a bounded ring in memory, followed by the optional
+        # overflow file once the ring is full. Without an overflow file, the oldest events are dropped.
+        self.__buffer = deque()
+        self.__buffer_size = config["buffer_size"]
+        self.__overflow_file = config["overflow_file"]
+        self.__overflow_max_bytes = config["overflow_max_bytes"]
+        self.__overflow_events = 0
+
+        # Sequence numbers of the events sent asynchronously. The failed ones are buffered again in front of the ring,
+        # with their sequence numbers in __requeued, so that events failing together keep their send order.
+        self.__sequence = 0
+        self.__requeued = []
+
+        self.__lock = threading.Lock()
+        self.__stats = {"sent": 0, "delivered": 0, "failed": 0, "retried": 0, "dropped": 0}
+
+        self.__running = True
+        self.__wakeup = threading.Event()
+
+        if self.__overflow_file and os.path.exists(self.__overflow_file):
+            with open(self.__overflow_file) as f:
+                self.__overflow_events = sum(1 for line in f if line.strip())
+
+        if not self.__connect():
+            logger.warning("Notification engine started in degraded mode, events are buffered")
+
+        self.__reconnect_thread = threading.Thread(target=self.__reconnect_loop, daemon=True)
+        self.__reconnect_thread.start()
+
+    def __connect(self):
+
+        try:
+            # Sends are asynchronous and batched (linger_ms), events are keyed by entity_id so that the events of an
+            # entity are assigned to the same partition. A single in-flight request per connection keeps their order
+            # on retries. A send never blocks for long on missing metadata, the event is buffered instead.
+            producer = KafkaProducer(bootstrap_servers=self.__config["bootstrap_servers"],
+                                     key_serializer=lambda k: str(k).encode("utf-8") if k is not None else None,
+                                     value_serializer=lambda v: json.dumps(v).encode("ascii"),
+                                     compression_type='gzip',
+                                     linger_ms=self.__config["linger_ms"],
+                                     batch_size=self.__config["batch_size"],
+                                     acks=self.__config["acks"],
+                                     retries=self.__config["retries"],
+                                     max_in_flight_requests_per_connection=1,
+                                     max_block_ms=self.__config["max_block_ms"])
+        except Exception as err:
+            logger.error("Unable to connect to the Kafka bootstrap servers")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            return False
+
+        with self.__lock:
+            self.__producer = producer
+
+        logger.info("Notification engine connected to the Kafka bootstrap servers")
+        return True
+
+    def __reconnect_loop(self):
+
+        while self.__running:
+
+            self.__wakeup.wait(self.__config["reconnect_interval"])
+            self.__wakeup.clear()
+
+            if not self.__running:
+                break
+
+            self.__close_failed_producer()
+
+            if self.__producer is None and not self.__connect():
+                continue
+
+            self.__drain()
+
+            stats = self.get_stats()
+            if stats["buffered"] > 0 or stats["overflow"] > 0:
+                logger.warning("Notification engine degraded - %s" % json.dumps(stats))
+
+    def __drain(self):
+
+        # The buffered events are sent in order, synchronously, so that the drain stops at the first failure
+        while self.__running:
+
+            with self.__lock:
+                if not self.__buffer:
+                    self.__load_overflow()
+                if not self.__buffer or self.__producer is None:
+                    return
+                event = self.__buffer[0]
+                producer = self.__producer
+
+            try:
+                producer.send(self.__kafka_notification_topic, key=event.get("entity_id", None),
+                              value=event).get(timeout=self.__config["reconnect_interval"])
+            except Exception as err:
+                logger.error("Unable to drain buffered telemetry notification events")
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                return
+
+            with self.__lock:
+                # Failed in-flight events of the previous producer may have been requeued in front of it meanwhile
+                index = next((i for i, e in enumerate(self.__buffer) if e is event), None)
+                if index is not None:
+                    self.__remove_buffered(index)
+                self.__stats["sent"] += 1
+                self.__stats["delivered"] += 1
+
+    def __buffer_event(self, event):
+
+        # Called with the lock held
+        if self.__overflow_events == 0 and len(self.__buffer) < self.__buffer_size:
+            self.__buffer.append(event)
+            return
+
+        if self.__overflow_file:
+            try:
+                size = os.path.getsize(self.__overflow_file) if os.path.exists(self.__overflow_file) else 0
+                if size < self.__overflow_max_bytes:
+                    with open(self.__overflow_file, "a") as f:
+                        f.write(json.dumps(event) + "\n")
+                    self.__overflow_events += 1
+                    return
+            except Exception as err:
+                logger.error("Unable to write to the notification events overflow file")
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            self.__stats["dropped"] += 1
+            return
+
+        self.__remove_buffered(0)
+        self.__buffer.append(event)
+        self.__stats["dropped"] += 1
+
+    def __remove_buffered(self, index):
+        # Called with the lock held
+        del self.__buffer[index]
+        if index < len(self.__requeued):
+            del self.__requeued[index]
+
+    def __load_overflow(self):
+
+        # Called with the lock held and an empty ring, moves the oldest overflow events to the ring
+        if self.__overflow_events == 0:
+            return
+
+        try:
+            with open(self.__overflow_file) as f:
+                lines = [line for line in f if line.strip()]
+
+            events = [json.loads(line) for line in lines[:self.__buffer_size]]
+
+            remaining = lines[self.__buffer_size:]
+            with open(self.__overflow_file + ".tmp", "w") as f:
+                f.writelines(remaining)
+            os.replace(self.__overflow_file + ".tmp", self.__overflow_file)
+        except Exception as err:
+            # An unreadable overflow file is set aside, so that the drain of the next events goes on
+            quarantine_file = "%s.corrupt.%s" % (self.__overflow_file, int(time.time()))
+            logger.error("Unable to load the notification events overflow file, move it to '%s'" % quarantine_file)
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            try:
+                os.replace(self.__overflow_file, quarantine_file)
+            except OSError as err:
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            self.__stats["dropped"] += self.__overflow_events
+            self.__overflow_events = 0
+            return
+
+        self.__buffer.extend(events)
+        self.__overflow_events = len(remaining)
+
+    def __persist_buffer(self):
+
+        # The events of the ring are kept in front of the overflow file, they are sent after the next boot
+        with self.__lock:
+            if not self.__buffer or not self.__overflow_file:
+                return
+            try:
+                lines = []
+                if os.path.exists(self.__overflow_file):
+                    with open(self.__overflow_file) as f:
+                        lines = [line for line in f if line.strip()]
+                with open(self.__overflow_file + ".tmp", "w") as f:
+                    f.writelines([json.dumps(event) + "\n" for event in self.__buffer] + lines)
+                os.replace(self.__overflow_file + ".tmp", self.__overflow_file)
+                self.__overflow_events += len(self.__buffer)
+                self.__buffer.clear()
+                self.__requeued = []
+            except Exception as err:
+                logger.error("Unable to persist the buffered telemetry notification events")
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def __send(self, event):
         logger.debug("Forward telemetry notification event ...")
         logger.debug(json.dumps(event))
-        self.__producer.send(self.__kafka_notification_topic, event)
-        self.__producer.flush()
+
+        with self.__lock:
+            # Events are buffered behind the already buffered ones to keep their order
+            if self.__producer is None or self.__buffer or self.__overflow_events > 0:
+                self.__buffer_event(event)
+                self.__wakeup.set()
+                return
+            producer = self.__producer
+            self.__sequence += 1
+            sequence = self.__sequence
+
+        try:
+            future = producer.send(self.__kafka_notification_topic, key=event.get("entity_id", None), value=event)
+        except Exception as err:
+            # e.g. the metadata of the topic are unavailable while the brokers are unreachable
+            logger.error("Unable to forward telemetry notification event, buffer it")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+            with self.__lock:
+                self.__buffer_event(event)
+            self.__wakeup.set()
+            return
+
+        self.__count("sent")
+        future.add_callback(self.__on_delivery)
+        future.add_errback(self.__on_delivery_error, sequence, event, producer)
+
+    def __count(self, k):
+        with self.__lock:
+            self.__stats[k] += 1
+
+    def __on_delivery(self, record_metadata):
+        self.__count("delivered")
+
+    def __on_delivery_error(self, sequence, event, producer, err):
+
+        logger.error("Unable to deliver telemetry notification event of entity '%s'" % event.get("entity_id", ""))
+        logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+        # Events rejected by the brokers (e.g. too large) are not sent again
+        if not getattr(err, "retriable", False):
+            self.__count("failed")
+            return
+
+        # Otherwise the brokers are unreachable: the event is buffered in front of the pending ones, after the
+        # failed events sent before it, and the producer is handed over to the reconnect loop. Errbacks run on the
+        # I/O thread of the producer, which can not be closed from here.
+        with self.__lock:
+            self.__stats["retried"] += 1
+            index = bisect.bisect(self.__requeued, sequence)
+            self.__requeued.insert(index, sequence)
+            self.__buffer.insert(index, event)
+            if len(self.__buffer) > self.__buffer_size:
+                # The newest event moves to the overflow file, or is dropped without one
+                newest = self.__buffer.pop()
+                del self.__requeued[len(self.__buffer):]
+                if self.__overflow_file:
+                    self.__buffer_event(newest)
+                else:
+                    self.__stats["dropped"] += 1
+            if self.__producer is producer:
+                logger.warning("Notification engine switched to degraded mode, events are buffered")
+                self.__producer = None
+                self.__failed_producer = producer
+
+        self.__wakeup.set()
+
+    def __close_failed_producer(self):
+
+        with self.__lock:
+            producer = self.__failed_producer
+            self.__failed_producer = None
+
+        if producer is None:
+            return
+
+        try:
+            producer.close(timeout=0)
+        except Exception as err:
+            logger.error("Unable to close the Kafka producer")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def get_stats(self):
+        with self.__lock:
+            data = dict(self.__stats)
+            data["connected"] = self.__producer is not None
+            data["buffered"] = len(self.__buffer)
+            data["buffer_size"] = self.__buffer_size
+            data["overflow"] = self.__overflow_events
+            return data
+
+    def on_telemetry_controller_event(self, event):
+        self.__send(event)
 
     def on_analytic_engine_event(self, event):
-        logger.debug("Forward telemetry notification event ...")
-        logger.debug(json.dumps(event))
-        self.__producer.send(self.__kafka_notification_topic, event)
-        self.__producer.flush()
+        self.__send(event)
+
+    def shutdown(self, timeout=10):
+
+        self.__running = False
+        self.__wakeup.set()
+        self.__reconnect_thread.join(timeout)
+
+        self.__persist_buffer()
+        self.__close_failed_producer()
+
+        if self.__producer is None:
+            logger.warning("Notification engine not connected - %s" % json.dumps(self.get_stats()))
+            return
+
+        logger.info("Flush pending telemetry notification events ...")
+        try:
+            self.__producer.flush(timeout=timeout)
+            self.__producer.close(timeout=timeout)
+        except Exception as err:
+            logger.error("Unable to flush pending telemetry notification events")
+            logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+        logger.info("Telemetry notification events - %s" % json.dumps(self.get_stats()))
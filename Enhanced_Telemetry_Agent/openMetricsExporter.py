@@ -0,0 +1,199 @@
+import json
+import logging
+import threading
+
+import quantityParser
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.OpenMetricsExporter")
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Metric families of the exposition: name -> (type, help)
+FAMILIES = {
+    "serrano_probe_last_snapshot_timestamp_seconds": ("gauge", "Time the monitoring data of the probe last changed"),
+    "serrano_node_running_pods": ("gauge", "Running pods of the node"),
+    "serrano_node_cpu_seconds": ("counter", "Seconds the CPUs of the node spent in each mode"),
+    "serrano_node_memory_total_bytes": ("gauge", "Total memory of the node"),
+    "serrano_node_memory_used_bytes": ("gauge", "Used memory of the node"),
+    "serrano_node_memory_usage_percentage": ("gauge", "Memory usage of the node"),
+    "serrano_node_filesystem_size_bytes": ("gauge", "Size of the root filesystem of the node"),
+    "serrano_node_filesystem_used_bytes": ("gauge", "Used bytes of the root filesystem of the node"),
+    "serrano_node_filesystem_usage_percentage": ("gauge", "Usage of the root filesystem of the node"),
+    "serrano_node_network_receive_bytes": ("counter", "Bytes received by the node"),
+    "serrano_node_network_transmit_bytes": ("counter", "Bytes transmitted by the node"),
+    "serrano_pod_cpu_usage_cores": ("gauge", "CPU usage of the pod"),
+    "serrano_pod_memory_usage_bytes": ("gauge", "Memory usage of the pod"),
+    "serrano_pod_restarts": ("counter", "Container restarts of the pod"),
+    "serrano_pod_phase": ("gauge", "Phase of the pod"),
+    "serrano_deployment_replicas": ("gauge", "Replicas of the deployment"),
+    "serrano_deployment_available_replicas": ("gauge", "Available replicas of the deployment"),
+    "serrano_deployment_ready_replicas": ("gauge", "Ready replicas of the deployment"),
+    "serrano_persistent_volume_capacity_bytes": ("gauge", "Storage capacity of the persistent volume"),
+    "serrano_hpc_partition_avail_cpus": ("gauge", "Available CPUs of the HPC partition"),
+    "serrano_hpc_partition_avail_nodes": ("gauge", "Available nodes of the HPC partition"),
+    "serrano_hpc_partition_queued_jobs": ("gauge", "Queued jobs of the HPC partition"),
+    "serrano_hpc_partition_running_jobs": ("gauge", "Running jobs of the HPC partition"),
+    "serrano_edge_storage_disk_total_bytes": ("gauge", "Disk capacity of the edge storage device"),
+    "serrano_edge_storage_disk_used_bytes": ("gauge", "Used disk of the edge storage device"),
+    "serrano_edge_storage_disk_free_bytes": ("gauge", "Free disk of the edge storage device"),
+    "serrano_edge_storage_bucket_usage_bytes": ("gauge", "Bucket usage of the edge storage device"),
+    "serrano_edge_storage_bucket_objects": ("gauge", "Bucket objects of the edge storage device"),
+    "serrano_edge_storage_process_cpu_seconds": ("counter", "CPU time of the edge storage device process"),
+    "serrano_edge_storage_process_resident_memory_bytes": ("gauge",
+                                                           "Resident memory of the edge storage device process")
+}
+
+NODE_METRICS = {"node_total_running_pods": "serrano_node_running_pods",
+                "node_memory_MemTotal_bytes": "serrano_node_memory_total_bytes",
+                "node_memory_MemUsed_bytes": "serrano_node_memory_used_bytes",
+                "node_memory_usage_percentage": "serrano_node_memory_usage_percentage",
+                "node_filesystem_size_bytes": "serrano_node_filesystem_size_bytes",
+                "node_filesystem_used_bytes": "serrano_node_filesystem_used_bytes",
+                "node_filesystem_usage_percentage": "serrano_node_filesystem_usage_percentage",
+                "node_network_receive_bytes_total": "serrano_node_network_receive_bytes",
+                "node_network_transmit_bytes_total": "serrano_node_network_transmit_bytes"}
+
+DEPLOYMENT_METRICS = {"replicas": "serrano_deployment_replicas",
+                      "available_replicas": "serrano_deployment_available_replicas",
+                      "ready_replicas": "serrano_deployment_ready_replicas"}
+
+HPC_PARTITION_METRICS = {"avail_cpus": "serrano_hpc_partition_avail_cpus",
+                         "avail_nodes": "serrano_hpc_partition_avail_nodes",
+                         "queued_jobs": "serrano_hpc_partition_queued_jobs",
+                         "running_jobs": "serrano_hpc_partition_running_jobs"}
+
+EDGE_STORAGE_METRICS = {"minio_node_disk_total_bytes": "serrano_edge_storage_disk_total_bytes",
+                        "minio_node_disk_used_bytes": "serrano_edge_storage_disk_used_bytes",
+                        "minio_node_disk_free_bytes": "serrano_edge_storage_disk_free_bytes",
+                        "minio_bucket_usage_total_bytes": "serrano_edge_storage_bucket_usage_bytes",
+                        "minio_bucket_usage_object_total": "serrano_edge_storage_bucket_objects",
+                        "minio_node_process_cpu_total_seconds": "serrano_edge_storage_process_cpu_seconds",
+                        "minio_node_process_resident_memory_bytes":
+                            "serrano_edge_storage_process_resident_memory_bytes"}
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class OpenMetricsExporter:
+
+    def __init__(self, probe_data_cache):
+
+        # The exposition is rendered from the latest monitoring data of the probes. The samples of a probe are
+        # rendered again only when its monitoring data change, the exposition only when any probe changes.
+        self.__probe_data_cache = probe_data_cache
+
+        self.__lock = threading.Lock()
+        self.__probes = {}
+        self.__versions = None
+        self.__exposition = b"# EOF\n"
+
+    def render(self):
+
+        snapshots = self.__probe_data_cache.snapshots("monitor")
+        versions = {probe_uuid: snapshot["version"] for probe_uuid, snapshot in snapshots.items()}
+
+        with self.__lock:
+
+            if versions == self.__versions:
+                return self.__exposition
+
+            for probe_uuid, snapshot in snapshots.items():
+                if self.__probes.get(probe_uuid, {}).get("version", None) == snapshot["version"]:
+                    continue
+                try:
+                    samples = self.__render_probe(probe_uuid, snapshot)
+                except Exception as err:
+                    logger.error("Unable to render the monitoring data of probe '%s'" % probe_uuid)
+                    logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                    samples = {}
+                self.__probes[probe_uuid] = {"version": snapshot["version"], "samples": samples}
+
+            for probe_uuid in set(self.__probes.keys()) - set(snapshots.keys()):
+                del self.__probes[probe_uuid]
+
+            lines = []
+            for name, (metric_type, metric_help) in FAMILIES.items():
+                family_lines = [line for probe in self.__probes.values() for line in probe["samples"].get(name, [])]
+                if not family_lines:
+                    continue
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                lines.append("# HELP %s %s" % (name, metric_help))
+                lines.extend(family_lines)
+            lines.append("# EOF")
+
+            self.__exposition = ("\n".join(lines) + "\n").encode("utf-8")
+            self.__versions = versions
+
+            return self.__exposition
+
+    @staticmethod
+    def __add(samples, name, labels, value, suffix=""):
+
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+
+        if FAMILIES[name][0] == "counter":
+            suffix = "_total"
+
+        label_set = ",".join(['%s="%s"' % (k, escape(v)) for k, v in labels.items() if v is not None])
+        samples.setdefault(name, []).append("%s%s{%s} %s" % (name, suffix, label_set, repr(float(value))))
+
+    def __render_probe(self, probe_uuid, snapshot):
+
+        samples = {}
+        data = json.loads(snapshot["text"])
+        probe_labels = {"probe_uuid": probe_uuid, "cluster_uuid": snapshot["metadata"].get("cluster_uuid", None)}
+
+        self.__add(samples, "serrano_probe_last_snapshot_timestamp_seconds", probe_labels, snapshot["modified"])
+
+        k8s_data = data.get("kubernetes_monitoring_data", {})
+
+        for node in k8s_data.get("Nodes", []):
+            labels = dict(probe_labels, node=node.get("node_name", None))
+            for k, name in NODE_METRICS.items():
+                self.__add(samples, name, labels, node.get(k, None))
+            for cpu in node.get("node_cpus", []):
+                for mode in ["idle", "used"]:
+                    self.__add(samples, "serrano_node_cpu_seconds", dict(labels, cpu=cpu.get("label", ""), mode=mode),
+                               cpu.get(mode, None))
+
+        for pod in k8s_data.get("Pods", []):
+            labels = dict(probe_labels, namespace=pod.get("namespace", None), pod=pod.get("name", None),
+                          node=pod.get("node", None))
+            usage = pod.get("usage", None) or {}
+            if "cpu" in usage or "memory" in usage:
+                quantityParser.normalize_usage(usage)
+            self.__add(samples, "serrano_pod_cpu_usage_cores", labels, usage.get("cpu_cores", None))
+            self.__add(samples, "serrano_pod_memory_usage_bytes", labels, usage.get("memory_bytes", None))
+            self.__add(samples, "serrano_pod_restarts", labels, pod.get("restarts", None))
+            if pod.get("phase", None):
+                self.__add(samples, "serrano_pod_phase", dict(labels, phase=pod["phase"]), 1)
+
+        for deployment in k8s_data.get("Deployments", []):
+            labels = dict(probe_labels, namespace=deployment.get("namespace", None),
+                          deployment=deployment.get("name", None))
+            for k, name in DEPLOYMENT_METRICS.items():
+                self.__add(samples, name, labels, deployment.get(k, None))
+
+        for pv in k8s_data.get("PersistentVolumes", []):
+            capacity = pv.get("capacity_numeric", None) or quantityParser.normalize_capacity(pv.get("capacity", None)
+                                                                                             or {})
+            self.__add(samples, "serrano_persistent_volume_capacity_bytes",
+                       dict(probe_labels, persistent_volume=pv.get("name", None)), capacity.get("storage", None))
+
+        hpc_data = data.get("hpc_monitoring_data", {})
+
+        for partition in hpc_data.get("partitions", []):
+            labels = dict(probe_labels, infrastructure=hpc_data.get("name", None),
+                          partition=partition.get("name", None))
+            for k, name in HPC_PARTITION_METRICS.items():
+                self.__add(samples, name, labels, partition.get(k, None))
+
+        for device in data.get("edge_storage_devices", []):
+            labels = dict(probe_labels, node=device.get("node", None), device=device.get("name", None))
+            for k, name in EDGE_STORAGE_METRICS.items():
+                self.__add(samples, name, labels, device.get(k, None))
+
+        return samples
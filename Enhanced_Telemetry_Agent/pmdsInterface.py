@@ -1,13 +1,67 @@
 import json
 import logging
+import threading
 
 from PyQt5.QtCore import QThread
 
 from influxdb_client import InfluxDBClient, Point, Dialect, BucketRetentionRules
+from influxdb_client import TaskCreateRequest, TaskUpdateRequest
 from influxdb_client.client.write_api import SYNCHRONOUS
 
 logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.PMDSInterface")
 
+# Measurement used for the pods metrics of each PMDS schema version. Version 1 keeps the pod
+# "phase" and "creation_timestamp" as tags, version 2 stores them as fields to bound the series cardinality.
+PODS_MEASUREMENT = {1: "pods", 2: "pods_v2"}
+
+# Numeric fields of the SERRANO deployments samples that are rolled up into the downsampling tiers
+DEPLOYMENTS_ROLLUP_FIELDS = ["cpu_usage_cores", "memory_usage_bytes", "restarts"]
+DEPLOYMENTS_ROLLUP_FUNCTIONS = ["min", "max", "mean", "last"]
+
+DEPLOYMENTS_BUCKET = "SERRANO_Deployments"
+
+# Downsampling tiers of the deployments monitoring data, rolled up by InfluxDB tasks
+DEPLOYMENTS_TIERS = {"1m": {"bucket": "SERRANO_Deployments_1m", "every": "1m", "offset": "15s",
+                            "source": DEPLOYMENTS_BUCKET},
+                     "1h": {"bucket": "SERRANO_Deployments_1h", "every": "1h", "offset": "2m",
+                            "source": "SERRANO_Deployments_1m"}}
+
+
+def deployments_rollup_flux(tier, org, start=None, stop=None):
+
+    # Flux of the rollup task of a tier, or of the rollup of the given time range when the tier is backfilled
+    tier_config = DEPLOYMENTS_TIERS[tier]
+
+    if start is None:
+        flux = ['import "strings"',
+                'option task = {name: "%s", every: %s, offset: %s}' % (tier_config["bucket"],
+                                                                       tier_config["every"],
+                                                                       tier_config["offset"]),
+                'data = from(bucket: "%s") |> range(start: -task.every) '
+                '|> filter(fn: (r) => r._measurement == "serrano_deployments")' % tier_config["source"]]
+    else:
+        flux = ['import "strings"',
+                'data = from(bucket: "%s") |> range(start: %s, stop: %s) '
+                '|> filter(fn: (r) => r._measurement == "serrano_deployments")' % (tier_config["source"], start, stop)]
+
+    for fn in DEPLOYMENTS_ROLLUP_FUNCTIONS:
+        if tier_config["source"] == DEPLOYMENTS_BUCKET:
+            # Rollup of the raw samples, the rolled up fields are suffixed with the aggregate function
+            fields = " or ".join(['r._field == "%s"' % f for f in DEPLOYMENTS_ROLLUP_FIELDS])
+            flux.append('data |> filter(fn: (r) => %s) '
+                        '|> aggregateWindow(every: %s, fn: %s, createEmpty: false) '
+                        '|> map(fn: (r) => ({r with _field: r._field + "_%s"})) '
+                        '|> to(bucket: "%s", org: "%s")' % (fields, tier_config["every"], fn, fn,
+                                                            tier_config["bucket"], org))
+        else:
+            # Rollup of a lower tier, e.g. the max of the per minute max values
+            flux.append('data |> filter(fn: (r) => strings.hasSuffix(v: r._field, suffix: "_%s")) '
+                        '|> aggregateWindow(every: %s, fn: %s, createEmpty: false) '
+                        '|> to(bucket: "%s", org: "%s")' % (fn, tier_config["every"], fn,
+                                                            tier_config["bucket"], org))
+
+    return "\n".join(flux)
+
 
 class PMDSInterface(QThread):
 
@@ -17,6 +71,7 @@ class PMDSInterface(QThread):
 
         influx_config = config.get_influxDB()
         self.__influx_org = influx_config["org"]
+        self.__schema_version = influx_config["schema_version"]
 
         client = InfluxDBClient(url="https://%s:%s" % (influx_config["address"], influx_config["port"]),
                                 token=influx_config["token"],
@@ -25,13 +80,21 @@ class PMDSInterface(QThread):
         self.__write_api = client.write_api(write_options=SYNCHRONOUS)
         self.__query_api = client.query_api()
         self.__buckets_api = client.buckets_api()
+        self.__tasks_api = client.tasks_api()
 
-        self.__deployments_monitoring_bucket = "SERRANO_Deployments"
+        self.__deployments_monitoring_bucket = DEPLOYMENTS_BUCKET
         self.__deployments_specific_metrics_bucket = "SERRANO_Deployments_Specific_Metrics"
-        self.__grafana_deployments_monitoring_bucket = "SERRANO_Deployments_Metrics"
+        self.__deployments_tiers = DEPLOYMENTS_TIERS
+        self.__deployments_retention = influx_config["deployments_retention"]
+        self.__deployments_downsampling = False
+        self.__downsampling_lock = threading.Lock()
 
         self.__retention_rules = BucketRetentionRules(type="expire", every_seconds=315360000)
 
+        if self.__schema_version not in PODS_MEASUREMENT:
+            logger.error("Unsupported PMDS schema version '%s', fallback to version 2" % self.__schema_version)
+            self.__schema_version = 2
+
     def on_update_pmds(self, data):
 
         try:
@@ -46,8 +109,8 @@ class PMDSInterface(QThread):
                 self.__ensure_bucket(data["probe_uuid"])
                 self.__handle_edge_storage_data(data["cluster_uuid"], data["probe_uuid"], data["data"])
             elif data["probe_type"] == "DeploymentMonitoring":
-                self.__ensure_bucket(self.__deployments_monitoring_bucket)
-                self.__ensure_bucket(self.__grafana_deployments_monitoring_bucket)
+                if not self.__deployments_downsampling:
+                    self.__setup_deployments_downsampling()
                 self.__handle_deployment_monitoring_data(data["data"])
             elif data["probe_type"] == "DeploymentSpecificMetrics":
                 self.__ensure_bucket(self.__deployments_specific_metrics_bucket)
@@ -59,31 +122,88 @@ class PMDSInterface(QThread):
                                                                                           data["probe_uuid"]))
             logger.error(str(err))
 
-    def __ensure_bucket(self, probe_uuid):
-        if len(self.__buckets_api.find_buckets(name=probe_uuid).buckets) == 0:
+    def __ensure_bucket(self, probe_uuid, retention_seconds=None):
+
+        retention_rules = self.__retention_rules
+        if retention_seconds is not None:
+            retention_rules = BucketRetentionRules(type="expire", every_seconds=retention_seconds)
+
+        buckets = self.__buckets_api.find_buckets(name=probe_uuid).buckets
+
+        if len(buckets) == 0:
             logger.info("Create bucket for probe '%s'" % probe_uuid)
             self.__buckets_api.create_bucket(bucket_name=probe_uuid,
-                                             retention_rules=self.__retention_rules,
+                                             retention_rules=retention_rules,
                                              org=self.__influx_org)
+        elif retention_seconds is not None and \
+                [r.every_seconds for r in buckets[0].retention_rules] != [retention_seconds]:
+            # The retention of an existing bucket is not shortened here, the history of SERRANO_Deployments would
+            # expire before it is rolled up into the downsampling tiers (see deploymentsTiersMigration.py)
+            logger.warning("Retention period of bucket '%s' differs from the configured %s seconds, it is applied "
+                           "by the deployments tiers migration" % (probe_uuid, retention_seconds))
+
+    def __setup_deployments_downsampling(self):
+
+        with self.__downsampling_lock:
+
+            if self.__deployments_downsampling:
+                return
+
+            logger.info("Setup the downsampling tiers for the deployments monitoring data")
+
+            self.__ensure_bucket(self.__deployments_monitoring_bucket, self.__deployments_retention["raw"])
+
+            for tier in self.__deployments_tiers.keys():
+                self.__ensure_deployments_rollup_task(tier)
+
+            self.__deployments_downsampling = True
+
+    def __ensure_deployments_rollup_task(self, tier):
+
+        tier_config = self.__deployments_tiers[tier]
+        self.__ensure_bucket(tier_config["bucket"], self.__deployments_retention[tier])
+
+        flux = deployments_rollup_flux(tier, self.__influx_org)
+        tasks = self.__tasks_api.find_tasks(name=tier_config["bucket"])
+
+        if len(tasks) == 0:
+            logger.info("Create downsampling task '%s'" % tier_config["bucket"])
+            self.__tasks_api.create_task(task_create_request=TaskCreateRequest(flux=flux,
+                                                                               org=self.__influx_org,
+                                                                               status="active",
+                                                                               description="SERRANO deployments "
+                                                                                           "%s rollup" % tier))
+        elif tasks[0].flux != flux:
+            logger.info("Update downsampling task '%s'" % tier_config["bucket"])
+            self.__tasks_api.update_task_request(tasks[0].id, TaskUpdateRequest(flux=flux))
 
     def __write_data_persistent_volumes(self, bucket_name, p_volumes):
 
         for pv in p_volumes:
             record = {"measurement": "persistentVolumes",
                       "tags": {"name": pv["name"]},
-                      "fields": {"capacity_storage": pv["capacity"]["storage"]}}
+                      "fields": {"capacity_storage": pv["capacity"]["storage"],
+                                 "capacity_storage_bytes": pv["capacity_numeric"]["storage"]}}
             self.__write_api.write(bucket_name, self.__influx_org, record)
 
     def __write_data_pods(self, bucket_name, pods):
 
         for pod in pods:
-            pod_tags = {"name": pod["name"], "namespace": pod["namespace"], "node": pod["node"],
-                        "phase": pod["phase"], "creation_timestamp": pod["creation_timestamp"]}
+            pod_tags = {"name": pod["name"], "namespace": pod["namespace"], "node": pod["node"]}
 
             pod_fields = {"cpu_usage": pod["usage"]["cpu"], "memory_usage": pod["usage"]["memory"],
+                          "cpu_usage_cores": float(pod["usage"]["cpu_cores"]),
+                          "memory_usage_bytes": int(pod["usage"]["memory_bytes"]),
                           "restarts": pod["restarts"]}
 
-            record = {"measurement": "pods", "tags": pod_tags, "fields": pod_fields}
+            if self.__schema_version == 1:
+                pod_tags["phase"] = pod["phase"]
+                pod_tags["creation_timestamp"] = pod["creation_timestamp"]
+            else:
+                pod_fields["phase"] = pod["phase"]
+                pod_fields["creation_timestamp"] = float(pod["creation_timestamp"])
+
+            record = {"measurement": PODS_MEASUREMENT[self.__schema_version], "tags": pod_tags, "fields": pod_fields}
 
             self.__write_api.write(bucket_name, self.__influx_org, record)
 
@@ -206,36 +326,36 @@ class PMDSInterface(QThread):
                       "fields": {"phase": deployment_data["phase"],
                                  "restarts": deployment_data["restarts"],
                                  "cpu_usage": deployment_data["usage"]["cpu"],
-                                 "memory_usage": deployment_data["usage"]["memory"]}}
-
-            memory_usage_mb = int(deployment_data["usage"]["memory"][:-2]) * 0.001024
-            cpu_usage_m = int(deployment_data["usage"]["cpu"][:-1])/1000000
-
-            grafana_record = {"measurement": "serrano_deployments",
-                              "tags": {"cluster_uuid": deployment_data["cluster_uuid"],
-                                       "node": deployment_data["node"],
-                                       "name": deployment_data["name"],
-                                       "deployment_uuid": deployment_data["deployment_uuid"],
-                                       "group_id": deployment_data["group_id"]},
-                              "fields": {"restarts": int(deployment_data["restarts"]),
-                                         "cpu_usage_m": cpu_usage_m,
-                                         "memory_usage_mb": memory_usage_mb}}
+                                 "memory_usage": deployment_data["usage"]["memory"],
+                                 "cpu_usage_cores": float(deployment_data["usage"]["cpu_cores"]),
+                                 "memory_usage_bytes": int(deployment_data["usage"]["memory_bytes"])}}
 
             self.__write_api.write(self.__deployments_monitoring_bucket, self.__influx_org, record)
-            self.__write_api.write(self.__grafana_deployments_monitoring_bucket, self.__influx_org, grafana_record)
 
     def __handle_deployment_specific_metrics_data(self, data):
 
-        record = {"measurement": "serrano_deployments_specific_metrics",
-                  "tags": {"cluster_uuid": data["cluster_uuid"],
-                           "deployment_uuid": data["deployment_uuid"],
-                           "service_id": data["service_id"]},
-                  "fields": data["metrics"]}
+        # A single record, or a batch of records of the bulk ingestion written at once
+        records = []
+
+        for metrics_data in data if isinstance(data, list) else [data]:
+            record = {"measurement": "serrano_deployments_specific_metrics",
+                      "tags": {"cluster_uuid": metrics_data["cluster_uuid"],
+                               "deployment_uuid": metrics_data["deployment_uuid"],
+                               "service_id": metrics_data["service_id"]},
+                      "fields": metrics_data["metrics"]}
+            if isinstance(metrics_data.get("timestamp", None), (int, float)):
+                record["time"] = int(metrics_data["timestamp"] * 10 ** 9)
+            records.append(record)
 
-        self.__write_api.write(self.__deployments_specific_metrics_bucket, self.__influx_org, record)
+        self.__write_api.write(self.__deployments_specific_metrics_bucket, self.__influx_org, records)
 
     def __del__(self):
         self.wait()
 
     def run(self):
+        try:
+            self.__setup_deployments_downsampling()
+        except Exception as err:
+            logger.error("Unable to setup the downsampling tiers for the deployments monitoring data")
+            logger.error(str(err))
         logger.info("PMDSInterface is ready ...")
@@ -0,0 +1,42 @@
+import time
+import threading
+
+
+class ProbeDataCache:
+
+    def __init__(self):
+
+        # Latest raw (JSON text) payloads per probe, kind ("monitor", "inventory") and target. The version of an
+        # entry changes only when its payload changes.
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__version = 0
+
+    def put(self, probe_uuid, kind, text, target=None, metadata=None):
+        with self.__lock:
+            entry = self.__entries.get((probe_uuid, kind, target), None)
+            if entry is None or entry["text"] != text:
+                self.__version += 1
+                entry = {"text": text, "version": self.__version, "metadata": metadata or {}, "modified": time.time()}
+                self.__entries[(probe_uuid, kind, target)] = entry
+            elif metadata:
+                entry["metadata"] = metadata
+            entry["timestamp"] = time.time()
+
+    def get(self, probe_uuid, kind, target=None):
+        # Cached payload and its age in seconds, or None
+        with self.__lock:
+            entry = self.__entries.get((probe_uuid, kind, target), None)
+        if entry is None:
+            return None
+        return entry["text"], time.time() - entry["timestamp"]
+
+    def snapshots(self, kind, target=None):
+        # Entries of all the probes for the given kind and target: {probe_uuid: entry}
+        with self.__lock:
+            return {k[0]: dict(v) for k, v in self.__entries.items() if k[1] == kind and k[2] == target}
+
+    def remove(self, probe_uuid):
+        with self.__lock:
+            for k in [k for k in self.__entries if k[0] == probe_uuid]:
+                del self.__entries[k]
@@ -0,0 +1,59 @@
+# Kubernetes resource quantities (e.g. "123456n", "250m", "20480Ki", "1.5Gi", "1e3") to numeric values.
+# The same module is shipped with the Kubernetes probe and the Enhanced Telemetry Agent, keep them in sync
+# (python checkSharedModules.py).
+
+BINARY_SUFFIXES = {"Ki": 2 ** 10, "Mi": 2 ** 20, "Gi": 2 ** 30, "Ti": 2 ** 40, "Pi": 2 ** 50, "Ei": 2 ** 60}
+DECIMAL_SUFFIXES = {"n": -9, "u": -6, "m": -3, "k": 3, "M": 6, "G": 9, "T": 12, "P": 15, "E": 18}
+
+
+def parse_quantity(quantity):
+
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+
+    quantity = str(quantity).strip()
+
+    if quantity[-1:] == "i":
+        multiplier = BINARY_SUFFIXES.get(quantity[-2:], None)
+        if multiplier is None:
+            raise ValueError("Invalid quantity '%s'" % quantity)
+        return float(quantity[:-2]) * multiplier
+
+    exponent = DECIMAL_SUFFIXES.get(quantity[-1:], None)
+
+    if exponent is None:
+        return float(quantity)
+    if exponent < 0:
+        return float(quantity[:-1]) / 10 ** -exponent
+    return float(quantity[:-1]) * 10 ** exponent
+
+
+def cpu_cores(quantity):
+    return parse_quantity(quantity)
+
+
+def memory_bytes(quantity):
+    return int(round(parse_quantity(quantity)))
+
+
+def normalize_usage(usage):
+
+    if "cpu" in usage and "cpu_cores" not in usage:
+        usage["cpu_cores"] = cpu_cores(usage["cpu"])
+    if "memory" in usage and "memory_bytes" not in usage:
+        usage["memory_bytes"] = memory_bytes(usage["memory"])
+
+    return usage
+
+
+def normalize_capacity(capacity):
+
+    data = {}
+
+    for k, v in capacity.items():
+        try:
+            data[k] = cpu_cores(v) if k == "cpu" else memory_bytes(v)
+        except (TypeError, ValueError):
+            continue
+
+    return data
@@ -0,0 +1,231 @@
+import logging
+
+import pymongo
+
+# The same module is shipped with the Enhanced Telemetry Agent and the Central Telemetry Handler, keep them in sync
+# (python checkSharedModules.py).
+logger = logging.getLogger("SERRANO.OperationalDB.SchemaManager")
+
+# Monitoring data collections that expire through a TTL index on the BSON date "created_at" field, written by the
+# Enhanced Telemetry Agents and by the Central Telemetry Handler respectively
+METRICS_COLLECTIONS = ["cluster_state_metrics", "edge_storage_metrics", "cluster_deployment_metrics",
+                       "deployments_specific_metrics", "cluster_entity_metrics"]
+CENTRAL_METRICS_COLLECTIONS = ["serrano_state_metrics"]
+
+TTL_FIELD = "created_at"
+TTL_INDEX = "created_at_ttl"
+
+# Storage modes of the monitoring data: regular collections, or time-series collections (MongoDB >= 6.0)
+STORAGE_MODES = ["collection", "timeseries"]
+
+# Collections stored as time-series collections in "timeseries" storage mode: metaField
+TIME_SERIES_COLLECTIONS = {"cluster_state_metrics": "cluster_uuid", "cluster_deployment_metrics": "deployment_uuid"}
+
+# Indexes of the operational database, per collection: (index keys, unique)
+INDEXES = {
+    "entities": [([("uuid", pymongo.ASCENDING)], True),
+                 ([("type", pymongo.ASCENDING), ("uuid", pymongo.ASCENDING)], False),
+                 ([("type", pymongo.ASCENDING), ("cluster_uuid", pymongo.ASCENDING)], False),
+                 ([("type", pymongo.ASCENDING), ("probes", pymongo.ASCENDING)], False)],
+    "clusters": [([("uuid", pymongo.ASCENDING)], True),
+                 ([("type", pymongo.ASCENDING)], False)],
+    "edge_storage": [([("cluster_uuid", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], True)],
+    "cluster_capacity": [([("cluster_uuid", pymongo.ASCENDING)], True)],
+    "cluster_nodes": [([("cluster_uuid", pymongo.ASCENDING), ("node_name", pymongo.ASCENDING)], True),
+                      ([("gpu", pymongo.ASCENDING)], False),
+                      ([("fpga", pymongo.ASCENDING)], False),
+                      ([("security_tier", pymongo.ASCENDING), ("vaccel", pymongo.ASCENDING)], False),
+                      ([("cpu_free", pymongo.ASCENDING)], False),
+                      ([("memory_free", pymongo.ASCENDING)], False)],
+    "cluster_state_latest": [([("cluster_uuid", pymongo.ASCENDING)], True),
+                             ([("timestamp", pymongo.ASCENDING)], False)],
+    "edge_storage_latest": [([("cluster_uuid", pymongo.ASCENDING), ("name", pymongo.ASCENDING)], True),
+                            ([("name", pymongo.ASCENDING)], False),
+                            ([("timestamp", pymongo.ASCENDING)], False)],
+    "serrano_state_metrics": [([("scope", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], False)],
+    "cluster_state_metrics": [([("cluster_uuid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING),
+                                ("_id", pymongo.DESCENDING)], False)],
+    "edge_storage_metrics": [([("cluster_uuid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], False),
+                             ([("name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], False)],
+    "cluster_deployment_metrics": [([("cluster_uuid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], False),
+                                   ([("deployment_uuid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                                    False)],
+    "deployments_specific_metrics": [([("deployment_uuid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                                      False)],
+    "cluster_entity_metrics": [([("cluster_uuid", pymongo.ASCENDING), ("entity_type", pymongo.ASCENDING),
+                                 ("entity_name", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)], False)],
+    "serrano_deployments": [([("deployment_uuid", pymongo.ASCENDING)], True),
+                            ([("clusters", pymongo.ASCENDING)], False)],
+    "deployment_outbox": [([("deployment_uuid", pymongo.ASCENDING), ("cluster_uuid", pymongo.ASCENDING)], True),
+                          ([("next_attempt", pymongo.ASCENDING)], False)],
+    "serrano_kernel_deployments": [([("deployment_mode", pymongo.ASCENDING), ("cluster_uuid", pymongo.ASCENDING)],
+                                    False)],
+    "serrano_kernel_metrics": [([("cluster_uuid", pymongo.ASCENDING), ("kernel_name", pymongo.ASCENDING)], False)]
+}
+
+# Query shapes of the agent and the central handler that have to be served by an index: (filter, sort)
+QUERY_SHAPES = {
+    "entities": [({"uuid": ""}, None),
+                 ({"type": "Agent"}, None),
+                 ({"type": "Probe.k8s", "cluster_uuid": ""}, None)],
+    "clusters": [({"uuid": ""}, None)],
+    "edge_storage": [({"cluster_uuid": "", "name": ""}, None)],
+    "cluster_capacity": [({"cluster_uuid": ""}, None)],
+    "cluster_nodes": [({"cluster_uuid": "", "node_name": ""}, None),
+                      ({"gpu": {"$gte": 1}}, None)],
+    "cluster_state_latest": [({"cluster_uuid": ""}, None),
+                             ({"timestamp": {"$gte": 0}}, None)],
+    "edge_storage_latest": [({"name": ""}, None)],
+    "serrano_state_metrics": [({"scope": ""}, [("timestamp", pymongo.DESCENDING)])],
+    "cluster_state_metrics": [({"cluster_uuid": ""}, [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])],
+    "edge_storage_metrics": [({"cluster_uuid": ""}, [("timestamp", pymongo.DESCENDING)])],
+    "cluster_deployment_metrics": [({"deployment_uuid": ""}, [("timestamp", pymongo.DESCENDING)])],
+    "deployments_specific_metrics": [({"deployment_uuid": ""}, [("timestamp", pymongo.DESCENDING)])],
+    "cluster_entity_metrics": [({"cluster_uuid": "", "entity_type": "node", "entity_name": ""},
+                                [("timestamp", pymongo.DESCENDING)])],
+    "serrano_deployments": [({"deployment_uuid": ""}, None),
+                            ({"clusters": ""}, None)],
+    "deployment_outbox": [({"next_attempt": {"$lte": 0}}, [("next_attempt", pymongo.ASCENDING)])]
+}
+
+
+class SchemaManager:
+
+    def __init__(self, database, storage_mode="collection"):
+        self.__database = database
+        self.__storage_mode = storage_mode if storage_mode in STORAGE_MODES else "collection"
+
+    def __collection_type(self, collection_name):
+        info = list(self.__database.list_collections(filter={"name": collection_name}))
+        return info[0].get("type", "collection") if info else None
+
+    def __is_time_series(self, collection_name):
+        return self.__storage_mode == "timeseries" and collection_name in TIME_SERIES_COLLECTIONS
+
+    def ensure_time_series_collections(self, retain_period):
+
+        if self.__storage_mode != "timeseries":
+            return
+
+        for collection_name, meta_field in TIME_SERIES_COLLECTIONS.items():
+            try:
+                collection_type = self.__collection_type(collection_name)
+
+                if collection_type is None:
+                    logger.info("Create time-series collection '%s' (%s seconds)" % (collection_name, retain_period))
+                    self.__database.create_collection(collection_name,
+                                                      timeseries={"timeField": TTL_FIELD, "metaField": meta_field,
+                                                                  "granularity": "seconds"},
+                                                      expireAfterSeconds=retain_period)
+                elif collection_type == "timeseries":
+                    options = list(self.__database.list_collections(filter={"name": collection_name}))[0]["options"]
+                    if options.get("expireAfterSeconds", None) != retain_period:
+                        logger.info("Update expiry of time-series collection '%s' (%s seconds)" % (collection_name,
+                                                                                                 retain_period))
+                        self.__database.command("collMod", collection_name, expireAfterSeconds=retain_period)
+                else:
+                    logger.warning("Collection '%s' is a regular collection, run timeSeriesMigration.py to "
+                                   "migrate it to a time-series collection" % collection_name)
+            except Exception as err:
+                logger.error("Unable to setup the time-series collection '%s'" % collection_name)
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def ensure_indexes(self):
+
+        for collection_name, indexes in INDEXES.items():
+
+            # Creating an index implicitly creates a regular collection, time-series collections are created by the
+            # Enhanced Telemetry Agent
+            if self.__is_time_series(collection_name) and self.__collection_type(collection_name) is None:
+                continue
+
+            collection = self.__database[collection_name]
+
+            for keys, unique in indexes:
+                try:
+                    collection.create_index(keys, unique=unique)
+                except Exception as err:
+                    # e.g. existing duplicate entries prevent the creation of a unique index
+                    logger.error("Unable to create index %s for collection '%s'" % (keys, collection_name))
+                    logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def check_query_plans(self):
+
+        collection_scans = []
+
+        for collection_name, query_shapes in QUERY_SHAPES.items():
+
+            # The plans of time-series collections are executed against their internal buckets collection
+            if self.__is_time_series(collection_name):
+                continue
+
+            for query_filter, sort in query_shapes:
+                try:
+                    cursor = self.__database[collection_name].find(query_filter).limit(1)
+                    if sort:
+                        cursor = cursor.sort(sort)
+                    plan = cursor.explain()["queryPlanner"]["winningPlan"]
+                except Exception as err:
+                    logger.error("Unable to explain query %s for collection '%s'" % (query_filter, collection_name))
+                    logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+                    continue
+
+                if self.__plan_stages(plan).intersection({"COLLSCAN", "SORT"}):
+                    logger.warning("Query %s on collection '%s' is not served by an index" % (query_filter,
+                                                                                            collection_name))
+                    collection_scans.append({"collection": collection_name, "filter": query_filter})
+
+        return collection_scans
+
+    def __plan_stages(self, plan):
+
+        stages = {plan.get("stage", "")}
+
+        for k in ["inputStage", "queryPlan"]:
+            if k in plan:
+                stages |= self.__plan_stages(plan[k])
+
+        for input_plan in plan.get("inputStages", []):
+            stages |= self.__plan_stages(input_plan)
+
+        return stages
+
+    def ensure_ttl_indexes(self, retain_period, collection_names=None):
+
+        for collection_name in collection_names or METRICS_COLLECTIONS:
+
+            # Time-series collections expire through their own expireAfterSeconds option
+            if self.__is_time_series(collection_name):
+                continue
+
+            collection = self.__database[collection_name]
+            try:
+                self.__migrate_timestamps(collection)
+                self.__ensure_ttl_index(collection, retain_period)
+            except Exception as err:
+                logger.error("Unable to setup the TTL index of collection '%s'" % collection_name)
+                logger.error("%s - %s" % (err.__class__.__name__, str(err)))
+
+    def __ensure_ttl_index(self, collection, retain_period):
+
+        index = collection.index_information().get(TTL_INDEX, None)
+
+        if index is None:
+            logger.info("Create TTL index for collection '%s' (%s seconds)" % (collection.name, retain_period))
+            collection.create_index([(TTL_FIELD, pymongo.ASCENDING)], name=TTL_INDEX, expireAfterSeconds=retain_period)
+        elif index.get("expireAfterSeconds", None) != retain_period:
+            logger.info("Update TTL index for collection '%s' (%s seconds)" % (collection.name, retain_period))
+            self.__database.command("collMod", collection.name,
+                                    index={"name": TTL_INDEX, "expireAfterSeconds": retain_period})
+
+    def __migrate_timestamps(self, collection):
+
+        # Documents written before the TTL index existed only carry the integer (epoch seconds) timestamp
+        result = collection.update_many({TTL_FIELD: {"$exists": False}, "timestamp": {"$type": "number"}},
+                                        [{"$set": {TTL_FIELD: {"$toDate": {"$multiply": [{"$toLong": "$timestamp"},
+                                                                                          1000]}}}}])
+        if result.modified_count > 0:
+            logger.info("Migrated %s documents of collection '%s'" % (result.modified_count, collection.name))
+
+        # Documents without a usable timestamp expire one retention period after the migration
+        collection.update_many({TTL_FIELD: {"$exists": False}}, [{"$set": {TTL_FIELD: "$$NOW"}}])
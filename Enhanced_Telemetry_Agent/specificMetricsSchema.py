@@ -0,0 +1,106 @@
+import time
+import math
+import threading
+
+from collections import OrderedDict
+
+REQUIRED_FIELDS = ["cluster_uuid", "deployment_uuid", "service_id", "metrics"]
+
+# Accepted range of the record timestamps, unix time in seconds
+MIN_TIMESTAMP = 946684800
+MAX_CLOCK_SKEW = 3600
+
+
+def value_type(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "string"
+    return None
+
+
+class SpecificMetricsSchema:
+
+    def __init__(self, max_entries=10000):
+
+        # Type of each metric per (deployment_uuid, service_id), learned from the accepted records. It prevents
+        # field type conflicts in the PMDS, e.g. a metric written as a number and later as a string.
+        self.__lock = threading.Lock()
+        self.__schemas = OrderedDict()
+        self.__max_entries = max_entries
+
+    def validate(self, record):
+        # Normalized record or the reason of its rejection
+
+        if not isinstance(record, dict):
+            return None, "Record is not an object"
+
+        for k in REQUIRED_FIELDS:
+            if k not in record:
+                return None, "Missing field '%s'" % k
+
+        if not isinstance(record["metrics"], dict) or not record["metrics"]:
+            return None, "Field 'metrics' is not a non-empty object"
+
+        if "timestamp" in record:
+            reason = self.__check_timestamp(record["timestamp"])
+            if reason:
+                return None, reason
+
+        metrics = {}
+        types = {}
+
+        for name, value in record["metrics"].items():
+            types[name] = value_type(value)
+            if types[name] is None:
+                return None, "Metric '%s' is not a number, string or boolean" % name
+            if types[name] == "float" and not math.isfinite(value):
+                return None, "Metric '%s' is not a finite number" % name
+            # The submitted numeric type is kept, the PMDS stores integers and floats as different field types
+            metrics[name] = value
+
+        key = (record["deployment_uuid"], record["service_id"])
+
+        with self.__lock:
+            schema = self.__schemas.get(key, None)
+            if schema is None:
+                schema = {}
+                self.__schemas[key] = schema
+                if len(self.__schemas) > self.__max_entries:
+                    self.__schemas.popitem(last=False)
+            else:
+                self.__schemas.move_to_end(key)
+
+            for name, t in types.items():
+                if schema.get(name, t) != t:
+                    return None, "Metric '%s' is '%s', expected '%s'" % (name, t, schema[name])
+
+            schema.update(types)
+
+        data = dict(record)
+        data["metrics"] = metrics
+        return data, None
+
+    @staticmethod
+    def __check_timestamp(timestamp):
+
+        if value_type(timestamp) not in ["integer", "float"] or not math.isfinite(timestamp):
+            return "Field 'timestamp' is not numeric"
+
+        max_timestamp = time.time() + MAX_CLOCK_SKEW
+
+        if MIN_TIMESTAMP <= timestamp / 1000 <= max_timestamp:
+            return "Field 'timestamp' is in milliseconds, expected seconds"
+        if not MIN_TIMESTAMP <= timestamp <= max_timestamp:
+            return "Field 'timestamp' is out of range"
+
+        return None
+
+    def forget(self, deployment_uuid):
+        with self.__lock:
+            for k in [k for k in self.__schemas if k[0] == deployment_uuid]:
+                del self.__schemas[k]
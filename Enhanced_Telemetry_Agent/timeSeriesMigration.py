@@ -0,0 +1,145 @@
+"""
+    Move the existing monitoring data of the regular "cluster_state_metrics" and "cluster_deployment_metrics"
+    collections to time-series collections with the same names, as used by the "timeseries" storage mode of the
+    operational database.
+
+    Each regular collection is renamed to "<collection>_legacy", the time-series collection is created and the
+    documents are copied in batches ordered by "_id", so that an interrupted migration can be resumed by running
+    the command again. The copies keep the "_id" of the legacy documents, so that the documents of a batch that
+    was copied but not yet removed from the legacy collection are not copied again. The legacy collection is
+    dropped once it is copied, unless the "--keep-legacy" option is provided. The Enhanced Telemetry Agent should
+    be stopped during the migration.
+
+    Example: python timeSeriesMigration.py --batch-size 1000
+"""
+
+import sys
+import yaml
+import time
+import logging
+import os.path
+import argparse
+import datetime
+
+import pymongo
+
+import schemaManager
+import agentConfiguration
+
+CONF_FILE = "/etc/serrano/telemetry_agent.yaml"
+LOG_LEVEL = {"CRITICAL": 50, "ERROR": 40, "WARNING": 30, "INFO": 20, "DEBUG": 10}
+
+logger = logging.getLogger("SERRANO.EnhancedTelemetryAgent.TimeSeriesMigration")
+
+
+def collection_type(database, collection_name):
+    info = list(database.list_collections(filter={"name": collection_name}))
+    return info[0].get("type", "collection") if info else None
+
+
+def to_time_series_document(document):
+
+    if schemaManager.TTL_FIELD not in document:
+        timestamp = document.get("timestamp", None)
+        if isinstance(timestamp, (int, float)):
+            document[schemaManager.TTL_FIELD] = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        else:
+            document[schemaManager.TTL_FIELD] = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    return document
+
+
+def migrate_collection(database, collection_name, retain_period, batch_size, keep_legacy):
+
+    legacy_name = "%s_legacy" % collection_name
+
+    if collection_type(database, collection_name) == "collection":
+        if collection_type(database, legacy_name) is not None:
+            logger.error("Unable to migrate '%s', collection '%s' already exists" % (collection_name, legacy_name))
+            return 0
+        logger.info("Rename collection '%s' to '%s'" % (collection_name, legacy_name))
+        database[collection_name].rename(legacy_name)
+
+    if collection_type(database, legacy_name) is None:
+        logger.info("Nothing to migrate for collection '%s'" % collection_name)
+        return 0
+
+    schemaManager.SchemaManager(database, "timeseries").ensure_time_series_collections(retain_period)
+
+    legacy_collection = database[legacy_name]
+    collection = database[collection_name]
+
+    migrated = 0
+    last_id = None
+
+    # Resume after the last document that was already copied and removed from the legacy collection
+    while True:
+
+        query_filter = {} if last_id is None else {"_id": {"$gt": last_id}}
+        documents = list(legacy_collection.find(query_filter).sort("_id", pymongo.ASCENDING).limit(batch_size))
+
+        if not documents:
+            break
+
+        ids = [d["_id"] for d in documents]
+
+        # Only the first batch may have been copied already, by an interrupted run before its removal. The
+        # time-series collections do not enforce unique "_id" values, the copied ones are skipped instead.
+        copied = set()
+        if last_id is None:
+            copied = set([d["_id"] for d in collection.find({"_id": {"$in": ids}}, {"_id": 1})])
+
+        last_id = documents[-1]["_id"]
+
+        documents = [to_time_series_document(d) for d in documents if d["_id"] not in copied]
+        if documents:
+            collection.insert_many(documents, ordered=False)
+        legacy_collection.delete_many({"_id": {"$in": ids}})
+
+        migrated += len(ids)
+        logger.info("Collection '%s' - migrated %s documents" % (collection_name, migrated))
+
+    if not keep_legacy:
+        logger.info("Drop collection '%s'" % legacy_name)
+        legacy_collection.drop()
+
+    return migrated
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Migrate the cluster metrics collections to time-series collections")
+    parser.add_argument("--config", default=CONF_FILE)
+    parser.add_argument("--collection", action="append", default=[],
+                        help="Collection to migrate, all the time-series collections are migrated if not specified")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Documents copied per batch")
+    parser.add_argument("--keep-legacy", action="store_true", help="Keep the (empty) legacy collections")
+    args = parser.parse_args()
+
+    config_params = None
+
+    if os.path.exists(args.config):
+        with open(args.config) as f:
+            config_params = yaml.safe_load(f)
+
+    if config_params is None:
+        sys.exit(0)
+
+    config = agentConfiguration.AgentConfiguration(config_params)
+    logging.basicConfig(filename="migration_%s.log" % (int(time.time())), level=LOG_LEVEL[config.get_log_level()])
+
+    operational_db = config.get_operational_db()
+    mongo_uri = "mongodb+srv://%s:%s@%s/?retryWrites=true&w=majority" % (operational_db["username"],
+                                                                         operational_db["password"],
+                                                                         operational_db["address"])
+    mongo_client = pymongo.MongoClient(mongo_uri)
+
+    for name in args.collection or list(schemaManager.TIME_SERIES_COLLECTIONS.keys()):
+        if name not in schemaManager.TIME_SERIES_COLLECTIONS:
+            print("Collection '%s' is not stored as time-series collection" % name)
+            continue
+        total = migrate_collection(mongo_client[operational_db["dbName"]], name, config.get_retain_data_period(),
+                                   args.batch_size, args.keep_legacy)
+        print("Collection '%s': %s documents migrated" % (name, total))
+
+    mongo_client.close()
@@ -1,4 +1,8 @@
+import re
+import time
 import logging
+import calendar
+import datetime
 
 from typing import List
 from json import JSONEncoder
@@ -19,9 +23,59 @@ NODES_NETWORK = ['node_network_receive_bytes_total', 'node_network_receive_drop_
                  'node_network_transmit_errs_total', 'node_network_transmit_packets_total']
 DEPLOYMENTS = ['replicas', 'ready_replicas', 'available_replicas']
 PODS = ['cpu_usage', 'memory_usage', 'restarts']
+PODS_MEASUREMENT = {1: "pods", 2: "pods_v2"}
 EDGE_STORAGE = ['minio_bucket_usage_object_total', 'minio_bucket_usage_total_bytes', 'minio_node_disk_free_bytes',
                 'minio_node_disk_total_bytes', 'minio_node_disk_used_bytes', 'minio_s3_requests_total']
 SERRANO_DEPLOYMENTS = ['cpu_usage', 'memory_usage', 'restarts', 'phase']
+SERRANO_DEPLOYMENTS_ROLLUP = ['%s_%s' % (field, fn) for field in ['cpu_usage_cores', 'memory_usage_bytes', 'restarts']
+                              for fn in ['min', 'max', 'mean', 'last']]
+# Downsampling tiers of the SERRANO deployments data, the "auto" resolution selects the first tier that
+# covers the requested time range (in seconds)
+SERRANO_DEPLOYMENTS_TIERS = {"raw": "", "1m": "_1m", "1h": "_1h"}
+SERRANO_DEPLOYMENTS_AUTO_TIERS = [(21600, "raw"), (604800, "1m")]
+
+
+def fields_filter(fields):
+    return "(%s)" % " or ".join(['r._field == "%s"' % field for field in fields])
+
+
+# Flux duration units in seconds, months and years are approximated
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800,
+                  "mo": 2592000, "y": 31536000}
+DURATION = re.compile(r"(\d+)(ns|us|µs|ms|mo|s|m|h|d|w|y)")
+RFC3339 = re.compile(r"^(\d{4}-\d{2}-\d{2})[Tt ](\d{2}:\d{2}:\d{2})(\.\d+)?([Zz]|([+-])(\d{2}):(\d{2}))$")
+
+
+def time_range_seconds(start, stop):
+
+    # Length of a Flux time range given as relative durations (e.g. -1h30m), unix timestamps or RFC3339 times.
+    # None if the range cannot be parsed.
+    def to_timestamp(value):
+        if value is None or value == "now()":
+            return time.time()
+        if value.isdigit():
+            return int(value)
+        if value.startswith("-"):
+            parts = DURATION.findall(value[1:])
+            if not parts or "".join([n + u for n, u in parts]) != value[1:]:
+                raise ValueError("Invalid duration '%s'" % value)
+            return time.time() - sum([int(n) * DURATION_UNITS[u] for n, u in parts])
+        match = RFC3339.match(value)
+        if match is None:
+            raise ValueError("Invalid time '%s'" % value)
+        timestamp = calendar.timegm(datetime.datetime.strptime("%sT%s" % match.group(1, 2),
+                                                               "%Y-%m-%dT%H:%M:%S").timetuple())
+        if match.group(3):
+            timestamp += float(match.group(3))
+        if match.group(5):
+            offset = int(match.group(6)) * 3600 + int(match.group(7)) * 60
+            timestamp -= offset if match.group(5) == "+" else -offset
+        return timestamp
+
+    try:
+        return to_timestamp(stop) - to_timestamp(start)
+    except ValueError:
+        return None
 
 
 class PMDSList(TableList):
@@ -72,6 +126,36 @@ class PMDSList(TableList):
 
         return data
 
+    def pivoted_to_json_object_grouped_by(self, group_by, columns: List['str'] = None, **kwargs):
+
+        data = {}
+
+        for table in self.__tables:
+            for record in table.records:
+                entry = {k: v for (k, v) in record.values.items() if k not in ["result", "table", "_start", "_stop",
+                                                                               "_measurement", "_time", group_by]
+                         and (columns is None or k in columns)}
+                entry["time"] = record["_time"]
+                data.setdefault(record[group_by], []).append(entry)
+
+        return data
+
+    def pivoted_to_json_object(self, fields, columns, **kwargs):
+
+        data = []
+
+        for table in self.__tables:
+            for record in table.records:
+                labels = {k: record.values.get(k, None) for k in columns}
+                for field in fields:
+                    if field not in record.values:
+                        continue
+                    entry = {"_field": field, "_time": record["_time"], "_value": record[field]}
+                    entry.update(labels)
+                    data.append(entry)
+
+        return data
+
     def cpus_to_json_object_grouped_by(self, cpus):
 
         data = {}
@@ -198,6 +282,8 @@ class DataEngine:
 
         if volume_name:
             filter_query.append('r.name== "%s"' % volume_name)
+        if format == "compact":
+            filter_query.append(fields_filter(["capacity_storage"]))
         if stop:
             range_query.append('stop: %s' % stop)
 
@@ -261,16 +347,17 @@ class DataEngine:
 
     def query_pods(self, bucket, start, **kwargs):
 
-        data = {}
-
         stop = kwargs.get("stop", None)
         name = kwargs.get("name", None)
         node = kwargs.get("node_name", None)
         phase = kwargs.get("phase", None)
         namespace = kwargs.get("namespace", None)
+        schema = kwargs.get("schema", None)
         format = kwargs.get("format", 'compact')
 
-        filter_query = ['r._measurement == "pods"']
+        data = {} if format == "compact" else []
+
+        filter_query = []
         range_query = ['start: %s' % start]
 
         if namespace:
@@ -279,31 +366,67 @@ class DataEngine:
             filter_query.append('r.name == "%s"' % name)
         if node:
             filter_query.append('r.node == "%s"' % node)
-        if phase:
-            filter_query.append('r.phase == "%s"' % phase)
         if stop:
             range_query.append('stop: %s' % stop)
 
-        filters = " and ".join(filter_query)
-        flux_query = 'from(bucket:"%s") |> range(%s) |> filter(fn: (r) => %s )' % (bucket,
-                                                                                   ','.join(range_query),
-                                                                                   filters)
+        schema_versions = [int(schema)] if schema in ["1", "2"] else list(PODS_MEASUREMENT.keys())
 
         try:
 
+            for schema_version in schema_versions:
+                schema_filter_query = filter_query
+                if format == "compact" and schema_version == 1:
+                    schema_filter_query = filter_query + [fields_filter(PODS)]
+                elif format == "compact":
+                    # Same compact entries as schema version 1, where the phase is a tag
+                    schema_filter_query = filter_query + [fields_filter(PODS + ["phase"])]
+                tables = self.__query_pods_schema(bucket, schema_version, range_query, schema_filter_query, phase)
+
+                if format == "compact":
+                    if schema_version == 1:
+                        entries = tables.to_json_object_grouped_by(fields=PODS, group_by="name", labels=["phase"])
+                    else:
+                        entries = tables.pivoted_to_json_object_grouped_by(group_by="name", columns=PODS + ["phase"])
+                    for pod_name, pod_entries in entries.items():
+                        data.setdefault(pod_name, []).extend(pod_entries)
+                else:
+                    if schema_version == 1:
+                        data += tables.to_json_object(columns=["name", "namespace", "node", "phase",
+                                                               "_field", "_time", "_value"])
+                    else:
+                        data += tables.pivoted_to_json_object(fields=PODS, columns=["name", "namespace", "node",
+                                                                                    "phase"])
+
             if format == "compact":
-                data = PMDSList(self.__query_api.query(flux_query)).to_json_object_grouped_by(fields=PODS,
-                                                                                              group_by="name")
-            else:
-                data = PMDSList(self.__query_api.query(flux_query)).to_json_object(columns=["name", "namespace", "node",
-                                                                                            "phase", "_field", "_time",
-                                                                                            "_value"])
+                for pod_entries in data.values():
+                    pod_entries.sort(key=lambda entry: entry["time"])
+
         except Exception as err:
             logger.error("Unable to query InfluxDB service")
             logger.error(str(err))
 
         return data
 
+    def __query_pods_schema(self, bucket, schema_version, range_query, filter_query, phase):
+
+        filters = " and ".join(['r._measurement == "%s"' % PODS_MEASUREMENT[schema_version]] + filter_query)
+
+        if schema_version == 1:
+            if phase:
+                filters += ' and r.phase == "%s"' % phase
+            flux_query = 'from(bucket:"%s") |> range(%s) |> filter(fn: (r) => %s )' % (bucket,
+                                                                                       ','.join(range_query),
+                                                                                       filters)
+        else:
+            # Phase is a field in schema version 2, thus the records are pivoted before filtering on it
+            flux_query = 'from(bucket:"%s") |> range(%s) |> filter(fn: (r) => %s ) ' \
+                         '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")' % (
+                             bucket, ','.join(range_query), filters)
+            if phase:
+                flux_query += ' |> filter(fn: (r) => r.phase == "%s")' % phase
+
+        return PMDSList(self.__query_api.query(flux_query))
+
     def query_edge_storage_devices(self, bucket, start, **kwargs):
 
         data = {}
@@ -349,6 +472,19 @@ class DataEngine:
         cluster_uuid = kwargs.get("cluster_uuid", None)
         node = kwargs.get("node_name", None)
         format = kwargs.get("format", 'compact')
+        resolution = kwargs.get("resolution", "auto")
+
+        if resolution not in SERRANO_DEPLOYMENTS_TIERS:
+            # The coarsest tier is used for time ranges that cannot be parsed
+            resolution = "1h"
+            seconds = time_range_seconds(start, stop)
+            for max_range, tier in SERRANO_DEPLOYMENTS_AUTO_TIERS:
+                if seconds is not None and seconds <= max_range:
+                    resolution = tier
+                    break
+
+        bucket += SERRANO_DEPLOYMENTS_TIERS[resolution]
+        fields = SERRANO_DEPLOYMENTS if resolution == "raw" else SERRANO_DEPLOYMENTS_ROLLUP
 
         filter_query = ['r._measurement == "serrano_deployments"', 'r.deployment_uuid == "%s"' % deployment_uuid]
         range_query = ['start: %s' % start]
@@ -360,13 +496,16 @@ class DataEngine:
         if stop:
             range_query.append('stop: %s' % stop)
 
+        if format == "compact":
+            filter_query.append(fields_filter(fields))
+
         filters = " and ".join(filter_query)
         flux_query = 'from(bucket:"%s") |> range(%s) |> filter(fn: (r) => %s )' % (bucket,
                                                                                    ','.join(range_query),
                                                                                    filters)
         try:
             if format == "compact":
-                data = PMDSList(self.__query_api.query(flux_query)).to_json_object_grouped_by(fields=SERRANO_DEPLOYMENTS,
+                data = PMDSList(self.__query_api.query(flux_query)).to_json_object_grouped_by(fields=fields,
                                                                                               group_by="name",
                                                                                               labels=["group_id"])
             else:
@@ -83,13 +83,16 @@ def pmds_service_query_deployments(cluster_uuid, namespace, **kwargs):
     Filtering parameters:
       - name (path parameter) => Limits the results only for the pod with the provided name.
       - node_name (path parameter) => Limits the results only for the pods that are running in the specified node name.  
+      - phase (query parameter) => Limits the results only for the pods in the specified phase.
+      - schema (query parameter) => Limits the results to the pods measurement schema version "1" or "2". If not 
+        specified, the data of both versions are returned.
     
     Response format parameter, the same with the pmds_service_query_nodes()
 """
 
 
 def pmds_service_query_pods(cluster_uuid, namespace, **kwargs):
-    valid_query_params = ["start", "stop", "name", "node_name", "format"]
+    valid_query_params = ["start", "stop", "name", "node_name", "phase", "schema", "format"]
 
     query_params = {k: v for (k, v) in kwargs.items() if k in valid_query_params}
     query_params["namespace"] = namespace
@@ -128,7 +131,7 @@ def pmds_service_query_edge_storage_devices(cluster_uuid, **kwargs):
 
 
 def pmds_service_query_serrano_deployments(deployment_uuid, **kwargs):
-    valid_query_params = ["start", "stop", "node_name", "cluster_uuid", "format"]
+    valid_query_params = ["start", "stop", "node_name", "cluster_uuid", "resolution", "format"]
 
     query_params = {k: v for (k, v) in kwargs.items() if k in valid_query_params}
 
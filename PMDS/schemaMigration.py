@@ -0,0 +1,181 @@
+"""
+    Rewrite the historical pods metrics of the PMDS buckets from schema version 1 ("pods" measurement with
+    the pod phase and creation timestamp as tags) to schema version 2 ("pods_v2" measurement with the pod
+    phase and creation timestamp as fields).
+
+    The data are migrated in consecutive time windows, so that the memory of the migration tool remains
+    bounded regardless of the amount of the historical data. The records of schema version 1 are preserved,
+    unless the "--delete" option is provided. In that case the records of a window are deleted only once its
+    records are written synchronously and counted in the "pods_v2" measurement.
+
+    Example: python schemaMigration.py --bucket <probe_uuid> --start -365d --window 1d --delete
+"""
+
+import sys
+import yaml
+import time
+import logging
+import os.path
+import argparse
+import datetime
+
+from influxdb_client import InfluxDBClient, Point
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+import PMDSConfiguration
+
+CONF_FILE = "/etc/serrano/pmds.yaml"
+LOG_LEVEL = {"CRITICAL": 50, "ERROR": 40, "WARNING": 30, "INFO": 20, "DEBUG": 10}
+
+POD_TAGS = ["name", "namespace", "node"]
+POD_FIELDS = ["cpu_usage", "memory_usage", "restarts"]
+
+WRITE_BATCH_SIZE = 5000
+
+logger = logging.getLogger("SERRANO.PMDS.SchemaMigration")
+
+
+def parse_time(value, now):
+    if value.startswith("-"):
+        units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+        return now - datetime.timedelta(seconds=int(value[1:-1]) * units[value[-1]])
+    return datetime.datetime.fromtimestamp(int(value), tz=datetime.timezone.utc)
+
+
+def parse_window(value):
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    return datetime.timedelta(seconds=int(value[:-1]) * units[value[-1]])
+
+
+def migrate_window(query_api, write_api, bucket, org, start, stop):
+
+    flux_query = 'from(bucket: "%s") |> range(start: %s, stop: %s) |> filter(fn: (r) => r._measurement == "pods") ' \
+                 '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")' % (bucket,
+                                                                                               start.isoformat(),
+                                                                                               stop.isoformat())
+    points = []
+    keys = set()
+
+    for table in query_api.query(flux_query):
+        for record in table.records:
+            point = Point("pods_v2").time(record["_time"])
+            key = [record["_time"]]
+            for tag in POD_TAGS:
+                if record.values.get(tag, None) is not None:
+                    point.tag(tag, record[tag])
+                key.append(record.values.get(tag, None))
+            for field in POD_FIELDS:
+                if record.values.get(field, None) is not None:
+                    point.field(field, record[field])
+            if record.values.get("phase", None) is not None:
+                point.field("phase", record["phase"])
+            if record.values.get("creation_timestamp", None) is not None:
+                point.field("creation_timestamp", float(record["creation_timestamp"]))
+            points.append(point)
+            keys.add(tuple(key))
+
+    # Synchronous writes raise on failure, so that the window is never deleted after a lost write
+    for i in range(0, len(points), WRITE_BATCH_SIZE):
+        write_api.write(bucket=bucket, org=org, record=points[i:i + WRITE_BATCH_SIZE])
+
+    # Records of schema version 1 that differ only in the former phase / creation timestamp tags are a single
+    # schema version 2 record
+    return len(points), len(keys)
+
+
+def count_window(query_api, bucket, start, stop):
+
+    flux_query = 'from(bucket: "%s") |> range(start: %s, stop: %s) ' \
+                 '|> filter(fn: (r) => r._measurement == "pods_v2") ' \
+                 '|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value") ' \
+                 '|> group() |> count(column: "_time")' % (bucket, start.isoformat(), stop.isoformat())
+
+    count = 0
+    for table in query_api.query(flux_query):
+        for record in table.records:
+            count += record["_time"]
+
+    return count
+
+
+def migrate_bucket(client, bucket, org, start, stop, window, delete):
+
+    query_api = client.query_api()
+    delete_api = client.delete_api()
+
+    logger.info("Migrate pods metrics of bucket '%s' to schema version 2" % bucket)
+
+    migrated = 0
+    w_start = start
+
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    try:
+        while w_start < stop:
+            w_stop = min(w_start + window, stop)
+            count, expected = migrate_window(query_api, write_api, bucket, org, w_start, w_stop)
+
+            logger.info("Bucket '%s' - window %s / %s - migrated %s records" % (bucket, w_start.isoformat(),
+                                                                              w_stop.isoformat(), count))
+
+            if delete and count > 0:
+                written = count_window(query_api, bucket, w_start, w_stop)
+                if written >= expected:
+                    delete_api.delete(w_start, w_stop, '_measurement="pods"', bucket=bucket, org=org)
+                else:
+                    logger.error("Bucket '%s' - window %s / %s - %s of %s records found in 'pods_v2', schema version 1 "
+                                 "records are not deleted" % (bucket, w_start.isoformat(), w_stop.isoformat(), written,
+                                                              expected))
+
+            migrated += count
+            w_start = w_stop
+    finally:
+        write_api.close()
+
+    return migrated
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Migrate PMDS pods metrics to schema version 2")
+    parser.add_argument("--config", default=CONF_FILE)
+    parser.add_argument("--bucket", action="append", default=[],
+                        help="Bucket to migrate, all the non system buckets are migrated if not specified")
+    parser.add_argument("--start", default="-30d", help="Relative duration (e.g. -30d) or unix timestamp")
+    parser.add_argument("--stop", default=None, help="Relative duration (e.g. -1h) or unix timestamp")
+    parser.add_argument("--window", default="1d", help="Migration window (e.g. 6h, 1d)")
+    parser.add_argument("--delete", action="store_true", help="Delete the migrated schema version 1 records")
+    args = parser.parse_args()
+
+    config_params = None
+
+    if os.path.exists(args.config):
+        with open(args.config) as f:
+            config_params = yaml.safe_load(f)
+
+    if config_params is None:
+        sys.exit(0)
+
+    config = PMDSConfiguration.PMDSConfiguration(config_params)
+    logging.basicConfig(filename="migration_%s.log" % (int(time.time())), level=LOG_LEVEL[config.get_log_level()])
+
+    pmds_db = config.get_pmds_db()
+    client = InfluxDBClient(url="https://%s:%s" % (pmds_db["address"], pmds_db["port"]),
+                            token=pmds_db["token"],
+                            org=pmds_db["org"],
+                            timeout=300000)
+
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    start = parse_time(args.start, now)
+    stop = parse_time(args.stop, now) if args.stop else now
+
+    buckets = args.bucket
+    if not buckets:
+        buckets = [b.name for b in client.buckets_api().find_buckets(limit=100).buckets if not b.name.startswith("_")]
+
+    for bucket_name in buckets:
+        total = migrate_bucket(client, bucket_name, pmds_db["org"], start, stop, parse_window(args.window),
+                               args.delete)
+        print("Bucket '%s': %s pods records migrated" % (bucket_name, total))
+
+    client.close()
@@ -3,6 +3,8 @@ import requests
 from kubernetes import client
 from prometheus_client.parser import text_string_to_metric_families
 
+import metrics.quantityParser as quantityParser
+
 
 def k8s_cluster_inventory(api_client, node_exporter_endpoints):
     k8s_inventory_data = []
@@ -40,6 +42,7 @@ def k8s_cluster_inventory(api_client, node_exporter_endpoints):
             if "xilinx.com/fpga-xilinx" in k:
                 capacity["total_fpga"] = str(int(capacity["total_fpga"])+int(v))
         data["node_capacity"] = capacity
+        data["node_capacity_numeric"] = quantityParser.normalize_capacity(capacity)
         data["node_info"] = node.status.node_info.to_dict()
 
         k8s_inventory_data.append(data)
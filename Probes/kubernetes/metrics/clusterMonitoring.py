@@ -4,6 +4,8 @@ import requests
 from kubernetes import client
 from prometheus_client.parser import text_string_to_metric_families
 
+import metrics.quantityParser as quantityParser
+
 logger = logging.getLogger('SERRANO.TelemetryProbe.K8sProbe')
 
 def k8s_cluster_node_monitoring(node_exporter_data):
@@ -78,6 +80,7 @@ def k8s_cluster_persistent_volumes_monitoring(api_client):
         pv["name"] = item.metadata.name
         pv["creation_timestamp"] = item.metadata.creation_timestamp.timestamp()
         pv["capacity"] = item.spec.capacity
+        pv["capacity_numeric"] = quantityParser.normalize_capacity(item.spec.capacity)
         data.append(pv)
 
     return data
@@ -129,7 +132,7 @@ def k8s_cluster_pods_monitoring(api_client, cluster_worker_nodes):
         if len(top_pods["items"]) == 0:
             continue
 
-        pod["usage"] = top_pods["items"][0]['containers'][0]['usage']
+        pod["usage"] = quantityParser.normalize_usage(top_pods["items"][0]['containers'][0]['usage'])
         data.append(pod)
 
     return data
@@ -228,7 +231,7 @@ def k8s_application_data(api_client, deployment_name):#creates the list with met
                                                                                               plural='pods',
                                                                                               field_selector='metadata.name=' + pod.metadata.name,
                                                                                               watch=False)
-                    info["usage"] = top_pods["items"][0]['containers'][0]['usage']
+                    info["usage"] = quantityParser.normalize_usage(top_pods["items"][0]['containers'][0]['usage'])
                     data.append(info)
     return data
 
@@ -0,0 +1,39 @@
+"""
+    The telemetry components are deployed separately and import their modules from their own folder, so the
+    modules they share are shipped as identical copies. Run the check after changing any of them:
+
+        python checkSharedModules.py
+"""
+
+import sys
+import os.path
+import filecmp
+
+# Copies of each shared module, relative to the repository root
+SHARED_MODULES = [
+    ["Enhanced_Telemetry_Agent/quantityParser.py", "Probes/kubernetes/metrics/quantityParser.py"],
+    ["Enhanced_Telemetry_Agent/schemaManager.py", "Central_Telemetry_Handler/schemaManager.py"],
+    ["Enhanced_Telemetry_Agent/stateDelta.py", "Central_Telemetry_Handler/stateDelta.py"]
+]
+
+
+def check(root):
+
+    differences = []
+
+    for copies in SHARED_MODULES:
+        for path in copies[1:]:
+            if not filecmp.cmp(os.path.join(root, copies[0]), os.path.join(root, path), shallow=False):
+                differences.append((copies[0], path))
+
+    return differences
+
+
+if __name__ == "__main__":
+
+    differences = check(os.path.dirname(os.path.abspath(__file__)))
+
+    for original, copy in differences:
+        print("'%s' differs from '%s'" % (copy, original))
+
+    sys.exit(1 if differences else 0)